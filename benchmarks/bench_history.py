@@ -0,0 +1,154 @@
+"""
+履歴ストアのイベントループ停止時間ベンチマーク
+
+旧実装（async関数内で毎回 sqlite3.connect して同期実行）と、
+HistoryStore（常駐接続 + 専用スレッド + WAL + 複合インデックス）を比較する。
+
+    python benchmarks/bench_history.py [--users 200] [--rows 500] [--rounds 5]
+
+1msごとに起床するティッカーの遅延を計測し、イベントループが
+どれだけ止められたか（最大・p99）を出力する。
+"""
+
+import argparse
+import asyncio
+import os
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+TMP_DIR = Path(tempfile.mkdtemp(prefix="bench_history_"))
+os.environ["HISTORY_DB_PATH"] = str(TMP_DIR / "new.db")
+
+import main  # noqa: E402
+
+LEGACY_DB = TMP_DIR / "legacy.db"
+
+
+# ===== 旧実装（比較用） =====
+def legacy_init_db() -> None:
+    conn = sqlite3.connect(LEGACY_DB)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS chat_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_user_id ON chat_history(user_id)")
+    conn.commit()
+    conn.close()
+
+
+async def legacy_get_history(user_id: str) -> list[dict[str, str]]:
+    conn = sqlite3.connect(LEGACY_DB)
+    rows = conn.execute(
+        "SELECT role, content FROM chat_history WHERE user_id = ? ORDER BY timestamp DESC LIMIT 20",
+        (user_id,),
+    ).fetchall()
+    conn.close()
+    return [{"role": role, "content": content} for role, content in reversed(rows)]
+
+
+async def legacy_save_to_history(user_id: str, role: str, content: str) -> None:
+    conn = sqlite3.connect(LEGACY_DB)
+    conn.execute(
+        "INSERT INTO chat_history (user_id, role, content) VALUES (?, ?, ?)",
+        (user_id, role, content),
+    )
+    conn.commit()
+    conn.close()
+
+
+# ===== 計測 =====
+def seed(paths: list[Path], users: int, rows: int) -> None:
+    """ユーザーごとに rows 件の履歴を投入（複数パスなら main.shard_index で振り分け）"""
+    conns = [sqlite3.connect(path) for path in paths]
+    for u in range(users):
+        user_id = f"user-{u}"
+        conns[main.shard_index(user_id, len(conns))].executemany(
+            "INSERT INTO chat_history (user_id, role, content, timestamp) VALUES (?, ?, ?, datetime('now', ?))",
+            (
+                (user_id, "user" if i % 2 == 0 else "assistant", "あ" * 200, f"-{rows - i} seconds")
+                for i in range(rows)
+            ),
+        )
+    for conn in conns:
+        conn.commit()
+        conn.close()
+
+
+async def lag_monitor(samples: list[float], stop: asyncio.Event, interval: float = 0.001) -> None:
+    """interval ごとに起床し、予定より遅れた時間を記録する"""
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        start = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(loop.time() - start - interval)
+
+
+async def run_workload(get_history, save_to_history, users: int, rounds: int) -> dict[str, float]:
+    """全ユーザーが並行して「履歴取得 → 2件保存」を rounds 回繰り返す"""
+    samples: list[float] = []
+    stop = asyncio.Event()
+    monitor = asyncio.create_task(lag_monitor(samples, stop))
+
+    async def conversation(user_id: str) -> None:
+        for _ in range(rounds):
+            await get_history(user_id)
+            await save_to_history(user_id, "user", "質問")
+            await save_to_history(user_id, "assistant", "回答")
+
+    started = time.perf_counter()
+    await asyncio.gather(*(conversation(f"user-{u}") for u in range(users)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await monitor
+
+    samples.sort()
+    return {
+        "elapsed_s": elapsed,
+        "ops_per_s": users * rounds * 3 / elapsed,
+        "loop_lag_max_ms": samples[-1] * 1000 if samples else 0.0,
+        "loop_lag_p99_ms": samples[int(len(samples) * 0.99)] * 1000 if samples else 0.0,
+        "loop_lag_mean_ms": statistics.fmean(samples) * 1000 if samples else 0.0,
+        "ticks": len(samples),
+    }
+
+
+def report(name: str, result: dict[str, float]) -> None:
+    print(
+        f"{name:<8} elapsed={result['elapsed_s']:.2f}s ops/s={result['ops_per_s']:.0f} "
+        f"ticks={result['ticks']} lag max={result['loop_lag_max_ms']:.1f}ms "
+        f"p99={result['loop_lag_p99_ms']:.1f}ms mean={result['loop_lag_mean_ms']:.2f}ms"
+    )
+
+
+async def main_async(args: argparse.Namespace) -> None:
+    legacy_init_db()
+    main.init_storage()
+    seed([LEGACY_DB], args.users, args.rows)
+    seed(main.history_shards.paths, args.users, args.rows)
+
+    legacy = await run_workload(legacy_get_history, legacy_save_to_history, args.users, args.rounds)
+    report("before", legacy)
+
+    new = await run_workload(main.get_history, main.save_to_history, args.users, args.rounds)
+    report("after", new)
+    main.history_shards.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--rows", type=int, default=500)
+    parser.add_argument("--rounds", type=int, default=5)
+    asyncio.run(main_async(parser.parse_args()))
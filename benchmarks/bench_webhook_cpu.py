@@ -0,0 +1,151 @@
+"""
+Webhook 1イベントあたりのCPUオーバーヘッドのマイクロベンチマーク
+
+旧実装（bodyを2回 json.loads、プロンプト文字列をイベントごとに組み立て、
+送信ペイロードを標準jsonで毎回エンコード）と、
+現行実装（1回パース + 組み込み済みテンプレート + 高速JSON）を比較する。
+
+    python benchmarks/bench_webhook_cpu.py [--events 20] [--iterations 2000] [--image-kb 200]
+
+ネットワークやOpenAIは使わず、リクエスト経路のパース・組み立て・
+エンコードだけを計測する。
+"""
+
+import argparse
+import base64
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+TMP_DIR = Path(tempfile.mkdtemp(prefix="bench_webhook_"))
+os.environ["HISTORY_DB_PATH"] = str(TMP_DIR / "history.db")
+os.environ["CACHE_DB_PATH"] = str(TMP_DIR / "cache.db")
+
+import main  # noqa: E402
+
+
+# ===== 入力 =====
+def make_body(events: int) -> bytes:
+    """テキストと画像が半々のWebhookボディ"""
+    items = []
+    for i in range(events):
+        message = (
+            {"type": "text", "id": str(10000 + i), "text": "今日の天気について教えてください。" * 3}
+            if i % 2 == 0
+            else {"type": "image", "id": str(10000 + i), "contentProvider": {"type": "line"}}
+        )
+        items.append({
+            "type": "message",
+            "mode": "active",
+            "timestamp": 1700000000000 + i,
+            "source": {"type": "user", "userId": f"U{i:032x}"},
+            "webhookEventId": f"01H{i:023d}",
+            "deliveryContext": {"isRedelivery": False},
+            "replyToken": f"{i:032x}",
+            "message": message,
+        })
+    return json.dumps({"destination": "Uxxxxxxxx", "events": items}).encode()
+
+
+HISTORY = [
+    {"role": "user" if i % 2 == 0 else "assistant", "content": "これまでのやり取りです。" * 10} for i in range(20)
+]
+
+
+# ===== 旧実装（比較用） =====
+LEGACY_IMAGE_SUFFIX = main.IMAGE_SYSTEM_PROMPT[len(main.SYS_PROMPT):]
+
+
+def legacy_image_messages(image_data_url: str) -> list[dict]:
+    # 旧実装はイベントごとに SYS_PROMPT + 指示文 を連結していた
+    return [
+        {"role": "system", "content": main.SYS_PROMPT + LEGACY_IMAGE_SUFFIX},
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": main.IMAGE_REQUEST_TEXT},
+                {"type": "image_url", "image_url": {"url": image_data_url}},
+            ],
+        },
+    ]
+
+
+def legacy_path(body: bytes, image_data_url: str) -> int:
+    body_obj = json.loads(body.decode("utf-8"))
+    isinstance(body_obj.get("events"), list) and len(body_obj["events"]) == 0
+    body_obj = json.loads(body.decode("utf-8"))
+
+    sent = 0
+    for event in body_obj.get("events", []):
+        if event["message"]["type"] == "text":
+            messages = [{"role": "system", "content": main.SYS_PROMPT}, *HISTORY]
+            messages.append({"role": "user", "content": event["message"]["text"]})
+        else:
+            messages = legacy_image_messages(image_data_url)
+        # httpx の json= と同じく標準jsonでエンコード
+        sent += len(json.dumps({"model": "gpt-5", "messages": messages}).encode("utf-8"))
+        reply = {"replyToken": event["replyToken"], "messages": [{"type": "text", "text": "回答です。" * 50}]}
+        sent += len(json.dumps(reply).encode("utf-8"))
+    return sent
+
+
+# ===== 現行実装 =====
+def current_path(body: bytes, image_data_url: str) -> int:
+    body_obj = main.json_loads(body)
+    isinstance(body_obj, dict) and body_obj.get("events") == []
+
+    sent = 0
+    for event in body_obj.get("events", []):
+        if event["message"]["type"] == "text":
+            messages = main.build_context(HISTORY, event["message"]["text"])
+        else:
+            messages = [
+                main.IMAGE_SYSTEM_MESSAGE,
+                {
+                    "role": "user",
+                    "content": [main.IMAGE_REQUEST_PART, {"type": "image_url", "image_url": {"url": image_data_url}}],
+                },
+            ]
+        sent += len(main.encode_chat_payload("gpt-5", messages))
+        reply = {"replyToken": event["replyToken"], "messages": [{"type": "text", "text": "回答です。" * 50}]}
+        sent += len(main.json_dumps(reply))
+    return sent
+
+
+# ===== 計測 =====
+def measure(fn, body: bytes, image_data_url: str, iterations: int, events: int) -> dict[str, float]:
+    fn(body, image_data_url)  # ウォームアップ
+    started = time.perf_counter()
+    for _ in range(iterations):
+        fn(body, image_data_url)
+    elapsed = time.perf_counter() - started
+    return {"elapsed_s": elapsed, "us_per_event": elapsed / (iterations * events) * 1e6}
+
+
+def report(name: str, result: dict[str, float]) -> None:
+    print(f"{name:<8} elapsed={result['elapsed_s']:.2f}s per_event={result['us_per_event']:.1f}us")
+
+
+def main_cli(args: argparse.Namespace) -> None:
+    body = make_body(args.events)
+    image_data_url = "data:image/jpeg;base64," + base64.b64encode(os.urandom(args.image_kb * 1024)).decode()
+    print(f"json backend: {'orjson' if main.orjson is not None else 'stdlib'}")
+
+    report("before", measure(legacy_path, body, image_data_url, args.iterations, args.events))
+    report("after", measure(current_path, body, image_data_url, args.iterations, args.events))
+    main.history_shards.close()
+    main.cache_store.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--events", type=int, default=20)
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--image-kb", type=int, default=200)
+    main_cli(parser.parse_args())
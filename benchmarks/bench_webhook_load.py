@@ -0,0 +1,246 @@
+"""
+Webhookエンドポイントの負荷試験（ネットワーク不要）
+
+ローカルの代替サーバー（stub_servers.py）を LINE / OpenAI の代わりに立て、
+アプリを uvicorn で起動して、署名付きのWebhookバッチ（テキスト・画像・スタンプ・音声の混在）を
+並行に送り続ける。スループット、レイテンシ（p50/p95/p99）、アプリのピークRSSを出力する。
+
+    python benchmarks/bench_webhook_load.py [--requests 300] [--concurrency 20] [--mix text=6,image=2,sticker=1,audio=1]
+    python benchmarks/bench_webhook_load.py --mode queue --error-rate 0.05 --openai-latency-ms 1500
+    python benchmarks/bench_webhook_load.py --model-latency-ms gpt-5=2000,gpt-5-mini=600,gpt-5-nano=300
+
+認識しない引数はそのまま stub_servers.py に渡す（例: --dalle-latency-ms 500）。
+"""
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+
+import httpx
+
+ROOT = Path(__file__).resolve().parent.parent
+CHANNEL_SECRET = "bench-channel-secret"
+
+
+# ===== Webhookイベントの生成 =====
+def sign(body: bytes, secret: str = CHANNEL_SECRET) -> str:
+    """main.verify_signature と同じ方式の署名（HMAC-SHA256のbase64）"""
+    return base64.b64encode(hmac.new(secret.encode(), body, hashlib.sha256).digest()).decode()
+
+
+def parse_mix(spec: str) -> tuple[list[str], list[float]]:
+    kinds, weights = [], []
+    for item in spec.split(","):
+        kind, _, weight = item.partition("=")
+        kinds.append(kind.strip())
+        weights.append(float(weight or 1))
+    return kinds, weights
+
+
+class EventFactory:
+    """種類の割合に従ってWebhookイベントを作る（webhookEventIdは毎回ユニーク）"""
+
+    def __init__(self, mix: str, users: int, stickers: int):
+        self._kinds, self._weights = parse_mix(mix)
+        self._users = users
+        self._stickers = stickers
+        self._seq = 0
+
+    def message(self, kind: str, seq: int) -> dict:
+        if kind == "text":
+            return {"type": "text", "id": str(seq), "text": f"ベンチマークの質問です #{seq}"}
+        if kind == "image":
+            return {"type": "image", "id": f"image-{seq}", "contentProvider": {"type": "line"}}
+        if kind == "sticker":
+            sticker = random.randrange(self._stickers)
+            return {"type": "sticker", "id": str(seq), "packageId": "446", "stickerId": str(1988 + sticker)}
+        if kind == "audio":
+            return {"type": "audio", "id": f"audio-{seq}", "duration": 5000, "contentProvider": {"type": "line"}}
+        raise ValueError(f"unknown event kind: {kind}")
+
+    def event(self) -> tuple[str, dict]:
+        self._seq += 1
+        kind = random.choices(self._kinds, self._weights)[0]
+        return kind, {
+            "type": "message",
+            "mode": "active",
+            "timestamp": int(time.time() * 1000),
+            "source": {"type": "user", "userId": f"Ubench{random.randrange(self._users):05d}"},
+            "webhookEventId": f"bench-{os.getpid()}-{self._seq}",
+            "deliveryContext": {"isRedelivery": False},
+            "replyToken": f"reply-{self._seq}",
+            "message": self.message(kind, self._seq),
+        }
+
+    def batch(self, size: int) -> tuple[str, bytes]:
+        """イベントの種類（バッチ内の最初のもの）とリクエストボディ"""
+        kinds, events = zip(*(self.event() for _ in range(size)))
+        return kinds[0], json.dumps({"destination": "Ubench", "events": list(events)}).encode()
+
+
+# ===== プロセス管理 =====
+def peak_rss_mb(pid: int) -> float | None:
+    """プロセスのピークRSS（LinuxのVmHWM）。取得できなければNone"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+async def wait_ready(url: str, process: subprocess.Popen, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"process exited early: {process.args}")
+            try:
+                await client.get(url, timeout=1.0)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.1)
+    raise RuntimeError(f"timed out waiting for {url}")
+
+
+def start_processes(args: argparse.Namespace, stub_args: list[str], tmp: Path) -> tuple[subprocess.Popen, subprocess.Popen]:
+    stub_url = f"http://127.0.0.1:{args.stub_port}"
+    stub = subprocess.Popen(
+        [sys.executable, str(ROOT / "benchmarks" / "stub_servers.py"), "--port", str(args.stub_port), *stub_args],
+        cwd=ROOT,
+    )
+    env = {
+        **os.environ,
+        "LINE_CHANNEL_SECRET": CHANNEL_SECRET,
+        "LINE_CHANNEL_ACCESS_TOKEN": "bench-access-token",
+        "OPENAI_API_KEY": "bench-openai-key",
+        "OPENAI_BASE_URL": stub_url,
+        "LINE_API_BASE_URL": stub_url,
+        "LINE_DATA_BASE_URL": stub_url,
+        "HISTORY_DB_PATH": str(tmp / "history.db"),
+        "CACHE_DB_PATH": str(tmp / "cache.db"),
+        "WEBHOOK_MODE": args.mode,
+        "PUBLIC_BASE_URL": "",
+        "RENDER_EXTERNAL_URL": "",
+    }
+    app = subprocess.Popen(
+        [
+            sys.executable, "-m", "uvicorn", "main:app",
+            "--host", "127.0.0.1", "--port", str(args.app_port), "--log-level", "warning", "--no-access-log",
+        ],
+        cwd=ROOT,
+        env=env,
+        stdout=subprocess.DEVNULL if args.quiet else None,
+        stderr=subprocess.DEVNULL if args.quiet else None,
+    )
+    return stub, app
+
+
+# ===== 負荷生成 =====
+async def run_load(args: argparse.Namespace) -> dict:
+    factory = EventFactory(args.mix, args.users, args.stickers)
+    url = f"http://127.0.0.1:{args.app_port}/webhook"
+    latencies: dict[str, list[float]] = {}
+    statuses: Counter = Counter()
+    remaining = args.requests
+
+    async def worker(client: httpx.AsyncClient) -> None:
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            kind, body = factory.batch(args.batch_size)
+            started = time.perf_counter()
+            try:
+                res = await client.post(url, content=body, headers={"x-line-signature": sign(body)})
+                statuses[res.status_code] += 1
+            except httpx.HTTPError as e:
+                statuses[type(e).__name__] += 1
+                continue
+            latencies.setdefault(kind, []).append(time.perf_counter() - started)
+
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=args.timeout) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+    return {"elapsed": elapsed, "latencies": latencies, "statuses": statuses}
+
+
+def percentile(values: list[float], q: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * q))] * 1000
+
+
+def report(result: dict, args: argparse.Namespace, rss_mb: float | None) -> None:
+    all_latencies = sorted(v for values in result["latencies"].values() for v in values)
+    completed = len(all_latencies)
+    print(
+        f"mode={args.mode} requests={args.requests} batch_size={args.batch_size} "
+        f"concurrency={args.concurrency} mix={args.mix}"
+    )
+    print(
+        f"elapsed={result['elapsed']:.2f}s throughput={completed / result['elapsed']:.1f} req/s "
+        f"({completed * args.batch_size / result['elapsed']:.1f} events/s)"
+    )
+    print(f"status: {dict(result['statuses'])}")
+    rows = [("all", all_latencies)] + sorted((k, sorted(v)) for k, v in result["latencies"].items())
+    for kind, values in rows:
+        if values:
+            print(
+                f"  {kind:<8} n={len(values):<5} p50={percentile(values, 0.50):7.1f}ms "
+                f"p95={percentile(values, 0.95):7.1f}ms p99={percentile(values, 0.99):7.1f}ms "
+                f"mean={statistics.fmean(values) * 1000:7.1f}ms"
+            )
+    print(f"peak RSS: {rss_mb:.1f} MB" if rss_mb is not None else "peak RSS: n/a")
+
+
+async def main_async(args: argparse.Namespace, stub_args: list[str]) -> None:
+    tmp = Path(tempfile.mkdtemp(prefix="bench_load_"))
+    stub, app = start_processes(args, stub_args, tmp)
+    try:
+        await wait_ready(f"http://127.0.0.1:{args.stub_port}/stats", stub)
+        await wait_ready(f"http://127.0.0.1:{args.app_port}/", app)
+        result = await run_load(args)
+        if args.mode == "queue":
+            # キューに積んだイベントを処理し終えるまで待つ
+            async with httpx.AsyncClient() as client:
+                while (await client.get(f"http://127.0.0.1:{args.app_port}/health")).json()["event_queue"]["pending"]:
+                    await asyncio.sleep(0.2)
+        report(result, args, peak_rss_mb(app.pid))
+        async with httpx.AsyncClient() as client:
+            models = (await client.get(f"http://127.0.0.1:{args.stub_port}/stats")).json()["models"]
+        print(f"chat completions by model: {models}")
+    finally:
+        for process in (app, stub):
+            process.terminate()
+            process.wait(timeout=30)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=300, help="送信するWebhookリクエスト数")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=1, help="1リクエストに含めるイベント数")
+    parser.add_argument("--mix", default="text=6,image=2,sticker=1,audio=1")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--stickers", type=int, default=5, help="送るスタンプの種類数")
+    parser.add_argument("--mode", choices=("sync", "queue"), default="sync")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--app-port", type=int, default=18000)
+    parser.add_argument("--stub-port", type=int, default=18080)
+    parser.add_argument("--quiet", action="store_true", help="アプリのログを表示しない")
+    args, stub_args = parser.parse_known_args()
+    asyncio.run(main_async(args, stub_args))
@@ -0,0 +1,200 @@
+"""
+LINE / OpenAI API のローカル代替サーバー（ベンチマーク用）
+
+LINEの reply/push・コンテンツ取得と、OpenAIの Chat Completions（ストリーミング含む）・
+画像生成・音声文字起こしを1つのサーバーで模倣する。遅延とエラー率は引数で指定できる。
+
+    python benchmarks/stub_servers.py [--port 18080] [--openai-latency-ms 800] [--error-rate 0.02]
+
+main.py 側は OPENAI_BASE_URL / LINE_API_BASE_URL / LINE_DATA_BASE_URL をこのサーバーに向ける。
+"""
+
+import argparse
+import asyncio
+import base64
+import io
+import json
+import os
+import random
+import zlib
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow未導入ならランダムなバイト列を画像として返す
+    Image = None
+
+
+class StubConfig:
+    """遅延（ミリ秒、平均値の±50%でばらつかせる）とエラー注入の設定"""
+
+    def __init__(self, args: argparse.Namespace):
+        self.openai_latency = args.openai_latency_ms / 1000
+        self.model_latency = {
+            model.strip(): float(ms) / 1000
+            for model, _, ms in (item.partition("=") for item in args.model_latency_ms.split(",") if "=" in item)
+        }
+        self.dalle_latency = args.dalle_latency_ms / 1000
+        self.whisper_latency = args.whisper_latency_ms / 1000
+        self.line_latency = args.line_latency_ms / 1000
+        self.error_rate = args.error_rate
+        self.line_error_rate = args.line_error_rate
+        self.stream_chunks = args.stream_chunks
+        self.images = make_images(args.image_variants, args.image_size)
+        self.audio = os.urandom(args.audio_kb * 1024)
+
+
+def make_images(variants: int, size: int) -> list[bytes]:
+    """メッセージIDごとに出し分けるJPEG（同じIDには同じ画像を返す）"""
+    if Image is None:
+        return [os.urandom(size * size // 8) for _ in range(max(1, variants))]
+    images = []
+    for i in range(max(1, variants)):
+        image = Image.new("RGB", (size, size * 3 // 4), (i * 37 % 256, i * 91 % 256, i * 53 % 256))
+        buffer = io.BytesIO()
+        image.save(buffer, "JPEG", quality=90)
+        images.append(buffer.getvalue())
+    return images
+
+
+async def delay(mean: float) -> None:
+    if mean > 0:
+        await asyncio.sleep(random.uniform(mean * 0.5, mean * 1.5))
+
+
+def injected_error(rate: float) -> Response | None:
+    """rate の確率で 429（Retry-After付き）か 503 を返す"""
+    if random.random() >= rate:
+        return None
+    if random.random() < 0.5:
+        return JSONResponse(
+            {"error": {"message": "Rate limit reached (stub)", "type": "requests"}},
+            status_code=429,
+            headers={"retry-after-ms": "200"},
+        )
+    return JSONResponse({"error": {"message": "Service unavailable (stub)"}}, status_code=503)
+
+
+def create_app(config: StubConfig) -> FastAPI:
+    app = FastAPI()
+    stats = {"chat": 0, "images": 0, "audio": 0, "content": 0, "reply": 0, "push": 0, "errors": 0}
+    models: dict[str, int] = {}
+
+    def fail(rate: float) -> Response | None:
+        error = injected_error(rate)
+        if error is not None:
+            stats["errors"] += 1
+        return error
+
+    # ===== OpenAI =====
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        payload = json.loads(await request.body())
+        stats["chat"] += 1
+        if error := fail(config.error_rate):
+            return error
+        text = "これはベンチマーク用の応答です。" * 8
+        latency = config.model_latency.get(payload.get("model"), config.openai_latency)
+        models[payload.get("model")] = models.get(payload.get("model"), 0) + 1
+
+        if not payload.get("stream"):
+            await delay(latency)
+            return {"choices": [{"message": {"role": "assistant", "content": text}}]}
+
+        async def events():
+            step = max(1, len(text) // config.stream_chunks)
+            for i in range(0, len(text), step):
+                await delay(latency / config.stream_chunks)
+                chunk = {"choices": [{"delta": {"content": text[i:i + step]}}]}
+                yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode()
+            yield b"data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    @app.post("/v1/images/generations")
+    async def images_generations(request: Request):
+        payload = json.loads(await request.body())
+        stats["images"] += 1
+        if error := fail(config.error_rate):
+            return error
+        await delay(config.dalle_latency)
+        if payload.get("response_format") == "b64_json":
+            return {"data": [{"b64_json": base64.b64encode(config.images[0]).decode()}]}
+        return {"data": [{"url": str(request.base_url) + "files/generated.jpg"}]}
+
+    @app.post("/v1/audio/transcriptions")
+    async def audio_transcriptions(request: Request):
+        size = 0
+        async for chunk in request.stream():
+            size += len(chunk)
+        stats["audio"] += 1
+        if error := fail(config.error_rate):
+            return error
+        await delay(config.whisper_latency)
+        return {"text": f"ベンチマーク用の文字起こしです（{size} bytes）。"}
+
+    # ===== LINE =====
+    @app.get("/v2/bot/message/{message_id}/content")
+    async def message_content(message_id: str):
+        stats["content"] += 1
+        if error := fail(config.line_error_rate):
+            return error
+        await delay(config.line_latency)
+        if message_id.startswith("audio-"):
+            return Response(config.audio, media_type="audio/mp4")
+        image = config.images[zlib.crc32(message_id.encode()) % len(config.images)]
+        return Response(image, media_type="image/jpeg")
+
+    @app.post("/v2/bot/message/reply")
+    async def reply(request: Request):
+        await request.body()
+        stats["reply"] += 1
+        if error := fail(config.line_error_rate):
+            return error
+        await delay(config.line_latency)
+        return {}
+
+    @app.post("/v2/bot/message/push")
+    async def push(request: Request):
+        await request.body()
+        stats["push"] += 1
+        await delay(config.line_latency)
+        return {}
+
+    @app.get("/files/generated.jpg")
+    async def generated_image():
+        return Response(config.images[0], media_type="image/jpeg")
+
+    @app.get("/stats")
+    async def get_stats():
+        return {**stats, "models": models}
+
+    return app
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--openai-latency-ms", type=float, default=800)
+    parser.add_argument(
+        "--model-latency-ms", default="", help="モデルごとの応答時間（例: gpt-5=2000,gpt-5-mini=600）"
+    )
+    parser.add_argument("--dalle-latency-ms", type=float, default=3000)
+    parser.add_argument("--whisper-latency-ms", type=float, default=1000)
+    parser.add_argument("--line-latency-ms", type=float, default=30)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="OpenAIが429/503を返す確率")
+    parser.add_argument("--line-error-rate", type=float, default=0.0, help="LINEが429/503を返す確率")
+    parser.add_argument("--stream-chunks", type=int, default=8)
+    parser.add_argument("--image-variants", type=int, default=16)
+    parser.add_argument("--image-size", type=int, default=2000, help="コンテンツ画像の横幅（px）")
+    parser.add_argument("--audio-kb", type=int, default=200)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    uvicorn.run(create_app(StubConfig(args)), host=args.host, port=args.port, log_level="warning")
@@ -6,22 +6,45 @@ GitHub Actions + FastAPI + SQLite で動作
 """
 
 import os
+import asyncio
+import random
+import tempfile
 import hmac
 import hashlib
 import base64
+import io
 import json
+import queue
+import re
 import sqlite3
+import socket
+import sys
 import logging
-from typing import Any
+import logging.handlers
+import atexit
+import threading
+import time
+import unicodedata
+import zlib
+import heapq
+import contextvars
+import functools
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from typing import Any, AsyncIterator, Awaitable, Callable
 from pathlib import Path
 
 import httpx
 from fastapi import FastAPI, Request, HTTPException, Header
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 
-# ロギング設定
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
+# 量の多いログはカテゴリ（main. 配下のロガー）を分け、LOG_SAMPLING / LOG_RATE_LIMITS で間引けるようにする
+content_logger = logging.getLogger(f"{__name__}.line_content")
+event_logger = logging.getLogger(f"{__name__}.event")
 
 
 # ===== 環境変数 =====
@@ -31,542 +54,4332 @@ SYS_PROMPT = os.getenv("SYSTEM_PROMPT", "あなたはLINE上で丁寧に応答
 CHANNEL_SECRET = os.getenv("LINE_CHANNEL_SECRET", "")
 
 # SQLiteデータベースパス
-DB_PATH = Path(__file__).parent / "line_chat_history.db"
+DB_PATH = Path(os.getenv("HISTORY_DB_PATH", Path(__file__).parent / "line_chat_history.db"))
+CACHE_DB_PATH = Path(os.getenv("CACHE_DB_PATH", Path(__file__).parent / "line_cache.db"))
 
-# FastAPIアプリ
-app = FastAPI(title="Saku Chappy LINE Bot", version="1.0.0")
+# 履歴書き込みのグループコミット
+HISTORY_BATCH_SIZE = int(os.getenv("HISTORY_BATCH_SIZE", "64"))
+HISTORY_BATCH_WINDOW_MS = float(os.getenv("HISTORY_BATCH_WINDOW_MS", "10"))
+# full=コミット+fsyncを待つ / normal=コミットを待つ（WAL, fsyncはチェックポイント時）/ buffered=待たない
+HISTORY_DURABILITY = os.getenv("HISTORY_DURABILITY", "normal")
+# 履歴DBの分割数（user_idのハッシュで振り分け。変更時は tools/reshard_history.py で移行する）
+HISTORY_SHARDS = max(1, int(os.getenv("HISTORY_SHARDS", "1")))
+
+# 会話履歴キャッシュ（0で無効）。他のプロセスの書き込みやリセットは反映されないので、
+# 複数プロセスで動かす構成（WEB_CONCURRENCY>1、または分割した履歴DB）では既定で無効にする
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+MULTI_PROCESS = WEB_CONCURRENCY > 1 or HISTORY_SHARDS > 1
+HISTORY_CACHE_MAX_USERS = int(os.getenv("HISTORY_CACHE_MAX_USERS", "0" if MULTI_PROCESS else "1000"))
+HISTORY_CACHE_MAX_BYTES = int(os.getenv("HISTORY_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+
+# 履歴の保持期間（古い行はアーカイブテーブルに移して本体から削除）
+HISTORY_RETENTION_INTERVAL = float(os.getenv("HISTORY_RETENTION_INTERVAL", "3600"))  # 0で無効
+HISTORY_RETENTION_KEEP = int(os.getenv("HISTORY_RETENTION_KEEP", "200"))  # ユーザーごとに残す件数
+HISTORY_RETENTION_DAYS = float(os.getenv("HISTORY_RETENTION_DAYS", "90"))  # これより古い行を移す
+HISTORY_RETENTION_BATCH = int(os.getenv("HISTORY_RETENTION_BATCH", "500"))
+HISTORY_ARCHIVE = os.getenv("HISTORY_ARCHIVE", "1") != "0"  # 0ならアーカイブせず削除のみ
+HISTORY_VACUUM_PAGES = int(os.getenv("HISTORY_VACUUM_PAGES", "1000"))
+
+# プロンプトのトークン予算と会話の要約
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+SUMMARY_MIN_ROWS = int(os.getenv("SUMMARY_MIN_ROWS", "10"))  # 窓から外れた行がこの件数に達したら要約（0で無効）
+SUMMARY_MAX_CHARS = int(os.getenv("SUMMARY_MAX_CHARS", "800"))
+
+# ストリーミング応答と返信期限
+OPENAI_STREAMING = os.getenv("OPENAI_STREAMING", "1") != "0"
+REPLY_DEADLINE_SECONDS = float(os.getenv("REPLY_DEADLINE_SECONDS", "45"))  # 受信からこの秒数を過ぎたらreply tokenを諦める
+PUSH_FALLBACK = os.getenv("PUSH_FALLBACK", "1") != "0"
+
+# 画像の取り込み（ダウンロード上限とVisionモデル向けの縮小）
+IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", str(20 * 1024 * 1024)))
+VISION_MAX_LONG_SIDE = int(os.getenv("VISION_MAX_LONG_SIDE", "2048"))
+VISION_MAX_SHORT_SIDE = int(os.getenv("VISION_MAX_SHORT_SIDE", "768"))
+VISION_JPEG_QUALITY = int(os.getenv("VISION_JPEG_QUALITY", "85"))
+IMAGE_DECODE_MEMORY_MB = int(os.getenv("IMAGE_DECODE_MEMORY_MB", "256"))
+IMAGE_DECODE_CONCURRENCY = int(os.getenv("IMAGE_DECODE_CONCURRENCY", "2"))
+
+# 画像解析結果のキャッシュ（同じ画像・同じプロンプトならOpenAIを呼ばない）
+IMAGE_CACHE_TTL_DAYS = float(os.getenv("IMAGE_CACHE_TTL_DAYS", "30"))
+IMAGE_CACHE_MAX_MB = float(os.getenv("IMAGE_CACHE_MAX_MB", "100"))  # 0で無効
+
+# 履歴に依存しない発言（履歴なし・リセット直後）への回答キャッシュ
+ANSWER_CACHE_TTL_HOURS = float(os.getenv("ANSWER_CACHE_TTL_HOURS", "24"))
+ANSWER_CACHE_MAX_MB = float(os.getenv("ANSWER_CACHE_MAX_MB", "20"))  # 0で無効
+ANSWER_CACHE_MAX_CHARS = int(os.getenv("ANSWER_CACHE_MAX_CHARS", "200"))  # これより長い発言はキャッシュしない
+
+# スタンプ応答キャッシュ（生成画像を自前で配信するには公開URLが必要）
+PUBLIC_BASE_URL = (os.getenv("PUBLIC_BASE_URL") or os.getenv("RENDER_EXTERNAL_URL", "")).rstrip("/")
+STICKER_CACHE_VARIANTS = int(os.getenv("STICKER_CACHE_VARIANTS", "2"))
+STICKER_CACHE_TTL_DAYS = float(os.getenv("STICKER_CACHE_TTL_DAYS", "30"))
+STICKER_CACHE_MAX_MB = float(os.getenv("STICKER_CACHE_MAX_MB", "200"))  # 0で画像のキャッシュを無効
+STICKER_PREVIEW_SIZE = 240
+STICKER_PREWARM_TOP = int(os.getenv("STICKER_PREWARM_TOP", "0"))  # 人気上位N件を事前生成（0で無効）
+STICKER_PREWARM_INTERVAL = float(os.getenv("STICKER_PREWARM_INTERVAL", "3600"))
+
+# 音声（Whisperの上限は25MB）と文字起こしのキャッシュ
+AUDIO_MAX_BYTES = int(os.getenv("AUDIO_MAX_BYTES", str(25 * 1024 * 1024)))
+AUDIO_SPOOL_MEMORY = int(os.getenv("AUDIO_SPOOL_MEMORY", str(1024 * 1024)))  # これを超えたら一時ファイルへ
+TRANSCRIPTION_CACHE_TTL_DAYS = float(os.getenv("TRANSCRIPTION_CACHE_TTL_DAYS", "30"))
+TRANSCRIPTION_CACHE_MAX_MB = float(os.getenv("TRANSCRIPTION_CACHE_MAX_MB", "20"))  # 0で無効
+
+# Webhook処理モード: "sync"=処理完了後に応答 / "queue"=キューに積んで即座に応答
+WEBHOOK_MODE = os.getenv("WEBHOOK_MODE", "sync")
+EVENT_WORKERS = int(os.getenv("EVENT_WORKERS", "4"))
+EVENT_QUEUE_SIZE = int(os.getenv("EVENT_QUEUE_SIZE", "100"))
+EVENT_ENQUEUE_TIMEOUT = float(os.getenv("EVENT_ENQUEUE_TIMEOUT", "2"))
+EVENT_DRAIN_TIMEOUT = float(os.getenv("EVENT_DRAIN_TIMEOUT", "25"))
+
+# 同じユーザーが続けて送ったテキストをまとめて1回の応答にする（0で無効）
+MESSAGE_COALESCE_WINDOW_MS = float(os.getenv("MESSAGE_COALESCE_WINDOW_MS", "0"))  # 次の発言を待つ時間
+MESSAGE_COALESCE_MAX_WAIT_MS = float(os.getenv("MESSAGE_COALESCE_MAX_WAIT_MS", "5000"))  # 最初の発言からの上限
+MESSAGE_COALESCE_MAX_MESSAGES = int(os.getenv("MESSAGE_COALESCE_MAX_MESSAGES", "10"))
+
+# 再送イベントの重複排除（webhookEventIdで判定）
+EVENT_DEDUP_TTL = float(os.getenv("EVENT_DEDUP_TTL", "86400"))  # 秒（0で無効）
+EVENT_DEDUP_MEMORY = int(os.getenv("EVENT_DEDUP_MEMORY", "10000"))  # メモリに保持する件数
+EVENT_DEDUP_MAX_MB = float(os.getenv("EVENT_DEDUP_MAX_MB", "5"))
+
+# モデルの振り分け（タスクごとの階層。入力が大きければ1段上げ、p95が予算を超えたら速い階層に落とす）
+MODEL_TIERS = os.getenv("MODEL_TIERS", "small=gpt-5-nano,medium=gpt-5-mini,large=gpt-5")
+MODEL_ROUTES = os.getenv(
+    "MODEL_ROUTES", "chat=medium,vision=large,sticker_prompt=small,transcript_summary=small,history_summary=small"
+)
+MODEL_UPGRADE_TOKENS = int(os.getenv("MODEL_UPGRADE_TOKENS", "1500"))  # 入力がこれを超えたら1段上の階層（0で無効）
+MODEL_LATENCY_BUDGETS = os.getenv(
+    "MODEL_LATENCY_BUDGETS", "chat=20,vision=30,sticker_prompt=20,transcript_summary=20,history_summary=60"
+)  # タスクごとのp95の上限秒数
+MODEL_LATENCY_WINDOW = float(os.getenv("MODEL_LATENCY_WINDOW", "300"))  # p95を計算する直近の秒数
+MODEL_LATENCY_MIN_SAMPLES = int(os.getenv("MODEL_LATENCY_MIN_SAMPLES", "20"))  # これ未満なら振り分けに使わない
+
+# 起動時のウォームアップ（上流ホストの名前解決・接続、SQLite接続、画像ライブラリの初期化）
+STARTUP_WARMUP = os.getenv("STARTUP_WARMUP", "1") != "0"
+STARTUP_WARMUP_TIMEOUT = float(os.getenv("STARTUP_WARMUP_TIMEOUT", "5"))  # ホストごとの上限秒数
+
+# ログ（出力は別スレッドで行う。カテゴリは main. を除いたロガー名、例: event, line_content, httpx）
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")  # text / json
+LOG_SAMPLING = os.getenv("LOG_SAMPLING", "")  # カテゴリ=出力する割合（WARNING未満のみ） 例: event=0.1
+LOG_RATE_LIMITS = os.getenv("LOG_RATE_LIMITS", "httpx=10,line_content=20,event=50")  # カテゴリ=1秒あたりの上限
+
+# HTTP/2（h2パッケージが無い環境ではHTTP/1.1にフォールバック）
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "1") != "0"
+
+# OpenAIのレート制限（モデル=リクエスト/分:トークン/分、0は無制限）と再試行
+OPENAI_RATE_LIMITS = os.getenv(
+    "OPENAI_RATE_LIMITS",
+    "gpt-5=500:500000,gpt-5-mini=500:500000,gpt-5-nano=500:200000,dall-e-3=5:0,whisper-1=50:0",
+)
+OPENAI_CONCURRENCY_MIN = int(os.getenv("OPENAI_CONCURRENCY_MIN", "2"))
+OPENAI_CONCURRENCY_MAX = int(os.getenv("OPENAI_CONCURRENCY_MAX", "16"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "3"))
+OPENAI_RETRY_BASE = float(os.getenv("OPENAI_RETRY_BASE", "0.5"))
+OPENAI_RETRY_MAX = float(os.getenv("OPENAI_RETRY_MAX", "20"))
+# 画像生成は応答まで時間がかかるので、読み取りのタイムアウトだけ OPENAI_TIMEOUT より長くする
+DALLE_READ_TIMEOUT = float(os.getenv("DALLE_READ_TIMEOUT", "120"))
+
+
+# ===== ロギング =====
+REDACTED = "[REDACTED]"
+# LogRecord が標準で持つ属性（JSON出力ではこれ以外を extra のフィールドとして出す）
+_LOG_RECORD_ATTRS = frozenset(logging.makeLogRecord({}).__dict__) | {"message", "asctime"}
+
+
+def parse_log_settings(spec: str) -> dict[str, float]:
+    """"カテゴリ=数値,..." 形式の設定を読む"""
+    settings: dict[str, float] = {}
+    for item in spec.split(","):
+        name, _, value = item.partition("=")
+        if name.strip() and value.strip():
+            settings[name.strip()] = float(value)
+    return settings
+
+
+class LogSampler(logging.Filter):
+    """WARNING未満のレコードをカテゴリごとに間引く（割合でサンプリングし、1秒あたりの件数で制限）
+
+    キューに積む前に判定するので、捨てたレコードは整形もされない。
+    """
+
+    def __init__(self, sample_rates: dict[str, float], rate_limits: dict[str, float]):
+        super().__init__()
+        self._sample_rates = sample_rates
+        self._rate_limits = rate_limits
+        self._allowance = dict(rate_limits)
+        self._updated: dict[str, float] = {}
+        self._lock = threading.Lock()
+        self.dropped: dict[str, int] = {}
+
+    @staticmethod
+    def category(name: str) -> str:
+        prefix = f"{__name__}."
+        return name[len(prefix):] if name.startswith(prefix) else name
+
+    def _drop(self, category: str) -> bool:
+        with self._lock:
+            self.dropped[category] = self.dropped.get(category, 0) + 1
+        return False
+
+    def _within_rate(self, category: str, limit: float) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            elapsed = now - self._updated.get(category, now)
+            allowance = min(limit, self._allowance[category] + elapsed * limit)
+            self._updated[category] = now
+            if allowance < 1:
+                self._allowance[category] = allowance
+                return False
+            self._allowance[category] = allowance - 1
+            return True
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        category = self.category(record.name)
+        rate = self._sample_rates.get(category)
+        if rate is not None and random.random() >= rate:
+            return self._drop(category)
+        limit = self._rate_limits.get(category)
+        if limit is not None and not self._within_rate(category, limit):
+            return self._drop(category)
+        return True
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            dropped = dict(self.dropped)
+        return {"sample_rates": self._sample_rates, "rate_limits": self._rate_limits, "dropped": dropped}
+
+
+class RedactingFormatter(logging.Formatter):
+    """出力直前にトークン・APIキーを伏せるフォーマッター（json=True なら1レコード1行のJSON）"""
+
+    _PATTERN = re.compile(r"(Bearer\s+)[^\s\"',}]+|\b(sk-)[A-Za-z0-9_-]{8,}")
+
+    def __init__(self, secrets: list[str], json_output: bool = False):
+        super().__init__(logging.BASIC_FORMAT)
+        self._json = json_output
+        values = sorted({secret for secret in secrets if len(secret) >= 8}, key=len, reverse=True)
+        self._secrets = re.compile("|".join(map(re.escape, values))) if values else None
+
+    def redact(self, text: str) -> str:
+        if self._secrets is not None:
+            text = self._secrets.sub(REDACTED, text)
+        return self._PATTERN.sub(lambda m: (m.group(1) or m.group(2)) + REDACTED, text)
+
+    def format(self, record: logging.LogRecord) -> str:
+        if not self._json:
+            return self.redact(super().format(record))
+        payload: dict[str, Any] = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        payload.update((key, value) for key, value in record.__dict__.items() if key not in _LOG_RECORD_ATTRS)
+        if record.exc_info:
+            payload["exc_info"] = self.formatException(record.exc_info)
+        if record.stack_info:
+            payload["stack_info"] = self.formatStack(record.stack_info)
+        return self.redact(json.dumps(payload, ensure_ascii=False, default=str))
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """レコードを整形せずにキューへ積むハンドラ（% の展開と例外の整形はリスナースレッドで行う）
+
+    引数は参照のまま渡るので、ログ出力後に変更されるオブジェクトは引数に渡さない。
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class LazyJSON:
+    """出力されるときに初めてJSONに変換するログ引数"""
+
+    __slots__ = ("obj",)
+
+    def __init__(self, obj: Any):
+        self.obj = obj
+
+    def __str__(self) -> str:
+        return json_dumps(self.obj).decode()
+
+
+def configure_logging() -> tuple[LogSampler, queue.SimpleQueue]:
+    """ルートロガーの出力をキュー経由にし、イベントループのスレッドで書き込みを待たないようにする
+
+    すでにハンドラが設定されている場合（テストランナーなど）は basicConfig と同じく何もしない。
+    """
+    sampler = LogSampler(parse_log_settings(LOG_SAMPLING), parse_log_settings(LOG_RATE_LIMITS))
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    root = logging.getLogger()
+    if root.handlers:
+        return sampler, log_queue
+    output = logging.StreamHandler()
+    output.setFormatter(RedactingFormatter([ACCESS_TOKEN, OPENAI_KEY, CHANNEL_SECRET], LOG_FORMAT == "json"))
+    handler = DeferredQueueHandler(log_queue)
+    handler.addFilter(sampler)
+    root.addHandler(handler)
+    root.setLevel(LOG_LEVEL)
+    listener = logging.handlers.QueueListener(log_queue, output)
+    listener.start()
+    atexit.register(listener.stop)
+    return sampler, log_queue
+
+
+log_sampler, log_queue = configure_logging()
+
+
+# ===== JSON =====
+try:
+    import orjson
+except ImportError:  # orjson未導入なら標準のjsonを使う
+    orjson = None
+
+
+def json_loads(data: bytes | str) -> Any:
+    """JSONをデコード（orjsonがあれば使う）"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_dumps(obj: Any) -> bytes:
+    """JSONをUTF-8のバイト列にエンコード（orjsonがあれば使う）"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+class PrebuiltMessage(dict):
+    """起動時にシリアライズ済みの変更不可なチャットメッセージ
+
+    長いシステムプロンプトをリクエストごとにエンコードし直さないよう、
+    encode_chat_payload() はこのバイト列をそのまま埋め込む。
+    """
+
+    __slots__ = ("encoded",)
+
+    def __init__(self, role: str, content: str):
+        super().__init__(role=role, content=content)
+        self.encoded = json_dumps(dict(self))
+
+    def _immutable(self, *args: Any, **kwargs: Any) -> None:
+        raise TypeError("PrebuiltMessage is immutable")
+
+    __setitem__ = __delitem__ = update = pop = popitem = clear = setdefault = _immutable
+
+
+def encode_chat_payload(model: str, messages: list[dict[str, Any]], **options: Any) -> bytes:
+    """Chat Completions のリクエストボディを組み立てる（組み込み済みメッセージは再エンコードしない）"""
+    encoded = [m.encoded if isinstance(m, PrebuiltMessage) else json_dumps(m) for m in messages]
+    head = json_dumps({"model": model, **options})
+    return head[:-1] + b',"messages":[' + b",".join(encoded) + b"]}"
+
+
+# 毎回作り直さないヘッダー
+OPENAI_JSON_HEADERS = {"Authorization": f"Bearer {OPENAI_KEY}", "Content-Type": "application/json"}
+LINE_JSON_HEADERS = {"Authorization": f"Bearer {ACCESS_TOKEN}", "Content-Type": "application/json"}
+
+
+# ===== メトリクス =====
+# prometheus_client に依存せず、Prometheusのテキスト形式（0.0.4）で出力する
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Metric:
+    """ラベル付きメトリクスの共通部分"""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        METRICS.append(self)
+
+    def _key(self, labels: dict[str, str]) -> tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        return "\n".join(lines + self.samples())
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def samples(self) -> list[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {value}" for key, value in self._values.items()]
+
+
+class Gauge(Metric):
+    """出力時に関数を呼んで値を得るゲージ（関数は {ラベル値のタプル: 値} を返す）"""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._function: Callable[[], dict[tuple[str, ...], float]] = dict
+
+    def set_function(self, function: Callable[[], dict[tuple[str, ...], float]]) -> None:
+        self._function = function
+
+    def samples(self) -> list[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {value}" for key, value in self._function().items()
+        ]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self._buckets = buckets
+        # ラベルごとに [各バケットの件数..., 合計, 件数]
+        self._values: dict[tuple[str, ...], list[float]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        counts = self._values.get(key)
+        if counts is None:
+            counts = self._values[key] = [0.0] * (len(self._buckets) + 2)
+        for i, bound in enumerate(self._buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        counts[-2] += value
+        counts[-1] += 1
+
+    def samples(self) -> list[str]:
+        lines = []
+        for key, counts in self._values.items():
+            cumulative = 0.0
+            for bound, count in zip(self._buckets, counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {counts[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {counts[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {counts[-1]}")
+        return lines
+
+
+METRICS: list[Metric] = []
+
+# 処理中のイベントのメッセージ種別（各段階のメトリクスのラベルに使う）
+current_msg_type: contextvars.ContextVar[str] = contextvars.ContextVar("current_msg_type", default="")
+
+stage_seconds = Histogram(
+    "saku_stage_duration_seconds",
+    "Latency of each request stage",
+    ("stage", "msg_type", "model"),
+)
+stage_errors = Counter("saku_errors_total", "Errors by stage", ("stage", "msg_type", "model"))
+stage_retries = Counter("saku_retries_total", "Retried upstream calls by stage", ("stage", "model", "reason"))
+db_write_seconds = Histogram("saku_db_write_duration_seconds", "SQLite write latency including queueing", ("store",))
+upstream_in_flight = Gauge("saku_upstream_in_flight", "Upstream HTTP requests currently in flight", ("host",))
+event_queue_depth = Gauge("saku_event_queue_depth", "Events waiting in or being processed by the event queue")
+openai_concurrency = Gauge("saku_openai_concurrency", "OpenAI scheduler concurrency", ("state",))
+answer_cache_lookups = Counter(
+    "saku_answer_cache_lookups_total", "Answer cache lookups for history-independent prompts", ("result",)
+)
+model_routes = Counter("saku_model_routes_total", "Model selections by task", ("task", "model", "reason"))
+coalesced_messages = Counter(
+    "saku_coalesced_messages_total", "Text messages answered together with a later message from the same user"
+)
+startup_seconds = Gauge("saku_startup_phase_seconds", "Time spent in each startup phase", ("phase",))
+
+
+@contextmanager
+def stage_timer(stage: str, model: str = ""):
+    """with ブロックの所要時間を段階別ヒストグラムに記録し、例外はエラーとして数える"""
+    msg_type = current_msg_type.get()
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        stage_errors.inc(stage=stage, msg_type=msg_type, model=model)
+        raise
+    finally:
+        stage_seconds.observe(time.perf_counter() - started, stage=stage, msg_type=msg_type, model=model)
+
+
+def render_metrics() -> str:
+    return "\n".join(metric.render() for metric in METRICS) + "\n"
+
+
+# ===== 上流HTTPクライアント =====
+@dataclass(frozen=True)
+class UpstreamConfig:
+    """上流ホストごとの接続設定"""
+    base_url: str
+    timeout: float
+    max_connections: int
+    max_keepalive_connections: int
+    keepalive_expiry: float = 60.0
+
+
+UPSTREAMS: dict[str, UpstreamConfig] = {
+    "openai": UpstreamConfig(
+        base_url=os.getenv("OPENAI_BASE_URL", "https://api.openai.com"),
+        timeout=float(os.getenv("OPENAI_TIMEOUT", "60")),
+        max_connections=int(os.getenv("OPENAI_MAX_CONNECTIONS", "20")),
+        max_keepalive_connections=int(os.getenv("OPENAI_MAX_KEEPALIVE", "10")),
+    ),
+    "line": UpstreamConfig(
+        base_url=os.getenv("LINE_API_BASE_URL", "https://api.line.me"),
+        timeout=float(os.getenv("LINE_TIMEOUT", "10")),
+        max_connections=int(os.getenv("LINE_MAX_CONNECTIONS", "10")),
+        max_keepalive_connections=int(os.getenv("LINE_MAX_KEEPALIVE", "5")),
+    ),
+    "line_data": UpstreamConfig(
+        base_url=os.getenv("LINE_DATA_BASE_URL", "https://api-data.line.me"),
+        timeout=float(os.getenv("LINE_DATA_TIMEOUT", "30")),
+        max_connections=int(os.getenv("LINE_DATA_MAX_CONNECTIONS", "10")),
+        max_keepalive_connections=int(os.getenv("LINE_DATA_MAX_KEEPALIVE", "5")),
+    ),
+}
+
+
+def _http2_available() -> bool:
+    """h2パッケージが使えるか確認"""
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class _TrackedStream(httpx.AsyncByteStream):
+    """本文を閉じたときに1回だけ on_close を呼ぶレスポンス本文"""
+
+    def __init__(self, stream: httpx.AsyncByteStream, on_close: Callable[[], None]):
+        self._stream = stream
+        self._on_close: Callable[[], None] | None = on_close
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self) -> None:
+        try:
+            await self._stream.aclose()
+        finally:
+            if self._on_close is not None:
+                self._on_close()
+                self._on_close = None
+
+
+class InFlightTransport(httpx.AsyncBaseTransport):
+    """送信開始から本文を閉じるまでを実行中のリクエストとして数えるトランスポート"""
+
+    def __init__(self, transport: httpx.AsyncBaseTransport):
+        self.transport = transport
+        self.in_flight = 0
+
+    def _done(self) -> None:
+        self.in_flight -= 1
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self.in_flight += 1
+        try:
+            response = await self.transport.handle_async_request(request)
+        except BaseException:
+            self._done()
+            raise
+        return httpx.Response(
+            status_code=response.status_code,
+            headers=response.headers,
+            stream=_TrackedStream(response.stream, self._done),
+            extensions=response.extensions,
+        )
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
+
+
+class UpstreamClients:
+    """上流ホストごとに1つの httpx.AsyncClient を保持する（lifespanで生成・破棄）"""
+
+    def __init__(self, configs: dict[str, UpstreamConfig]):
+        self._configs = configs
+        self._clients: dict[str, httpx.AsyncClient] = {}
+        self._transports: dict[str, InFlightTransport] = {}
+        self._request_counts: dict[str, int] = {name: 0 for name in configs}
+        self._http2 = HTTP2_ENABLED and _http2_available()
+        self._ssl_context = None  # 証明書ストアの読み込みが重いので全ホストで1つを共有する
+
+    def _create(self, name: str) -> httpx.AsyncClient:
+        config = self._configs[name]
+
+        async def count_request(request: httpx.Request) -> None:
+            self._request_counts[name] += 1
+
+        if self._ssl_context is None:
+            self._ssl_context = httpx.create_ssl_context(http2=self._http2)
+        transport = self._transports[name] = InFlightTransport(
+            httpx.AsyncHTTPTransport(
+                verify=self._ssl_context,
+                http2=self._http2,
+                limits=httpx.Limits(
+                    max_connections=config.max_connections,
+                    max_keepalive_connections=config.max_keepalive_connections,
+                    keepalive_expiry=config.keepalive_expiry,
+                ),
+            )
+        )
+        return httpx.AsyncClient(
+            base_url=config.base_url,
+            transport=transport,
+            timeout=httpx.Timeout(config.timeout, connect=min(config.timeout, 10.0)),
+            event_hooks={"request": [count_request]},
+        )
+
+    def in_flight(self) -> dict[tuple[str, ...], float]:
+        """ホストごとの実行中リクエスト数（メトリクス用）"""
+        return {(name,): transport.in_flight for name, transport in self._transports.items()}
+
+    async def start(self) -> None:
+        """全ホストのクライアントを生成"""
+        if HTTP2_ENABLED and not self._http2:
+            logger.warning("h2パッケージが無いためHTTP/1.1で接続します")
+        for name in self._configs:
+            self.get(name)
+
+    async def _warm_up_host(self, name: str, timeout: float) -> dict[str, Any]:
+        url = httpx.URL(self._configs[name].base_url)
+        port = url.port or (443 if url.scheme == "https" else 80)
+        timings: dict[str, Any] = {}
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(loop.getaddrinfo(url.host, port, type=socket.SOCK_STREAM), timeout)
+            timings["dns_ms"] = round((time.perf_counter() - started) * 1000, 1)
+            # 応答の中身は使わない。TCP・TLS（・HTTP/2）の確立済み接続をプールに残すためのリクエスト
+            started = time.perf_counter()
+            await self.get(name).head("/", timeout=timeout)
+            timings["connect_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        except (OSError, asyncio.TimeoutError, httpx.HTTPError) as e:
+            logger.warning("上流ホストへの事前接続に失敗しました（%s）: %s: %s", name, type(e).__name__, e)
+            timings["error"] = type(e).__name__
+        return timings
+
+    async def warm_up(self, timeout: float) -> dict[str, dict[str, Any]]:
+        """全ホストの名前解決と接続を並行して済ませ、ホストごとの所要時間を返す"""
+        results = await asyncio.gather(*(self._warm_up_host(name, timeout) for name in self._configs))
+        return dict(zip(self._configs, results))
+
+    def timeout(self, name: str, read: float) -> httpx.Timeout:
+        """ホストの設定済みタイムアウトのうち、読み取りだけを read 秒以上に延ばしたもの"""
+        base = self.get(name).timeout
+        return httpx.Timeout(
+            connect=base.connect, read=max(read, base.read or 0.0), write=base.write, pool=base.pool
+        )
+
+    def get(self, name: str) -> httpx.AsyncClient:
+        """ホスト名に対応するクライアントを取得（未生成なら生成）"""
+        client = self._clients.get(name)
+        if client is None or client.is_closed:
+            client = self._clients[name] = self._create(name)
+        return client
+
+    async def aclose(self) -> None:
+        """全クライアントを閉じる"""
+        clients, self._clients = self._clients, {}
+        for client in clients.values():
+            await client.aclose()
+
+    def stats(self) -> dict[str, Any]:
+        """ホストごとのコネクションプール統計"""
+        result: dict[str, Any] = {}
+        for name, config in self._configs.items():
+            entry: dict[str, Any] = {
+                "base_url": config.base_url,
+                "http2": self._http2,
+                "requests": self._request_counts[name],
+                "max_connections": config.max_connections,
+                "connections": 0,
+                "idle": 0,
+                "http2_connections": 0,
+            }
+            transport = self._transports.get(name)
+            entry["in_flight"] = transport.in_flight if transport else 0
+            # httpx はプール統計を公開していないので内部の httpcore プールを参照する
+            pool = getattr(getattr(transport, "transport", None), "_pool", None)
+            for conn in getattr(pool, "connections", []):
+                entry["connections"] += 1
+                if conn.is_idle():
+                    entry["idle"] += 1
+                if "HTTP/2" in conn.info():
+                    entry["http2_connections"] += 1
+            result[name] = entry
+        return result
+
+
+upstream = UpstreamClients(UPSTREAMS)
+upstream_in_flight.set_function(upstream.in_flight)
+
+
+# ===== OpenAIリクエストスケジューラ =====
+# 優先度（小さいほど先に送る）
+PRIORITY_INTERACTIVE = 0  # ユーザーが返信を待っているテキスト・画像解析
+PRIORITY_BACKGROUND = 1  # 会話の要約など
+PRIORITY_IMAGE_GENERATION = 2  # DALL-E（遅く、待たせても体感への影響が小さい）
+
+VISION_IMAGE_TOKENS = 765  # 1024px程度の画像1枚あたりの入力トークン
+COMPLETION_TOKENS_ESTIMATE = 512  # 出力トークンの見込み（レート制限の予約用）
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+def parse_rate_limits(spec: str) -> dict[str, tuple[float, float]]:
+    """ "model=rpm:tpm,..." をモデルごとの (リクエスト/分, トークン/分) にする"""
+    limits: dict[str, tuple[float, float]] = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        model, _, values = item.partition("=")
+        rpm, _, tpm = values.partition(":")
+        limits[model.strip()] = (float(rpm or 0), float(tpm or 0))
+    return limits
+
+
+def estimate_request_tokens(messages: list[dict[str, Any]]) -> int:
+    """Chat Completions 1回分のトークン数の見込み（入力 + 出力の見込み）"""
+    total = COMPLETION_TOKENS_ESTIMATE
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, str):
+            total += estimate_tokens(content) + 4
+            continue
+        for part in content:
+            if part.get("type") == "image_url":
+                total += VISION_IMAGE_TOKENS
+            else:
+                total += estimate_tokens(part.get("text", "")) + 4
+    return total
+
+
+class TokenBucket:
+    """1分あたりの量で補充されるトークンバケット（per_minute <= 0 なら無制限）
+
+    reserve() は先に量を差し引き（足りなければ借りる）、使えるまでの待ち時間を返す。
+    先着順に予約されるので、後から来た大きな要求が前の要求を追い越すことはない。
+    """
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self._rate = per_minute / 60.0
+        self._level = per_minute
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self._level = min(self.capacity, self._level + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def reserve(self, amount: float) -> float:
+        if self.capacity <= 0:
+            return 0.0
+        now = time.monotonic()
+        self._refill(now)
+        self._level -= min(amount, self.capacity)
+        return max(0.0, -self._level / self._rate)
+
+    def clamp(self, remaining: float) -> None:
+        """サーバーが返した残量の方が少なければそれに合わせる"""
+        if self.capacity <= 0:
+            return
+        self._refill(time.monotonic())
+        self._level = min(self._level, remaining)
+
+    @property
+    def level(self) -> float:
+        if self.capacity <= 0:
+            return 0.0
+        self._refill(time.monotonic())
+        return self._level
+
+
+class AdaptiveConcurrency:
+    """優先度付きの同時実行数制限（AIMD: 成功で少しずつ増やし、過負荷で半分に減らす）"""
+
+    def __init__(self, minimum: int, maximum: int, decrease_interval: float = 1.0):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = float(self.maximum)
+        self.in_flight = 0
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._seq = 0
+        self._decrease_interval = decrease_interval
+        self._last_decrease = 0.0
+
+    async def acquire(self, priority: int) -> None:
+        if self.in_flight < int(self.limit) and not self._waiters:
+            self.in_flight += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        heapq.heappush(self._waiters, (priority, self._seq, future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # 枠を受け取った直後にキャンセルされたら返す
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self) -> None:
+        self.in_flight -= 1
+        self._wake()
+
+    def _wake(self) -> None:
+        while self._waiters and self.in_flight < int(self.limit):
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():
+                continue
+            self.in_flight += 1
+            future.set_result(None)
+
+    def on_success(self) -> None:
+        self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+        self._wake()
+
+    def on_overload(self) -> None:
+        # 同時に返ってきた429/5xxで何度も半減しないよう、一定間隔に1回だけ減らす
+        now = time.monotonic()
+        if now - self._last_decrease >= self._decrease_interval:
+            self.limit = max(float(self.minimum), self.limit / 2)
+            self._last_decrease = now
+
+    @property
+    def waiting(self) -> int:
+        return sum(1 for _, _, future in self._waiters if not future.done())
+
+
+class ModelLimits:
+    """モデルごとのリクエスト数・トークン数のバケットと統計"""
+
+    def __init__(self, rpm: float, tpm: float):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.blocked_until = 0.0  # Retry-After でモデル全体を止める期限
+        self.counts = {"requests": 0, "retries": 0, "throttled": 0, "errors": 0, "wait_ms": 0.0}
+
+
+def openai_stage(model: str) -> str:
+    """メトリクスの段階名（画像生成はチャットと分けて見る）"""
+    return "dalle" if model.startswith("dall-e") else "openai"
+
+
+class OpenAIScheduler:
+    """OpenAIへの全リクエストを通すスケジューラ
+
+    モデルごとのトークンバケットで RPM/TPM を守り、全体の同時実行数は
+    429/5xx に応じて増減させる。空きを待つ要求は優先度順に送り出し、
+    再試行はサーバーのヒント（Retry-After 等）を優先してジッター付きで待つ。
+    """
+
+    def __init__(self, limits: dict[str, tuple[float, float]]):
+        self._limits = limits
+        self._models: dict[str, ModelLimits] = {}
+        self.concurrency = AdaptiveConcurrency(OPENAI_CONCURRENCY_MIN, OPENAI_CONCURRENCY_MAX)
+
+    def _model(self, model: str) -> ModelLimits:
+        limits = self._models.get(model)
+        if limits is None:
+            limits = self._models[model] = ModelLimits(*self._limits.get(model, (0.0, 0.0)))
+        return limits
+
+    @asynccontextmanager
+    async def _slot(self, limits: ModelLimits, priority: int, tokens: int) -> AsyncIterator[None]:
+        """レート制限の予約と同時実行枠の確保（バケット待ちの間は枠を占有しない）"""
+        started = time.monotonic()
+        wait = max(limits.requests.reserve(1), limits.tokens.reserve(tokens))
+        wait = max(wait, limits.blocked_until - started)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        await self.concurrency.acquire(priority)
+        limits.counts["wait_ms"] += (time.monotonic() - started) * 1000
+        limits.counts["requests"] += 1
+        try:
+            yield
+        finally:
+            self.concurrency.release()
+
+    @staticmethod
+    def _retry_hint(res: httpx.Response) -> float | None:
+        """レスポンスヘッダーが示す再試行までの秒数"""
+        if value := res.headers.get("retry-after-ms"):
+            try:
+                return float(value) / 1000
+            except ValueError:
+                pass
+        if value := res.headers.get("retry-after"):
+            try:
+                return float(value)
+            except ValueError:
+                try:
+                    return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+                except (TypeError, ValueError):
+                    pass
+        return None
+
+    @staticmethod
+    def _backoff(attempt: int) -> float:
+        """指数バックオフ（フルジッター）"""
+        return random.uniform(0, min(OPENAI_RETRY_MAX, OPENAI_RETRY_BASE * 2 ** attempt))
+
+    @staticmethod
+    def _retryable(res: httpx.Response) -> bool:
+        if res.status_code not in RETRYABLE_STATUS:
+            return False
+        if res.status_code == 429 and b"insufficient_quota" in res.content:
+            return False  # 利用枠の使い切りは待っても回復しない
+        return True
+
+    def _observe(self, limits: ModelLimits, res: httpx.Response) -> float | None:
+        """レスポンスから制限状況を学習し、再試行するなら待ち時間を返す"""
+        for header, bucket in (
+            ("x-ratelimit-remaining-requests", limits.requests),
+            ("x-ratelimit-remaining-tokens", limits.tokens),
+        ):
+            if value := res.headers.get(header):
+                try:
+                    bucket.clamp(float(value))
+                except ValueError:
+                    pass
+
+        if res.status_code < 400:
+            self.concurrency.on_success()
+            return None
+        if not self._retryable(res):
+            return None
+
+        self.concurrency.on_overload()
+        hint = self._retry_hint(res)
+        if res.status_code == 429:
+            limits.counts["throttled"] += 1
+            if hint is not None:
+                limits.blocked_until = max(limits.blocked_until, time.monotonic() + hint)
+        return hint
+
+    def _retry_delay(self, attempt: int, hint: float | None) -> float:
+        if hint is None:
+            return self._backoff(attempt)
+        return min(OPENAI_RETRY_MAX, hint) + random.uniform(0, OPENAI_RETRY_BASE)
+
+    async def _post(
+        self,
+        model: str,
+        path: str,
+        *,
+        priority: int = PRIORITY_INTERACTIVE,
+        tokens: int = 0,
+        retries: int | None = None,
+        **kwargs: Any,
+    ) -> httpx.Response:
+        limits = self._model(model)
+        retries = OPENAI_MAX_RETRIES if retries is None else retries
+        for attempt in range(retries + 1):
+            async with self._slot(limits, priority, tokens):
+                try:
+                    res = await upstream.get("openai").post(path, **kwargs)
+                except httpx.TransportError as e:
+                    res, error = None, e
+            if res is None:
+                limits.counts["errors"] += 1
+                self.concurrency.on_overload()
+                if attempt >= retries:
+                    raise error
+                delay, reason = self._backoff(attempt), "transport"
+                logger.warning("OpenAIへの接続に失敗したため再試行します: model=%s, delay=%.1fs, error=%s", model, delay, error)
+            else:
+                hint = self._observe(limits, res)
+                if res.status_code < 400 or not self._retryable(res) or attempt >= retries:
+                    if res.status_code >= 400:
+                        limits.counts["errors"] += 1
+                    return res
+                delay, reason = self._retry_delay(attempt, hint), str(res.status_code)
+                logger.warning("OpenAIの応答が%sのため再試行します: model=%s, delay=%.1fs", res.status_code, model, delay)
+            limits.counts["retries"] += 1
+            stage_retries.inc(stage=openai_stage(model), model=model, reason=reason)
+            await asyncio.sleep(delay)
+        raise AssertionError("unreachable")
+
+    @asynccontextmanager
+    async def _stream(
+        self,
+        model: str,
+        path: str,
+        *,
+        priority: int = PRIORITY_INTERACTIVE,
+        tokens: int = 0,
+        **kwargs: Any,
+    ) -> AsyncIterator[httpx.Response]:
+        limits = self._model(model)
+        client = upstream.get("openai")
+        for attempt in range(OPENAI_MAX_RETRIES + 1):
+            async with self._slot(limits, priority, tokens):
+                try:
+                    res = await client.send(client.build_request("POST", path, **kwargs), stream=True)
+                except httpx.TransportError as e:
+                    res, error = None, e
+                if res is not None:
+                    try:
+                        if res.status_code >= 400:
+                            await res.aread()
+                        hint = self._observe(limits, res)
+                        if res.status_code < 400 or not self._retryable(res) or attempt >= OPENAI_MAX_RETRIES:
+                            if res.status_code >= 400:
+                                limits.counts["errors"] += 1
+                            yield res
+                            return
+                    finally:
+                        await res.aclose()
+            if res is None:
+                limits.counts["errors"] += 1
+                self.concurrency.on_overload()
+                if attempt >= OPENAI_MAX_RETRIES:
+                    raise error
+                delay, reason = self._backoff(attempt), "transport"
+            else:
+                delay, reason = self._retry_delay(attempt, hint), str(res.status_code)
+            logger.warning("OpenAIのストリーミングを再試行します: model=%s, delay=%.1fs", model, delay)
+            limits.counts["retries"] += 1
+            stage_retries.inc(stage=openai_stage(model), model=model, reason=reason)
+            await asyncio.sleep(delay)
+
+    async def post(self, model: str, path: str, **kwargs: Any) -> httpx.Response:
+        """POSTを送り、429/5xx/通信エラーなら再試行する（最後の応答はそのまま返す）"""
+        with stage_timer(openai_stage(model), model):
+            res = await self._post(model, path, **kwargs)
+        if res.status_code >= 400:
+            stage_errors.inc(stage=openai_stage(model), msg_type=current_msg_type.get(), model=model)
+        return res
+
+    @asynccontextmanager
+    async def stream(self, model: str, path: str, **kwargs: Any) -> AsyncIterator[httpx.Response]:
+        """ストリーミングでPOSTする（再試行はヘッダーを受け取るまで。ストリーム中は枠を占有する）"""
+        with stage_timer(openai_stage(model), model):
+            async with self._stream(model, path, **kwargs) as res:
+                if res.status_code >= 400:
+                    stage_errors.inc(stage=openai_stage(model), msg_type=current_msg_type.get(), model=model)
+                yield res
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "concurrency_limit": round(self.concurrency.limit, 2),
+            "in_flight": self.concurrency.in_flight,
+            "waiting": self.concurrency.waiting,
+            "models": {
+                model: {
+                    **limits.counts,
+                    "wait_ms": round(limits.counts["wait_ms"], 1),
+                    "requests_available": round(limits.requests.level, 1),
+                    "tokens_available": round(limits.tokens.level),
+                    "blocked_for_s": round(max(0.0, limits.blocked_until - time.monotonic()), 1),
+                }
+                for model, limits in self._models.items()
+            },
+        }
+
+
+openai_scheduler = OpenAIScheduler(parse_rate_limits(OPENAI_RATE_LIMITS))
+openai_concurrency.set_function(
+    lambda: {
+        ("limit",): openai_scheduler.concurrency.limit,
+        ("in_flight",): openai_scheduler.concurrency.in_flight,
+        ("waiting",): openai_scheduler.concurrency.waiting,
+    }
+)
+
+
+# ===== モデルの振り分け =====
+MODEL_TIER_ORDER = ("small", "medium", "large")  # 速い順
+
+
+def parse_settings(spec: str) -> dict[str, str]:
+    """ "key=value,..." 形式の設定を読む"""
+    settings: dict[str, str] = {}
+    for item in spec.split(","):
+        key, _, value = item.partition("=")
+        if key.strip() and value.strip():
+            settings[key.strip()] = value.strip()
+    return settings
+
+
+class LatencyTracker:
+    """モデルごとの直近 window 秒の所要時間からパーセンタイルを求める"""
+
+    def __init__(self, window: float, min_samples: int, max_samples: int = 1000):
+        self._window = window
+        self._min_samples = min_samples
+        self._max_samples = max_samples
+        self._samples: dict[str, deque[tuple[float, float]]] = {}
+
+    def observe(self, model: str, seconds: float) -> None:
+        samples = self._samples.setdefault(model, deque(maxlen=self._max_samples))
+        samples.append((time.monotonic(), seconds))
+
+    def _recent(self, model: str) -> list[float]:
+        samples = self._samples.get(model)
+        if not samples:
+            return []
+        cutoff = time.monotonic() - self._window
+        while samples and samples[0][0] < cutoff:
+            samples.popleft()
+        return sorted(seconds for _, seconds in samples)
+
+    def percentile(self, model: str, q: float) -> float | None:
+        """直近のq分位点（サンプルが min_samples 未満ならNone）"""
+        recent = self._recent(model)
+        if len(recent) < self._min_samples:
+            return None
+        return recent[min(len(recent) - 1, int(len(recent) * q))]
+
+    def stats(self) -> dict[str, Any]:
+        result: dict[str, Any] = {}
+        for model in list(self._samples):
+            recent = self._recent(model)
+            if recent:
+                result[model] = {
+                    "samples": len(recent),
+                    "p50_ms": round(recent[len(recent) // 2] * 1000, 1),
+                    "p95_ms": round(recent[min(len(recent) - 1, int(len(recent) * 0.95))] * 1000, 1),
+                }
+        return result
+
+
+class ModelRouter:
+    """呼び出し元のタスクと入力の大きさからモデルを選ぶ
+
+    タスクごとに既定の階層（small / medium / large）を持ち、入力が upgrade_tokens を超えたら
+    1段上げる。選んだモデルの直近のp95がタスクの予算を超えていれば、予算内（または計測不足）の
+    モデルが見つかるまで速い階層に落とす。計測は window 秒で失効するので、遅延が収まれば元に戻る。
+    """
+
+    def __init__(
+        self,
+        tiers: dict[str, str],
+        routes: dict[str, str],
+        budgets: dict[str, float],
+        upgrade_tokens: int,
+        latency: LatencyTracker,
+    ):
+        self._tiers = {tier: tiers.get(tier, "gpt-5") for tier in MODEL_TIER_ORDER}
+        self._routes = routes
+        self._budgets = budgets
+        self._upgrade_tokens = upgrade_tokens
+        self.latency = latency
+        self._fallbacks = 0
+
+    def select(self, task: str, messages: list[dict[str, Any]]) -> str:
+        """タスク task で messages を送るモデル"""
+        tier = self._routes.get(task, "large")
+        level = MODEL_TIER_ORDER.index(tier) if tier in MODEL_TIER_ORDER else len(MODEL_TIER_ORDER) - 1
+        reason = "route"
+        input_tokens = estimate_request_tokens(messages) - COMPLETION_TOKENS_ESTIMATE
+        if self._upgrade_tokens and input_tokens > self._upgrade_tokens and level < len(MODEL_TIER_ORDER) - 1:
+            level += 1
+            reason = "size"
+
+        model = self._tiers[MODEL_TIER_ORDER[level]]
+        budget = self._budgets.get(task)
+        while budget and level > 0:
+            p95 = self.latency.percentile(model, 0.95)
+            if p95 is None or p95 <= budget:
+                break
+            level -= 1
+            model = self._tiers[MODEL_TIER_ORDER[level]]
+            reason = "fallback"
+        if reason == "fallback":
+            self._fallbacks += 1
+        model_routes.inc(task=task, model=model, reason=reason)
+        return model
+
+    def observe(self, model: str, seconds: float) -> None:
+        self.latency.observe(model, seconds)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "tiers": self._tiers,
+            "routes": self._routes,
+            "latency_budgets": self._budgets,
+            "fallbacks": self._fallbacks,
+            "latency": self.latency.stats(),
+        }
+
+
+model_router = ModelRouter(
+    parse_settings(MODEL_TIERS),
+    parse_settings(MODEL_ROUTES),
+    {task: float(budget) for task, budget in parse_settings(MODEL_LATENCY_BUDGETS).items()},
+    MODEL_UPGRADE_TOKENS,
+    LatencyTracker(MODEL_LATENCY_WINDOW, MODEL_LATENCY_MIN_SAMPLES),
+)
+
+
+# ===== 起動処理 =====
+# 起動の段階ごとの所要時間（秒）。/health と /metrics で確認できる
+startup_phases: dict[str, float] = {}
+startup_report: dict[str, Any] = {}
+startup_seconds.set_function(lambda: {(phase,): seconds for phase, seconds in startup_phases.items()})
+
+
+def process_age() -> float | None:
+    """プロセス起動からの経過秒数（Linuxの /proc から求める。取れなければNone）"""
+    try:
+        with open("/proc/self/stat") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    return max(0.0, uptime - start_ticks / os.sysconf("SC_CLK_TCK"))
+
+
+async def _timed_phase(name: str, awaitable: Awaitable[Any]) -> Any:
+    started = time.perf_counter()
+    try:
+        return await awaitable
+    finally:
+        startup_phases[name] = time.perf_counter() - started
+
+
+def _warm_up_libraries() -> None:
+    """初回の画像処理で払うPillowのプラグイン読み込み・コーデック初期化を済ませる"""
+    if Image is None:
+        return
+    for fmt in ("JPEG", "PNG"):
+        buffer = io.BytesIO()
+        Image.new("RGB", (8, 8)).save(buffer, fmt)
+        with Image.open(io.BytesIO(buffer.getvalue())) as img:
+            img.load()
+
+
+async def startup() -> None:
+    """スキーマ確認とウォームアップ（最初のWebhookで払っていた初期化を起動時に済ませる）"""
+    started = time.perf_counter()
+    boot = process_age()
+    if boot is not None:
+        startup_phases["boot"] = boot  # プロセス起動からlifespan開始まで（importを含む）
+
+    schema_started = time.perf_counter()
+    startup_report["initialized_db"] = init_storage()
+    startup_phases["schema"] = time.perf_counter() - schema_started
+
+    await _timed_phase("clients", upstream.start())  # TLSコンテキストの生成を含む
+    if STARTUP_WARMUP:
+        loop = asyncio.get_running_loop()
+        startup_report["upstream"], *_ = await asyncio.gather(
+            _timed_phase("upstream", upstream.warm_up(STARTUP_WARMUP_TIMEOUT)),
+            _timed_phase("storage", asyncio.gather(history_shards.warm_up(), cache_store.warm_up())),
+            _timed_phase("libraries", loop.run_in_executor(None, _warm_up_libraries)),
+        )
+    startup_phases["total"] = time.perf_counter() - started
+    logger.info(
+        "起動処理が完了しました: %s",
+        " ".join(f"{phase}={seconds * 1000:.0f}ms" for phase, seconds in startup_phases.items()),
+    )
+
+
+# ===== FastAPIアプリ =====
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """起動時にスキーマ確認・ウォームアップと上流クライアント・ワーカーの起動を行い、終了時に順に停止する"""
+    await startup()
+    if WEBHOOK_MODE == "queue":
+        dispatcher.start()
+    history_retention.start()
+    sticker_prewarmer.start()
+    try:
+        yield
+    finally:
+        # 残りのイベントを処理し終えてから（その間に予約された要約も含めて）バックグラウンド処理を止める
+        await message_coalescer.flush_all()
+        await dispatcher.drain(EVENT_DRAIN_TIMEOUT)
+        await sticker_prewarmer.stop()
+        await conversation_summaries.stop()
+        await history_retention.stop()
+        await event_deduplicator.flush()
+        await upstream.aclose()
+        await history_shards.flush()
+        history_shards.close()
+        cache_store.close()
+
+
+app = FastAPI(title="Saku Chappy LINE Bot", version="1.0.0", lifespan=lifespan)
 
 
 # ===== データベース初期化 =====
-def init_db() -> None:
-    """会話履歴用のSQLiteテーブルを初期化"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS chat_history (
+# 全接続に適用するPRAGMA（WALで読み書きを並行させ、fsyncはチェックポイント時のみ）
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-8000",
+    "PRAGMA mmap_size=67108864",
+)
+
+
+def connect_db(path: Path) -> sqlite3.Connection:
+    """PRAGMAを適用したSQLite接続を開く"""
+    conn = sqlite3.connect(path, check_same_thread=False)
+    for pragma in SQLITE_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def shard_paths(base: Path, shards: int) -> list[Path]:
+    """分割数に応じた履歴DBのパス（1なら従来どおり base だけ）"""
+    if shards <= 1:
+        return [base]
+    return [base.with_name(f"{base.stem}.{i}-of-{shards}{base.suffix}") for i in range(shards)]
+
+
+def shard_index(user_id: str, shards: int) -> int:
+    """user_id の振り分け先（プロセスや再起動をまたいで変わらないハッシュで決める）"""
+    if shards <= 1:
+        return 0
+    digest = hashlib.blake2b(user_id.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % shards
+
+
+# スキーマを変えたら上げる（PRAGMA user_version に記録し、同じバージョンなら初期化を省く）
+HISTORY_SCHEMA_VERSION = 2
+CACHE_SCHEMA_VERSION = 2
+
+
+def schema_version(conn: sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def init_db(path: Path = DB_PATH) -> bool:
+    """会話履歴用のSQLiteテーブルを初期化（初期化した場合はTrue）"""
+    conn = connect_db(path)
+    if schema_version(conn) >= HISTORY_SCHEMA_VERSION:
+        conn.close()
+        return False
+    # 削除で空いたページを少しずつ返せるよう incremental auto_vacuum にする
+    # （既存DBの切り替えには一度だけ VACUUM が必要）
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS chat_history (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id TEXT NOT NULL,
             role TEXT NOT NULL,
             content TEXT NOT NULL,
             timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
         )
-    """)
-    cursor.execute("""
-        CREATE INDEX IF NOT EXISTS idx_user_id ON chat_history(user_id)
-    """)
-    conn.commit()
-    conn.close()
+    """)
+    # (user_id, timestamp) の複合インデックスで「ユーザーの最新N件」をソートなしで引く
+    # COUNT(*) もこのインデックスだけで完結する
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_user_timestamp ON chat_history(user_id, timestamp)
+    """)
+    # 旧インデックスは複合インデックスの先頭列と重複するので削除
+    cursor.execute("DROP INDEX IF EXISTS idx_user_id")
+    # 保持期間を過ぎた履歴（content は zlib 圧縮）
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS chat_history_archive (
+            id INTEGER PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            role TEXT NOT NULL,
+            content BLOB NOT NULL,
+            timestamp DATETIME,
+            archived_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    # 会話の窓から外れた古いやり取りの要約（last_id までを要約済み）
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS chat_summary (
+            user_id TEXT PRIMARY KEY,
+            summary TEXT NOT NULL,
+            last_id INTEGER NOT NULL,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    # ユーザーごとの設定（履歴のリセットでは消さない）
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS user_settings (
+            user_id TEXT PRIMARY KEY,
+            answer_cache INTEGER NOT NULL DEFAULT 1
+        )
+    """)
+    cursor.execute(f"PRAGMA user_version={HISTORY_SCHEMA_VERSION}")
+    conn.commit()
+    conn.close()
+    return True
+
+
+def init_cache_db(path: Path = CACHE_DB_PATH) -> bool:
+    """応答キャッシュ用のSQLiteテーブルを初期化（初期化した場合はTrue）"""
+    conn = connect_db(path)
+    if schema_version(conn) >= CACHE_SCHEMA_VERSION:
+        conn.close()
+        return False
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS cache_entries (
+            namespace TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            accessed_at REAL NOT NULL,
+            PRIMARY KEY (namespace, key)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_cache_accessed ON cache_entries(namespace, accessed_at)
+    """)
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_cache_created ON cache_entries(namespace, created_at)
+    """)
+    # 名前空間ごとの件数と合計サイズ（保存・削除のたびに差分で更新し、容量判定で全件を集計しない）
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS cache_usage (
+            namespace TEXT PRIMARY KEY,
+            entries INTEGER NOT NULL,
+            bytes INTEGER NOT NULL
+        )
+    """)
+    conn.execute(
+        "INSERT OR REPLACE INTO cache_usage (namespace, entries, bytes) "
+        "SELECT namespace, COUNT(*), SUM(size) FROM cache_entries GROUP BY namespace"
+    )
+    conn.execute(f"PRAGMA user_version={CACHE_SCHEMA_VERSION}")
+    conn.commit()
+    conn.close()
+    return True
+
+
+def init_storage() -> list[str]:
+    """全DBのスキーマを現在のバージョンにそろえ、初期化したファイルを返す（起動時に1回呼ぶ）"""
+    initialized = [str(path) for path in shard_paths(DB_PATH, HISTORY_SHARDS) if init_db(path)]
+    if init_cache_db(CACHE_DB_PATH):
+        initialized.append(str(CACHE_DB_PATH))
+    if HISTORY_SHARDS > 1 and DB_PATH.exists():
+        logger.warning("分割前の履歴DBが残っています（読み込みません）: %s。tools/reshard_history.py で移行してください", DB_PATH)
+    if MULTI_PROCESS and HISTORY_CACHE_MAX_USERS > 0:
+        logger.warning(
+            "複数プロセス構成で履歴キャッシュが有効です（他のプロセスの書き込み・リセットは反映されません）: "
+            "WEB_CONCURRENCY=%s, HISTORY_SHARDS=%s, HISTORY_CACHE_MAX_USERS=%s",
+            WEB_CONCURRENCY, HISTORY_SHARDS, HISTORY_CACHE_MAX_USERS,
+        )
+    return initialized
+
+
+# ===== 履歴ストア =====
+class HistoryStore:
+    """SQLite接続を保持し、クエリをイベントループ外の専用スレッドで実行する
+
+    書き込みは1本のライタースレッドに直列化し、読み込みは別スレッド・別接続で
+    WALのスナップショットから行うので、書き込み中でも読み込みが待たされない。
+    """
+
+    def __init__(self, path: Path, synchronous: str = "NORMAL", name: str = "history"):
+        self._path = path
+        self._synchronous = synchronous
+        self._name = name
+        self._local = threading.local()
+        self._connections: list[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"{self._name}-writer")
+        self._reader = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"{self._name}-reader")
+
+    def _connection(self) -> sqlite3.Connection:
+        """実行中スレッド専用の接続（初回のみ開く）"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = connect_db(self._path)
+            conn.execute(f"PRAGMA synchronous={self._synchronous}")
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def _run_read(self, fn: Callable[..., Any], *args: Any) -> Any:
+        return fn(self._connection(), *args)
+
+    def _run_write(self, fn: Callable[..., Any], *args: Any) -> Any:
+        conn = self._connection()
+        try:
+            result = fn(conn, *args)
+            conn.commit()
+            return result
+        except BaseException:
+            conn.rollback()
+            raise
+
+    async def read(self, fn: Callable[..., Any], *args: Any) -> Any:
+        """fn(conn, *args) をリーダースレッドで実行"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._reader, self._run_read, fn, *args)
+
+    async def write(self, fn: Callable[..., Any], *args: Any) -> Any:
+        """fn(conn, *args) をライタースレッドで実行してコミット"""
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            return await loop.run_in_executor(self._writer, self._run_write, fn, *args)
+        finally:
+            db_write_seconds.observe(time.perf_counter() - started, store=self._name)
+
+    async def warm_up(self) -> None:
+        """リーダー・ライター両方のスレッドで接続を開いておく"""
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(
+            loop.run_in_executor(self._reader, self._connection),
+            loop.run_in_executor(self._writer, self._connection),
+        )
+
+    def close(self) -> None:
+        """実行中のクエリを待ってから全接続を閉じる"""
+        self._writer.shutdown(wait=True)
+        self._reader.shutdown(wait=True)
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"{self._name}-writer")
+        self._reader = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"{self._name}-reader")
+
+
+
+# ===== グループコミット =====
+def _apply_batch(
+    conn: sqlite3.Connection, ops: list[tuple[Callable[..., Any], tuple[Any, ...]]]
+) -> list[Any]:
+    """複数の書き込み操作を1トランザクションで実行（失敗した操作だけを巻き戻す）"""
+    if not conn.in_transaction:
+        conn.execute("BEGIN IMMEDIATE")
+    results: list[Any] = []
+    for fn, args in ops:
+        conn.execute("SAVEPOINT history_op")
+        try:
+            results.append(fn(conn, *args))
+            conn.execute("RELEASE history_op")
+        except Exception as e:
+            conn.execute("ROLLBACK TO history_op")
+            conn.execute("RELEASE history_op")
+            results.append(e)
+    return results
+
+
+class HistoryWriter:
+    """全ユーザーの書き込みを集めて1トランザクションでコミットする
+
+    件数が HISTORY_BATCH_SIZE に達するか HISTORY_BATCH_WINDOW_MS 経過した時点で
+    まとめて書き込むので、コミット（fsync）の回数が会話数に比例しなくなる。
+    操作は投入順に実行されるため、同じユーザーの保存とリセットの順序も保たれる。
+    """
+
+    def __init__(self, store: HistoryStore, batch_size: int, window: float, durability: str):
+        self._store = store
+        self._batch_size = max(1, batch_size)
+        self._window = window
+        self._durability = durability
+        self._ops: list[tuple[Callable[..., Any], tuple[Any, ...], asyncio.Future, str]] = []
+        self._pending_users: dict[str, int] = {}
+        self._inflight: set[asyncio.Task] = set()
+        self._timer: asyncio.Task | None = None
+        self._batches = 0
+        self._ops_written = 0
+        self._max_batch = 0
+        self._commit_seconds = 0.0
+
+    async def submit(self, user_id: str, fn: Callable[..., Any], *args: Any) -> Any:
+        """書き込み操作を投入（durabilityがbuffered以外ならコミットまで待つ）"""
+        future = asyncio.get_running_loop().create_future()
+        self._ops.append((fn, args, future, user_id))
+        self._pending_users[user_id] = self._pending_users.get(user_id, 0) + 1
+
+        if len(self._ops) >= self._batch_size:
+            self._start_batch()
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+
+        if self._durability == "buffered":
+            future.add_done_callback(self._log_failure)
+            return None
+        return await future
+
+    @staticmethod
+    def _log_failure(future: asyncio.Future) -> None:
+        if not future.cancelled() and future.exception() is not None:
+            logger.error("履歴の書き込みに失敗しました: %s", future.exception())
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self._window)
+        self._timer = None
+        self._start_batch()
+
+    def _start_batch(self) -> None:
+        """溜まっている操作を1バッチとしてライタースレッドに渡す"""
+        if self._timer is not None and self._timer is not asyncio.current_task():
+            self._timer.cancel()
+        self._timer = None
+        ops, self._ops = self._ops, []
+        if ops:
+            task = asyncio.create_task(self._run_batch(ops))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _run_batch(self, ops: list[tuple[Callable[..., Any], tuple[Any, ...], asyncio.Future, str]]) -> None:
+        started = time.perf_counter()
+        try:
+            results = await self._store.write(_apply_batch, [(fn, args) for fn, args, _, _ in ops])
+        except Exception as e:
+            results = [e] * len(ops)
+        self._commit_seconds += time.perf_counter() - started
+        self._batches += 1
+        self._ops_written += len(ops)
+        self._max_batch = max(self._max_batch, len(ops))
+
+        for (_, _, future, user_id), result in zip(ops, results):
+            remaining = self._pending_users.get(user_id, 1) - 1
+            if remaining > 0:
+                self._pending_users[user_id] = remaining
+            else:
+                self._pending_users.pop(user_id, None)
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def flush(self) -> None:
+        """溜まっている操作をすぐに書き込み、実行中のバッチも含めて完了を待つ"""
+        self._start_batch()
+        if self._inflight:
+            await asyncio.gather(*self._inflight, return_exceptions=True)
+
+    async def flush_user(self, user_id: str) -> None:
+        """未コミットの書き込みがあるユーザーを読む前に書き込みを済ませる"""
+        if user_id in self._pending_users:
+            await self.flush()
+
+    def stats(self) -> dict[str, Any]:
+        """バッチ書き込みの統計"""
+        return {
+            "durability": self._durability,
+            "pending": len(self._ops),
+            "batches": self._batches,
+            "ops": self._ops_written,
+            "max_batch": self._max_batch,
+            "avg_batch": round(self._ops_written / self._batches, 2) if self._batches else 0.0,
+            "avg_commit_ms": round(self._commit_seconds / self._batches * 1000, 2) if self._batches else 0.0,
+        }
+
+
+class ShardedHistory:
+    """user_id のハッシュで履歴を複数のSQLiteファイルに振り分ける
+
+    shardごとに HistoryStore と HistoryWriter を持つので、書き込みロックもグループコミットも
+    shard単位になる。同じユーザーの読み書きは常に同じshardに行くため、操作の順序は変わらない。
+    """
+
+    def __init__(self, paths: list[Path], synchronous: str, batch_size: int, window: float, durability: str):
+        self.paths = paths
+        self.stores = [
+            HistoryStore(path, synchronous=synchronous, name="history" if len(paths) == 1 else f"history-{i}")
+            for i, path in enumerate(paths)
+        ]
+        self.writers = [HistoryWriter(store, batch_size, window, durability) for store in self.stores]
+
+    def index(self, user_id: str) -> int:
+        return shard_index(user_id, len(self.stores))
+
+    async def read(self, user_id: str, fn: Callable[..., Any], *args: Any) -> Any:
+        """user_id のshardで fn(conn, *args) を読み込み用に実行"""
+        return await self.stores[self.index(user_id)].read(fn, *args)
+
+    async def submit(self, user_id: str, fn: Callable[..., Any], *args: Any) -> Any:
+        """user_id のshardのライターに書き込み操作を投入"""
+        return await self.writers[self.index(user_id)].submit(user_id, fn, *args)
+
+    async def flush_user(self, user_id: str) -> None:
+        await self.writers[self.index(user_id)].flush_user(user_id)
+
+    async def flush(self) -> None:
+        await asyncio.gather(*(writer.flush() for writer in self.writers))
+
+    async def warm_up(self) -> None:
+        await asyncio.gather(*(store.warm_up() for store in self.stores))
+
+    def close(self) -> None:
+        for store in self.stores:
+            store.close()
+
+    def stats(self) -> dict[str, Any]:
+        """全shardを合算したバッチ書き込みの統計（shardが複数ならshard別も）"""
+        per_shard = [writer.stats() for writer in self.writers]
+        batches = sum(stats["batches"] for stats in per_shard)
+        ops = sum(stats["ops"] for stats in per_shard)
+        commit_ms = sum(stats["avg_commit_ms"] * stats["batches"] for stats in per_shard)
+        result = {
+            "durability": per_shard[0]["durability"],
+            "shards": len(per_shard),
+            "pending": sum(stats["pending"] for stats in per_shard),
+            "batches": batches,
+            "ops": ops,
+            "max_batch": max(stats["max_batch"] for stats in per_shard),
+            "avg_batch": round(ops / batches, 2) if batches else 0.0,
+            "avg_commit_ms": round(commit_ms / batches, 2) if batches else 0.0,
+        }
+        if len(per_shard) > 1:
+            result["per_shard"] = per_shard
+        return result
+
+
+history_shards = ShardedHistory(
+    shard_paths(DB_PATH, HISTORY_SHARDS),
+    "FULL" if HISTORY_DURABILITY == "full" else "NORMAL",
+    HISTORY_BATCH_SIZE,
+    HISTORY_BATCH_WINDOW_MS / 1000,
+    HISTORY_DURABILITY,
+)
+
+
+# ===== 履歴キャッシュ =====
+HISTORY_LIMIT = 20  # 最新20件 = 10往復
+
+
+class HistoryCache:
+    """アクティブなユーザーの直近履歴を保持するLRUキャッシュ
+
+    ユーザー数と合計バイト数の両方で上限を設ける。書き込みはSQLiteへの
+    書き込み後に反映するので、キャッシュにあるユーザーの履歴は常にDBと一致する。
+    """
+
+    _ENTRY_OVERHEAD = 200  # dict・deque要素1件あたりのおおよそのバイト数
+
+    def __init__(self, max_users: int, max_bytes: int, window: int):
+        self._max_users = max_users
+        self._max_bytes = max_bytes
+        self._window = window
+        self._entries: OrderedDict[str, deque[dict[str, Any]]] = OrderedDict()
+        self._sizes: dict[str, int] = {}
+        self._bytes = 0
+        # DBから読み込み中のユーザー → 読み込み中に書き込みがあったか（読み込みがすべて終わるまで保持）
+        self._filling: dict[str, bool] = {}
+        self._readers: dict[str, int] = {}  # ユーザーごとの実行中の読み込み数
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._max_users > 0 and self._max_bytes > 0
+
+    @classmethod
+    def _message_size(cls, message: dict[str, Any]) -> int:
+        return sys.getsizeof(message["content"]) + cls._ENTRY_OVERHEAD
+
+    def get(self, user_id: str) -> list[dict[str, Any]] | None:
+        """キャッシュ済みの履歴（古い順）を返す。無ければNone"""
+        if not self.enabled:
+            return None
+        entry = self._entries.get(user_id)
+        if entry is None:
+            self._misses += 1
+            return None
+        self._entries.move_to_end(user_id)
+        self._hits += 1
+        return list(entry)
+
+    def begin_fill(self, user_id: str) -> None:
+        """DBからの読み込み開始を記録（読み込み中の書き込みを検出するため）"""
+        if self.enabled:
+            self._readers[user_id] = self._readers.get(user_id, 0) + 1
+            # 別の読み込みの最中なら、それまでに検出した書き込みを消さない
+            self._filling.setdefault(user_id, False)
+
+    def fill(self, user_id: str, history: list[dict[str, Any]]) -> None:
+        """DBから読み込んだ履歴を登録（同じユーザーの読み込み中に書き込みがあれば古いので捨てる）"""
+        if not self.enabled:
+            return
+        stale = self._end_fill(user_id)
+        if stale or user_id in self._entries:
+            return
+        self._store(user_id, deque(history, maxlen=self._window))
+
+    def abort_fill(self, user_id: str) -> None:
+        """DBからの読み込みが失敗したときに開始の記録を外す"""
+        if self.enabled:
+            self._end_fill(user_id)
+
+    def _end_fill(self, user_id: str) -> bool:
+        """読み込みの終了を記録し、読み込み中に書き込みがあったかを返す"""
+        readers = self._readers.get(user_id, 0) - 1
+        if readers > 0:
+            self._readers[user_id] = readers
+            return self._filling.get(user_id, True)
+        self._readers.pop(user_id, None)
+        return self._filling.pop(user_id, True)
+
+    def append(self, user_id: str, role: str, content: str) -> None:
+        """DBに保存したメッセージをキャッシュにも反映"""
+        if user_id in self._filling:
+            self._filling[user_id] = True
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return
+        message = {"role": role, "content": content}
+        if len(entry) == entry.maxlen:
+            removed = entry[0]
+            self._sizes[user_id] -= self._message_size(removed)
+            self._bytes -= self._message_size(removed)
+        entry.append(message)
+        self._sizes[user_id] += self._message_size(message)
+        self._bytes += self._message_size(message)
+        self._entries.move_to_end(user_id)
+        self._evict(keep=user_id)
+
+    def invalidate(self, user_id: str) -> None:
+        """ユーザーのキャッシュを破棄（次回はDBから読み直す）"""
+        if user_id in self._filling:
+            self._filling[user_id] = True
+        self._discard(user_id)
+
+    def reset(self, user_id: str) -> None:
+        """履歴リセット後の状態（空の履歴）を登録"""
+        if not self.enabled:
+            return
+        if user_id in self._filling:
+            self._filling[user_id] = True
+        self._discard(user_id)
+        self._store(user_id, deque(maxlen=self._window))
+
+    def _store(self, user_id: str, entry: deque[dict[str, Any]]) -> None:
+        size = sum(self._message_size(message) for message in entry)
+        self._entries[user_id] = entry
+        self._sizes[user_id] = size
+        self._bytes += size
+        self._evict(keep=user_id)
+
+    def _discard(self, user_id: str) -> None:
+        if self._entries.pop(user_id, None) is not None:
+            self._bytes -= self._sizes.pop(user_id)
+
+    def _evict(self, keep: str) -> None:
+        """上限を超えた分を古いユーザーから追い出す"""
+        while len(self._entries) > self._max_users or self._bytes > self._max_bytes:
+            oldest = next(iter(self._entries))
+            if oldest == keep and len(self._entries) == 1:
+                # 1ユーザー分だけで上限を超える場合はキャッシュしない
+                self._discard(oldest)
+                self._evictions += 1
+                return
+            if oldest == keep:
+                self._entries.move_to_end(keep)
+                continue
+            self._discard(oldest)
+            self._evictions += 1
+
+    def stats(self) -> dict[str, Any]:
+        """ヒット率などの統計"""
+        lookups = self._hits + self._misses
+        return {
+            "enabled": self.enabled,
+            "users": len(self._entries),
+            "bytes": self._bytes,
+            "max_users": self._max_users,
+            "max_bytes": self._max_bytes,
+            "hits": self._hits,
+            "misses": self._misses,
+            "evictions": self._evictions,
+            "hit_rate": round(self._hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+history_cache = HistoryCache(HISTORY_CACHE_MAX_USERS, HISTORY_CACHE_MAX_BYTES, HISTORY_LIMIT)
+
+
+# ===== データストア操作 =====
+
+
+def _select_recent(conn: sqlite3.Connection, user_id: str, limit: int) -> list[tuple[int, str, str]]:
+    return conn.execute(
+        "SELECT id, role, content FROM chat_history WHERE user_id = ? "
+        "ORDER BY timestamp DESC, id DESC LIMIT ?",
+        (user_id, limit),
+    ).fetchall()
+
+
+def _insert_message(conn: sqlite3.Connection, user_id: str, role: str, content: str) -> None:
+    conn.execute(
+        "INSERT INTO chat_history (user_id, role, content) VALUES (?, ?, ?)",
+        (user_id, role, content),
+    )
+
+
+def _insert_exchange(conn: sqlite3.Connection, user_id: str, user_text: str, reply_text: str) -> None:
+    conn.executemany(
+        "INSERT INTO chat_history (user_id, role, content) VALUES (?, ?, ?)",
+        ((user_id, "user", user_text), (user_id, "assistant", reply_text)),
+    )
+
+
+def _delete_user(conn: sqlite3.Connection, user_id: str) -> None:
+    conn.execute("DELETE FROM chat_history WHERE user_id = ?", (user_id,))
+    conn.execute("DELETE FROM chat_summary WHERE user_id = ?", (user_id,))
+
+
+def _select_answer_cache_setting(conn: sqlite3.Connection, user_id: str) -> bool:
+    row = conn.execute("SELECT answer_cache FROM user_settings WHERE user_id = ?", (user_id,)).fetchone()
+    return row is None or bool(row[0])
+
+
+def _upsert_answer_cache_setting(conn: sqlite3.Connection, user_id: str, enabled: bool) -> None:
+    conn.execute(
+        "INSERT INTO user_settings (user_id, answer_cache) VALUES (?, ?) "
+        "ON CONFLICT(user_id) DO UPDATE SET answer_cache = excluded.answer_cache",
+        (user_id, int(enabled)),
+    )
+
+
+def _count_user(conn: sqlite3.Connection, user_id: str) -> int:
+    return conn.execute(
+        "SELECT COUNT(*) FROM chat_history WHERE user_id = ?", (user_id,)
+    ).fetchone()[0]
+
+
+async def get_history(user_id: str, after_id: int = 0) -> list[dict[str, str]]:
+    """会話履歴を取得（最新20件 = 10往復のうち、要約済み（id <= after_id）を除く）"""
+    history = history_cache.get(user_id)
+    if history is None:
+        history_cache.begin_fill(user_id)
+        try:
+            with stage_timer("history_read"):
+                await history_shards.flush_user(user_id)
+                rows = await history_shards.read(user_id, _select_recent, user_id, HISTORY_LIMIT)
+        except BaseException:
+            history_cache.abort_fill(user_id)
+            raise
+
+        # 新しい順に取得したので逆順にする（idは要約済みの判定にだけ使う）
+        history = [{"id": row_id, "role": role, "content": content} for row_id, role, content in reversed(rows)]
+        history_cache.fill(user_id, history)
+
+    # キャッシュに追記した発言はidを持たないが、要約より新しい（要約が進むとキャッシュを破棄する）
+    return [
+        {"role": message["role"], "content": message["content"]}
+        for message in history
+        if message.get("id") is None or message["id"] > after_id
+    ]
+
+
+async def save_to_history(user_id: str, role: str, content: str) -> None:
+    """会話履歴に追加"""
+    await history_shards.submit(user_id, _insert_message, user_id, role, content)
+    history_cache.append(user_id, role, content)
+
+
+async def save_exchange(user_id: str, user_text: str, reply_text: str) -> None:
+    """ユーザー発言とアシスタント応答を1組として不可分に保存"""
+    await history_shards.submit(user_id, _insert_exchange, user_id, user_text, reply_text)
+    history_cache.append(user_id, "user", user_text)
+    history_cache.append(user_id, "assistant", reply_text)
+
+
+async def reset_history(user_id: str) -> None:
+    """会話履歴をリセット"""
+    # 実行中の要約を先に止める（止める前の要約が削除の後に書き戻されないように）
+    await conversation_summaries.reset(user_id)
+    await history_shards.submit(user_id, _delete_user, user_id)
+    history_cache.reset(user_id)
+
+
+async def get_history_count(user_id: str) -> int:
+    """会話履歴の件数を取得"""
+    await history_shards.flush_user(user_id)
+    return await history_shards.read(user_id, _count_user, user_id)
+
+
+async def get_answer_cache_setting(user_id: str) -> bool:
+    """回答キャッシュを使うか（/cache off で無効にしたユーザーはFalse）"""
+    await history_shards.flush_user(user_id)
+    return await history_shards.read(user_id, _select_answer_cache_setting, user_id)
+
+
+async def set_answer_cache_setting(user_id: str, enabled: bool) -> None:
+    await history_shards.submit(user_id, _upsert_answer_cache_setting, user_id, enabled)
+
+
+# ===== 履歴の保持期間 =====
+def _select_expired_ids(conn: sqlite3.Connection, cutoff_days: float, limit: int) -> list[int]:
+    # id は時刻順に増えるので、古い行は rowid 順の先頭に集まっている
+    return [
+        row[0]
+        for row in conn.execute(
+            "SELECT id FROM chat_history WHERE timestamp < datetime('now', ?) ORDER BY id LIMIT ?",
+            (f"-{cutoff_days} days", limit),
+        )
+    ]
+
+
+def _select_users_over(conn: sqlite3.Connection, keep: int) -> list[str]:
+    return [
+        row[0]
+        for row in conn.execute(
+            "SELECT user_id FROM chat_history GROUP BY user_id HAVING COUNT(*) > ?", (keep,)
+        )
+    ]
+
+
+def _select_overflow_ids(conn: sqlite3.Connection, user_id: str, keep: int, limit: int) -> list[int]:
+    return [
+        row[0]
+        for row in conn.execute(
+            "SELECT id FROM chat_history WHERE user_id = ? "
+            "ORDER BY timestamp DESC, id DESC LIMIT ? OFFSET ?",
+            (user_id, limit, keep),
+        )
+    ]
+
+
+def _archive_rows(conn: sqlite3.Connection, ids: list[int], archive: bool) -> list[str]:
+    """指定した行をアーカイブに移して削除し、影響したユーザーIDを返す"""
+    placeholders = ",".join("?" * len(ids))
+    rows = conn.execute(
+        f"SELECT id, user_id, role, content, timestamp FROM chat_history WHERE id IN ({placeholders})",
+        ids,
+    ).fetchall()
+    if archive:
+        conn.executemany(
+            "INSERT OR IGNORE INTO chat_history_archive (id, user_id, role, content, timestamp) "
+            "VALUES (?, ?, ?, ?, ?)",
+            ((id_, user_id, role, zlib.compress(content.encode()), ts) for id_, user_id, role, content, ts in rows),
+        )
+    conn.execute(f"DELETE FROM chat_history WHERE id IN ({placeholders})", ids)
+    return sorted({row[1] for row in rows})
+
+
+def _incremental_vacuum(conn: sqlite3.Connection, pages: int) -> None:
+    # sqlite3モジュールは結果列の無い文を1ステップしか実行しないので、1ページずつ解放する
+    free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    for _ in range(min(free_pages, pages)):
+        conn.execute("PRAGMA incremental_vacuum(1)").close()
+
+
+def _table_stats(conn: sqlite3.Connection) -> dict[str, int]:
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    return {
+        "rows": conn.execute("SELECT COUNT(*) FROM chat_history").fetchone()[0],
+        "archived_rows": conn.execute("SELECT COUNT(*) FROM chat_history_archive").fetchone()[0],
+        "db_bytes": conn.execute("PRAGMA page_count").fetchone()[0] * page_size,
+        "free_bytes": conn.execute("PRAGMA freelist_count").fetchone()[0] * page_size,
+    }
+
+
+class HistoryRetention:
+    """古い履歴を定期的にアーカイブへ移し、空きページを少しずつ解放するバックグラウンドタスク
+
+    削除は HISTORY_RETENTION_BATCH 件ずつグループコミット経由で行うので、
+    書き込みロックを長時間握らず通常の会話の保存と交互に進む。履歴が分割されていればshardごとに処理する。
+    """
+
+    _BATCH_PAUSE = 0.05  # バッチ間で他の書き込みに譲る秒数
+
+    def __init__(
+        self,
+        shards: ShardedHistory,
+        interval: float,
+        keep: int,
+        max_age_days: float,
+        batch_size: int,
+    ):
+        self._shards = shards
+        self._interval = interval
+        # 会話に使う直近の履歴は必ず残す
+        self._keep = max(keep, HISTORY_LIMIT) if keep > 0 else 0
+        self._max_age_days = max_age_days
+        self._batch_size = max(1, batch_size)
+        self._task: asyncio.Task | None = None
+        self._runs = 0
+        self._total_pruned = 0
+        self._last_run: dict[str, Any] = {}
+        self._table: dict[str, int] = {}
+
+    def start(self) -> None:
+        """定期実行タスクを開始"""
+        if self._interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._loop(), name="history-retention")
+
+    async def stop(self) -> None:
+        """定期実行タスクを停止"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _loop(self) -> None:
+        # 起動直後の負荷と重ならないよう、初回は少し遅らせる
+        await asyncio.sleep(min(self._interval, 60.0))
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error("履歴の保持期間処理に失敗しました: %s", e, exc_info=True)
+            await asyncio.sleep(self._interval)
+
+    async def _prune(self, writer: HistoryWriter, ids: list[int]) -> int:
+        affected = await writer.submit("__retention__", _archive_rows, ids, HISTORY_ARCHIVE)
+        for user_id in affected:
+            history_cache.invalidate(user_id)
+        await asyncio.sleep(self._BATCH_PAUSE)
+        return len(ids)
+
+    async def run_once(self) -> dict[str, Any]:
+        """保持期間を過ぎた行を移し、空きページを解放して統計を更新する"""
+        started = time.perf_counter()
+        pruned = 0
+        for store, writer in zip(self._shards.stores, self._shards.writers):
+            pruned += await self._run_shard(store, writer)
+
+        elapsed = time.perf_counter() - started
+        self._runs += 1
+        self._total_pruned += pruned
+        tables = [await store.read(_table_stats) for store in self._shards.stores]
+        self._table = {key: sum(table[key] for table in tables) for key in tables[0]}
+        self._last_run = {
+            "pruned": pruned,
+            "seconds": round(elapsed, 3),
+            "rows_per_second": round(pruned / elapsed, 1) if elapsed > 0 else 0.0,
+            "finished_at": time.time(),
+        }
+        if pruned:
+            logger.info("履歴をアーカイブしました: rows=%s, seconds=%.2f", pruned, elapsed)
+        return self._last_run
+
+    async def _run_shard(self, store: HistoryStore, writer: HistoryWriter) -> int:
+        pruned = 0
+        if self._max_age_days > 0:
+            while True:
+                ids = await store.read(_select_expired_ids, self._max_age_days, self._batch_size)
+                if not ids:
+                    break
+                pruned += await self._prune(writer, ids)
+
+        if self._keep > 0:
+            for user_id in await store.read(_select_users_over, self._keep):
+                while True:
+                    ids = await store.read(_select_overflow_ids, user_id, self._keep, self._batch_size)
+                    if not ids:
+                        break
+                    pruned += await self._prune(writer, ids)
+
+        if HISTORY_VACUUM_PAGES > 0:
+            await writer.submit("__retention__", _incremental_vacuum, HISTORY_VACUUM_PAGES)
+        return pruned
+
+    def stats(self) -> dict[str, Any]:
+        """保持期間処理とテーブルサイズの統計"""
+        return {
+            "enabled": self._interval > 0,
+            "keep_per_user": self._keep,
+            "max_age_days": self._max_age_days,
+            "runs": self._runs,
+            "total_pruned": self._total_pruned,
+            "last_run": self._last_run,
+            "table": self._table,
+        }
+
+
+history_retention = HistoryRetention(
+    history_shards,
+    HISTORY_RETENTION_INTERVAL,
+    HISTORY_RETENTION_KEEP,
+    HISTORY_RETENTION_DAYS,
+    HISTORY_RETENTION_BATCH,
+)
+
+
+# ===== 会話の要約とコンテキスト構築 =====
+SUMMARY_PROMPT = f"""あなたは会話ログを要約するアシスタントです。
+これまでの要約と新しいやり取りを統合し、今後の会話に必要な情報（ユーザーの状況・好み・
+話題・約束したこと・未解決の質問）を残した日本語の要約を{SUMMARY_MAX_CHARS}文字以内で出力してください。
+要約本文のみを出力してください。"""
+
+# 要約がないとき・要約処理自体で毎回使うシステムメッセージ（シリアライズ済み）
+SYSTEM_MESSAGE = PrebuiltMessage("system", SYS_PROMPT)
+SUMMARY_SYSTEM_MESSAGE = PrebuiltMessage("system", SUMMARY_PROMPT)
+
+
+def estimate_tokens(text: str) -> int:
+    """トークン数の概算（ASCIIは約4文字、それ以外は約1文字で1トークン）"""
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    return (ascii_chars + 3) // 4 + (len(text) - ascii_chars)
+
+
+def estimate_message_tokens(message: dict[str, Any]) -> int:
+    """1メッセージ分のトークン数の概算（ロール等のオーバーヘッド込み）"""
+    content = message["content"]
+    return estimate_tokens(content if isinstance(content, str) else json_dumps(content).decode()) + 4
+
+
+def _select_summary(conn: sqlite3.Connection, user_id: str) -> tuple[str, int] | None:
+    return conn.execute(
+        "SELECT summary, last_id FROM chat_summary WHERE user_id = ?", (user_id,)
+    ).fetchone()
+
+
+def _select_unsummarized(
+    conn: sqlite3.Connection, user_id: str, last_id: int, window: int, min_rows: int
+) -> list[tuple[int, str, str]]:
+    """会話の窓より古く、まだ要約に含まれていない行（古い順。min_rows件に満たなければ空）
+
+    要約済みの行は窓より古いので、id > last_id の行から窓の分を飛ばせば未要約の行だけが残る。
+    件数はインデックスだけで数え、要約するほど溜まっていなければ本文は読まない。
+    """
+    query = (
+        "FROM chat_history WHERE user_id = ? AND id > ? "
+        "ORDER BY timestamp DESC, id DESC LIMIT -1 OFFSET ?"
+    )
+    params = (user_id, last_id, window)
+    count = conn.execute(f"SELECT COUNT(*) FROM (SELECT id {query})", params).fetchone()[0]
+    if count < min_rows:
+        return []
+    rows = conn.execute(f"SELECT id, role, content {query}", params).fetchall()
+    return rows[::-1]
+
+
+def _upsert_summary(conn: sqlite3.Connection, user_id: str, summary: str, last_id: int) -> None:
+    conn.execute(
+        "INSERT INTO chat_summary (user_id, summary, last_id) VALUES (?, ?, ?) "
+        "ON CONFLICT(user_id) DO UPDATE SET summary = excluded.summary, "
+        "last_id = excluded.last_id, updated_at = CURRENT_TIMESTAMP",
+        (user_id, summary, last_id),
+    )
+
+
+class ConversationSummaries:
+    """プロンプトに入りきらなかったやり取りをユーザーごとの要約に少しずつ畳み込む
+
+    要約の更新は応答を返した後のバックグラウンドタスクで行い、前回の要約に
+    新しくプロンプトから外れた分だけを加えて作り直す。要約済みの発言は
+    プロンプトの履歴に含めない。
+    """
+
+    def __init__(self, shards: ShardedHistory, min_rows: int, max_users: int):
+        self._shards = shards
+        self._min_rows = min_rows
+        self._max_users = max(0, max_users)
+        self._summaries: OrderedDict[str, tuple[str, int]] = OrderedDict()
+        self._tasks: dict[str, asyncio.Task] = {}
+        self._resetting: set[str] = set()
+        self._stopped = False
+        self._runs = 0
+        self._failures = 0
+
+    async def get(self, user_id: str) -> tuple[str, int]:
+        """ユーザーの要約と、要約に含めた最後の履歴のid（無ければ ("", 0)）"""
+        entry = self._summaries.get(user_id)
+        if entry is None:
+            entry = await self._shards.read(user_id, _select_summary, user_id) or ("", 0)
+            self._remember(user_id, entry)
+        else:
+            self._summaries.move_to_end(user_id)
+        return entry
+
+    def _remember(self, user_id: str, entry: tuple[str, int]) -> None:
+        self._summaries[user_id] = entry
+        self._summaries.move_to_end(user_id)
+        while len(self._summaries) > self._max_users:
+            self._summaries.popitem(last=False)
+
+    async def reset(self, user_id: str) -> None:
+        """履歴リセットの前に要約を破棄
+
+        実行中の要約を止めて、それが投入済みの書き込みまで済ませてから戻る。
+        呼び出し側は戻った直後に（awaitを挟まず）履歴の削除を投入すること。
+        """
+        self._resetting.add(user_id)
+        try:
+            task = self._tasks.pop(user_id, None)
+            if task is not None:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+            await self._shards.flush_user(user_id)
+        finally:
+            self._resetting.discard(user_id)
+        self._remember(user_id, ("", 0))
+
+    def schedule(self, user_id: str, window: int = HISTORY_LIMIT) -> None:
+        """要約の更新をバックグラウンドで予約（同じユーザーの更新は同時に1つまで）
+
+        window はプロンプトに残った未要約の最新件数。それより古い未要約の行を要約に畳み込む。
+        """
+        if self._min_rows <= 0 or self._stopped or user_id in self._tasks or user_id in self._resetting:
+            return
+        task = asyncio.create_task(self._update(user_id, window))
+        self._tasks[user_id] = task
+        task.add_done_callback(lambda done: self._forget_task(user_id, done))
+
+    def _forget_task(self, user_id: str, task: asyncio.Task) -> None:
+        if self._tasks.get(user_id) is task:
+            del self._tasks[user_id]
+
+    async def _update(self, user_id: str, window: int) -> None:
+        try:
+            await self._shards.flush_user(user_id)
+            summary, last_id = await self._shards.read(user_id, _select_summary, user_id) or ("", 0)
+            rows = await self._shards.read(
+                user_id, _select_unsummarized, user_id, last_id, window, self._min_rows
+            )
+            if len(rows) < self._min_rows:
+                return
+
+            transcript = "\n".join(
+                f"{'ユーザー' if role == 'user' else 'アシスタント'}: {content}" for _, role, content in rows
+            )
+            messages = [
+                SUMMARY_SYSTEM_MESSAGE,
+                {
+                    "role": "user",
+                    "content": f"【これまでの要約】\n{summary or '(なし)'}\n\n【新しいやり取り】\n{transcript}",
+                },
+            ]
+            new_summary = (await chat_gpt(messages, PRIORITY_BACKGROUND, task="history_summary"))[:SUMMARY_MAX_CHARS * 2]
+            new_last_id = rows[-1][0]
+            await self._shards.submit(user_id, _upsert_summary, user_id, new_summary, new_last_id)
+            self._remember(user_id, (new_summary, new_last_id))
+            # キャッシュに追記した発言はidを持たず要約済みか判定できないので、読み直させる
+            history_cache.invalidate(user_id)
+            self._runs += 1
+            logger.info("会話を要約しました: user_id=%s, rows=%s, chars=%s", user_id, len(rows), len(new_summary))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._failures += 1
+            logger.warning("会話の要約に失敗しました: user_id=%s, error=%s", user_id, e)
+
+    async def stop(self) -> None:
+        """実行中の要約タスクを止める（以降の予約は受け付けない）"""
+        self._stopped = True
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "enabled": self._min_rows > 0,
+            "cached_users": len(self._summaries),
+            "running": len(self._tasks),
+            "runs": self._runs,
+            "failures": self._failures,
+        }
+
+
+conversation_summaries = ConversationSummaries(history_shards, SUMMARY_MIN_ROWS, HISTORY_CACHE_MAX_USERS)
+
+
+class ContextStats:
+    """構築したプロンプトのトークン数の統計"""
+
+    def __init__(self):
+        self.builds = 0
+        self.total_tokens = 0
+        self.max_tokens = 0
+        self.dropped_messages = 0
+
+    def record(self, tokens: int, dropped: int) -> None:
+        self.builds += 1
+        self.total_tokens += tokens
+        self.max_tokens = max(self.max_tokens, tokens)
+        self.dropped_messages += dropped
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "token_budget": CONTEXT_TOKEN_BUDGET,
+            "builds": self.builds,
+            "avg_tokens": round(self.total_tokens / self.builds, 1) if self.builds else 0.0,
+            "max_tokens": self.max_tokens,
+            "dropped_messages": self.dropped_messages,
+        }
+
+
+context_stats = ContextStats()
+
+
+def build_context(
+    history: list[dict[str, str]], user_text: str, summary: str = "", budget: int = CONTEXT_TOKEN_BUDGET
+) -> list[dict[str, str]]:
+    """システムプロンプト・要約・履歴・新しい発言からトークン予算内のプロンプトを組み立てる
+
+    履歴は新しい方から予算に収まるだけ詰め、収まらない古い発言は落とす
+    （落とした発言は、残した件数を ConversationSummaries.schedule に渡して要約に含める）。
+    """
+    system_message = SYSTEM_MESSAGE
+    if summary:
+        system_message = {"role": "system", "content": f"{SYS_PROMPT}\n\n【これまでの会話の要約】\n{summary}"}
+    user_message = {"role": "user", "content": user_text}
+
+    used = estimate_message_tokens(system_message) + estimate_message_tokens(user_message)
+    selected: list[dict[str, str]] = []
+    for message in reversed(history):
+        tokens = estimate_message_tokens(message)
+        if used + tokens > budget:
+            break
+        selected.append(message)
+        used += tokens
+    selected.reverse()
+
+    context_stats.record(used, len(history) - len(selected))
+    return [system_message, *selected, user_message]
+
+
+# ===== 永続キャッシュ =====
+def _cache_get(conn: sqlite3.Connection, namespace: str, key: str) -> tuple[bytes, float] | None:
+    return conn.execute(
+        "SELECT value, created_at FROM cache_entries WHERE namespace = ? AND key = ?", (namespace, key)
+    ).fetchone()
+
+
+def _cache_touch(conn: sqlite3.Connection, namespace: str, key: str, now: float) -> None:
+    conn.execute(
+        "UPDATE cache_entries SET accessed_at = ? WHERE namespace = ? AND key = ?", (now, namespace, key)
+    )
+
+
+def _cache_account(conn: sqlite3.Connection, namespace: str, entries: int, size: int) -> None:
+    conn.execute(
+        "INSERT INTO cache_usage (namespace, entries, bytes) VALUES (?, ?, ?) "
+        "ON CONFLICT(namespace) DO UPDATE SET entries = entries + excluded.entries, bytes = bytes + excluded.bytes",
+        (namespace, entries, size),
+    )
+
+
+def _cache_delete(conn: sqlite3.Connection, namespace: str, key: str) -> None:
+    row = conn.execute(
+        "SELECT size FROM cache_entries WHERE namespace = ? AND key = ?", (namespace, key)
+    ).fetchone()
+    if row is not None:
+        conn.execute("DELETE FROM cache_entries WHERE namespace = ? AND key = ?", (namespace, key))
+        _cache_account(conn, namespace, -1, -row[0])
+
+
+def _cache_usage(conn: sqlite3.Connection, namespace: str) -> tuple[int, int]:
+    row = conn.execute("SELECT entries, bytes FROM cache_usage WHERE namespace = ?", (namespace,)).fetchone()
+    return row or (0, 0)
+
+
+def _cache_evict_lru(conn: sqlite3.Connection, namespace: str, excess: int) -> int:
+    """最後に使われたのが古い順に excess バイト以上を削除して件数を返す（accessed_at のインデックスを使う）"""
+    evicted = freed = 0
+    while freed < excess:
+        rows = conn.execute(
+            "SELECT key, size FROM cache_entries WHERE namespace = ? ORDER BY accessed_at LIMIT 64", (namespace,)
+        ).fetchall()
+        if not rows:
+            break
+        for key, size in rows:
+            conn.execute("DELETE FROM cache_entries WHERE namespace = ? AND key = ?", (namespace, key))
+            evicted += 1
+            freed += size
+            if freed >= excess:
+                break
+    _cache_account(conn, namespace, -evicted, -freed)
+    return evicted
+
+
+def _cache_put(
+    conn: sqlite3.Connection,
+    namespace: str,
+    key: str,
+    value: bytes,
+    now: float,
+    ttl: float,
+    max_bytes: int,
+    evict_lru: bool = True,
+) -> tuple[int, int, int]:
+    """値を保存し、期限切れと（evict_lru なら）容量超過の古いエントリを削除して (削除件数, 件数, 合計サイズ) を返す"""
+    old = conn.execute(
+        "SELECT size FROM cache_entries WHERE namespace = ? AND key = ?", (namespace, key)
+    ).fetchone()
+    conn.execute(
+        "INSERT OR REPLACE INTO cache_entries (namespace, key, value, size, created_at, accessed_at) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        (namespace, key, value, len(value), now, now),
+    )
+    _cache_account(conn, namespace, 0 if old else 1, len(value) - (old[0] if old else 0))
+
+    # 期限切れは created_at のインデックスで該当分だけを消す
+    expired, expired_bytes = conn.execute(
+        "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache_entries WHERE namespace = ? AND created_at < ?",
+        (namespace, now - ttl),
+    ).fetchone()
+    if expired:
+        conn.execute("DELETE FROM cache_entries WHERE namespace = ? AND created_at < ?", (namespace, now - ttl))
+        _cache_account(conn, namespace, -expired, -expired_bytes)
+
+    evicted = expired
+    entries, size = _cache_usage(conn, namespace)
+    if evict_lru and size > max_bytes:
+        evicted += _cache_evict_lru(conn, namespace, size - max_bytes)
+        entries, size = _cache_usage(conn, namespace)
+    return evicted, entries, size
+
+
+class PersistentCache:
+    """SQLiteに保存する名前空間つきのキー・バリューキャッシュ（TTLと合計サイズで追い出す）
+
+    evict_lru=False ならTTLだけで削除し、合計サイズによる追い出しはしない。
+    """
+
+    def __init__(self, store: HistoryStore, namespace: str, ttl: float, max_bytes: int, evict_lru: bool = True):
+        self._store = store
+        self._namespace = namespace
+        self._ttl = ttl
+        self._max_bytes = max_bytes
+        self._evict_lru = evict_lru
+        self._hits = 0
+        self._misses = 0
+        self._sets = 0
+        self._evictions = 0
+        self._entries = 0
+        self._bytes = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._max_bytes > 0 and self._ttl > 0
+
+    async def get(self, key: str) -> bytes | None:
+        """キャッシュされた値（期限切れ・未登録ならNone）"""
+        if not self.enabled:
+            return None
+        row = await self._store.read(_cache_get, self._namespace, key)
+        now = time.time()
+        if row is None or row[1] < now - self._ttl:
+            self._misses += 1
+            if row is not None:
+                await self._store.write(_cache_delete, self._namespace, key)
+            return None
+        self._hits += 1
+        await self._store.write(_cache_touch, self._namespace, key, now)
+        return row[0]
+
+    async def set(self, key: str, value: bytes) -> None:
+        """値を保存（古いエントリは追い出す）"""
+        if not self.enabled:
+            return
+        evicted, self._entries, self._bytes = await self._store.write(
+            _cache_put, self._namespace, key, value, time.time(), self._ttl, self._max_bytes, self._evict_lru
+        )
+        self._sets += 1
+        self._evictions += evicted
+
+    async def get_json(self, key: str) -> Any:
+        value = await self.get(key)
+        return None if value is None else json_loads(value)
+
+    async def set_json(self, key: str, value: Any) -> None:
+        await self.set(key, json_dumps(value))
+
+    def stats(self) -> dict[str, Any]:
+        lookups = self._hits + self._misses
+        return {
+            "enabled": self.enabled,
+            "entries": self._entries,
+            "bytes": self._bytes,
+            "max_bytes": self._max_bytes,
+            "hits": self._hits,
+            "misses": self._misses,
+            "sets": self._sets,
+            "evictions": self._evictions,
+            "hit_rate": round(self._hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+cache_store = HistoryStore(CACHE_DB_PATH, name="cache")
+image_analysis_cache = PersistentCache(
+    cache_store, "image_analysis", IMAGE_CACHE_TTL_DAYS * 86400, int(IMAGE_CACHE_MAX_MB * 1024 * 1024)
+)
+
+
+def image_cache_key(image_hash: bytes, messages: list[dict[str, Any]], model: str) -> str:
+    """正規化済み画像のハッシュとプロンプト（モデル・指示文）から作るキャッシュキー"""
+    digest = hashlib.sha256()
+    digest.update(model.encode() + b"\0")
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, str):
+            digest.update(content.encode())
+        else:
+            for part in content:
+                if part.get("type") == "text":
+                    digest.update(part["text"].encode())
+        digest.update(b"\0")
+    digest.update(image_hash)
+    return digest.hexdigest()
+
+
+# ===== 回答キャッシュ =====
+_TRAILING_PUNCTUATION = re.compile(r"[\s。、.,!?…~・]+$")
+
+
+def normalize_prompt_text(text: str) -> str:
+    """全角・半角、大文字・小文字、空白の連続、末尾の句読点の違いをならした発言"""
+    text = " ".join(unicodedata.normalize("NFKC", text).casefold().split())
+    return _TRAILING_PUNCTUATION.sub("", text)
+
+
+class AnswerCache:
+    """履歴に依存しない発言（システムプロンプト + 発言だけのプロンプト）への回答キャッシュ
+
+    キーはモデル・システムプロンプト・正規化した発言。保存先は PersistentCache なので
+    TTLで失効し、合計サイズを超えると最後に使われた時刻が古いものから追い出される。
+    """
+
+    def __init__(self, cache: PersistentCache, max_chars: int):
+        self._cache = cache
+        self._max_chars = max_chars
+
+    def key(self, text: str, model: str, system_prompt: str = SYS_PROMPT) -> str | None:
+        """キャッシュキー（キャッシュしない発言ならNone）"""
+        normalized = normalize_prompt_text(text)
+        if not self._cache.enabled or not normalized or len(normalized) > self._max_chars:
+            return None
+        digest = hashlib.sha256()
+        for part in (model, system_prompt, normalized):
+            digest.update(part.encode())
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    async def get(self, key: str) -> str | None:
+        value = await self._cache.get(key)
+        answer_cache_lookups.inc(result="miss" if value is None else "hit")
+        return None if value is None else value.decode()
+
+    async def set(self, key: str, answer: str) -> None:
+        await self._cache.set(key, answer.encode())
+
+    def stats(self) -> dict[str, Any]:
+        return {**self._cache.stats(), "max_chars": self._max_chars}
+
+
+answer_cache = AnswerCache(
+    PersistentCache(
+        cache_store, "text_answers", ANSWER_CACHE_TTL_HOURS * 3600, int(ANSWER_CACHE_MAX_MB * 1024 * 1024)
+    ),
+    ANSWER_CACHE_MAX_CHARS,
+)
+
+
+# ===== 署名検証 =====
+def verify_signature(body: bytes, signature: str) -> bool:
+    """LINE署名を検証"""
+    if not CHANNEL_SECRET:
+        return True  # シークレット未設定時はスキップ（開発用）
+
+    computed = base64.b64encode(
+        hmac.new(CHANNEL_SECRET.encode(), body, hashlib.sha256).digest()
+    ).decode()
+    return hmac.compare_digest(signature, computed)
+
+
+# ===== LINEコンテンツ取得 =====
+@asynccontextmanager
+async def _open_line_content(message_id: str, retry_count: int = 3) -> AsyncIterator[httpx.Response]:
+    path = f"/v2/bot/message/{message_id}/content"
+    url = f"{UPSTREAMS['line_data'].base_url}{path}"
+    headers = {"Authorization": f"Bearer {ACCESS_TOKEN}"}
+    client = upstream.get("line_data")
+
+    content_logger.info("LINE content fetch: message_id=%s", message_id)
+    content_logger.debug("URL: %s", url)
+
+    last_error = None
+    retry_reason = ""
+
+    for attempt in range(retry_count):
+        if attempt > 0:
+            wait_time = attempt * 0.5  # 0.5秒, 1秒と待機時間を増やす
+            content_logger.info("Retry %s/%s after %ss wait...", attempt + 1, retry_count, wait_time)
+            stage_retries.inc(stage="content_fetch", model="", reason=retry_reason)
+            await asyncio.sleep(wait_time)
+
+        try:
+            res = await client.send(client.build_request("GET", path, headers=headers), stream=True)
+        except Exception as e:
+            last_error, retry_reason = str(e), "transport"
+            logger.warning("Attempt %s exception: %s", attempt + 1, last_error)
+            continue
+
+        content_logger.debug(
+            "LINE response (attempt %s): status=%s, content-type=%s, content-length=%s, request-id=%s",
+            attempt + 1,
+            res.status_code,
+            res.headers.get("content-type"),
+            res.headers.get("content-length"),
+            res.headers.get("x-line-request-id"),
+        )
+
+        if res.status_code == 200:
+            # 本文の読み込み中に起きた例外はリトライせず呼び出し元に返す
+            try:
+                yield res
+            finally:
+                await res.aclose()
+            return
+
+        # 404の場合は詳細なエラー情報を記録
+        await res.aread()
+        await res.aclose()
+        error_body = res.text[:500] if res.text else "No body"
+        last_error, retry_reason = f"Status {res.status_code}: {error_body}", str(res.status_code)
+        logger.warning("Attempt %s failed: %s", attempt + 1, last_error)
+
+    # すべてのリトライが失敗
+    logger.error("All %s attempts failed. Last error: %s", retry_count, last_error)
+    raise HTTPException(
+        status_code=502,
+        detail=f"LINE content取得に失敗しました（{retry_count}回試行）。\n\n考えられる原因:\n1. アクセストークンの権限不足\n2. メッセージIDが無効\n\n最後のエラー: {last_error}"
+    )
 
 
-init_db()
+@asynccontextmanager
+async def open_line_content(message_id: str, retry_count: int = 3) -> AsyncIterator[httpx.Response]:
+    """LINE画像/音声コンテンツのレスポンスを本文を読まずに開く（リトライ機能付き）
 
+    with ブロックを抜けるまで（本文の読み込みを含めて）を content_fetch の所要時間として記録する。
+    """
+    with stage_timer("content_fetch"):
+        async with _open_line_content(message_id, retry_count) as res:
+            yield res
 
-# ===== データストア操作 =====
-async def get_history(user_id: str) -> list[dict[str, str]]:
-    """会話履歴を取得（最新20件 = 10往復）"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT role, content FROM chat_history WHERE user_id = ? ORDER BY timestamp DESC LIMIT 20",
-        (user_id,)
+
+async def iter_content(res: httpx.Response, max_bytes: int | None = None) -> AsyncIterator[bytes]:
+    """レスポンス本文をチャンクごとに返し、max_bytes を超えたら打ち切る"""
+    declared = int(res.headers.get("content-length") or 0)
+    if max_bytes is not None and declared > max_bytes:
+        raise HTTPException(status_code=413, detail=f"コンテンツが大きすぎます（{declared} bytes）")
+    size = 0
+    async for chunk in res.aiter_bytes():
+        size += len(chunk)
+        if max_bytes is not None and size > max_bytes:
+            raise HTTPException(status_code=413, detail=f"コンテンツが大きすぎます（{max_bytes} bytes超）")
+        yield chunk
+
+
+async def fetch_line_content(
+    message_id: str, retry_count: int = 3, max_bytes: int | None = None
+) -> tuple[bytes, str]:
+    """LINE画像/音声コンテンツを取得（リトライ機能付き）
+
+    本文はストリーミングで読み、max_bytes を超えた時点で打ち切る。
+    """
+    async with open_line_content(message_id, retry_count) as res:
+        mime = res.headers.get("content-type", "application/octet-stream")
+        content = b"".join([chunk async for chunk in iter_content(res, max_bytes)])
+        content_logger.info("Success: size=%s bytes, mime=%s", len(content), mime)
+        return content, mime
+
+
+# ===== 画像の取り込み =====
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow未導入なら縮小せずにそのまま送る
+    Image = None
+    ImageOps = None
+
+
+class MemoryBudget:
+    """同時にデコードする画像の枚数と推定メモリ量を制限する"""
+
+    def __init__(self, max_bytes: int, max_concurrency: int):
+        self._max_bytes = max(1, max_bytes)
+        self._max_concurrency = max(1, max_concurrency)
+        self._used = 0
+        self._active = 0
+        self._peak = 0
+        self._waits = 0
+        self._condition: asyncio.Condition | None = None
+
+    @asynccontextmanager
+    async def reserve(self, cost: int):
+        """cost バイト分の枠を確保（1枚で上限を超える画像は単独で処理する）"""
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        cost = min(cost, self._max_bytes)
+        async with self._condition:
+            if self._active >= self._max_concurrency or self._used + cost > self._max_bytes:
+                self._waits += 1
+            await self._condition.wait_for(
+                lambda: self._active < self._max_concurrency and self._used + cost <= self._max_bytes
+            )
+            self._used += cost
+            self._active += 1
+            self._peak = max(self._peak, self._used)
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self._used -= cost
+                self._active -= 1
+                self._condition.notify_all()
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "budget_bytes": self._max_bytes,
+            "max_concurrency": self._max_concurrency,
+            "used_bytes": self._used,
+            "active": self._active,
+            "peak_bytes": self._peak,
+            "waits": self._waits,
+        }
+
+
+image_decode_budget = MemoryBudget(IMAGE_DECODE_MEMORY_MB * 1024 * 1024, IMAGE_DECODE_CONCURRENCY)
+image_stats = {"images": 0, "bytes_in": 0, "bytes_out": 0, "resized": 0}
+
+
+def _vision_scale(width: int, height: int) -> float:
+    """Visionモデル（detail=high）が実際に使う解像度に収める縮小率"""
+    long_side, short_side = max(width, height), min(width, height)
+    return min(1.0, VISION_MAX_LONG_SIDE / long_side, VISION_MAX_SHORT_SIDE / short_side)
+
+
+def _downscale_image(content: bytes, mime: str) -> tuple[bytes, str]:
+    """画像を縮小してJPEGに再圧縮（別スレッドで実行する）"""
+    with Image.open(io.BytesIO(content)) as img:
+        width, height = img.size
+        scale = _vision_scale(width, height)
+        # JPEGは縮小後のサイズに近い解像度でデコードしてメモリを節約する（回転前の向きで指定する）
+        img.draft("RGB", (max(1, round(width * scale)), max(1, round(height * scale))))
+        # 縦向きの写真は回転してから縮小後のサイズを決める
+        img = ImageOps.exif_transpose(img)
+        if img.mode not in ("RGB", "L"):
+            background = Image.new("RGB", img.size, (255, 255, 255))
+            background.paste(img, mask=img.convert("RGBA").getchannel("A"))
+            img = background
+        if scale < 1.0:
+            decoded_scale = _vision_scale(*img.size)
+            target = (max(1, round(img.width * decoded_scale)), max(1, round(img.height * decoded_scale)))
+            if img.size != target:
+                img = img.resize(target, Image.LANCZOS)
+        out = io.BytesIO()
+        img.save(out, format="JPEG", quality=VISION_JPEG_QUALITY, optimize=True)
+    if scale >= 1.0 and out.tell() >= len(content) and mime in ("image/jpeg", "image/png"):
+        # 縮小不要で再圧縮しても小さくならないなら元のまま送る
+        return content, mime
+    return out.getvalue(), "image/jpeg"
+
+
+async def prepare_image_for_vision(content: bytes, mime: str) -> tuple[bytes, str]:
+    """Visionモデルに送る前に画像を縮小・再圧縮する（デコードはメモリ予算内で並列数を制限）"""
+    image_stats["images"] += 1
+    image_stats["bytes_in"] += len(content)
+    if Image is None:
+        image_stats["bytes_out"] += len(content)
+        return content, mime
+
+    try:
+        with Image.open(io.BytesIO(content)) as header:
+            width, height = header.size
+    except Exception as e:
+        logger.warning("画像を解析できないため元のまま送ります: %s", e)
+        image_stats["bytes_out"] += len(content)
+        return content, mime
+
+    # 展開後のRGBAビットマップ相当をデコードに必要なメモリとして見積もる
+    async with image_decode_budget.reserve(width * height * 4):
+        result, result_mime = await asyncio.to_thread(_downscale_image, content, mime)
+    image_stats["bytes_out"] += len(result)
+    if result is not content:
+        image_stats["resized"] += 1
+    logger.info("画像を縮小しました: %sx%s, %s -> %s bytes", width, height, len(content), len(result))
+    return result, result_mime
+
+
+def build_data_url(content: bytes, mime: str) -> str:
+    """base64の data URL を1回のエンコードと1回の連結で作る"""
+    return f"data:{mime};base64," + base64.b64encode(content).decode("ascii")
+
+
+# ===== 画像解析プロンプト =====
+IMAGE_SYSTEM_PROMPT = SYS_PROMPT + """
+
+画像が送られたら、以下の形式で対応してください：
+
+1. **問題の画像の場合**（数学、英語、プログラミングなど）:
+   - 問題を理解して、丁寧な解説を提供
+   - 回答例を示す
+   - 解き方の手順を説明
+   - 重要なポイントを指摘
+
+2. **一般的な画像の場合**:
+   - 画像の内容を簡潔に説明
+
+判断基準:
+- 文字や数式が多い → 問題の可能性が高い
+- 「問」「解答」「問題」などの文字がある → 問題
+- 教科書やノートの写真 → 問題の可能性あり
+
+【重要】表記ルール:
+
+▼ 数式の書き方
+• LaTeX形式（\\(, \\), \\[, \\], $など）は絶対に使わない
+• バックスラッシュ（\\）は一切使わない
+• 累乗: x² または x^2
+• 分数: 1/2
+• 根号: √
+• プレーンテキストで読みやすく
+
+▼ 箇条書きの書き方
+• ハイフン（-）やアスタリスク（*）は使わない
+• 代わりに「•」（黒丸）または数字を使う
+• 例: • 項目1　• 項目2
+
+▼ 数式の良い例・悪い例
+❌ 悪い例: \\(x^2 + 2x + 1\\)
+✅ 良い例: x² + 2x + 1 または x^2 + 2x + 1
+❌ 悪い例: - 計算手順（行頭にハイフン）
+✅ 良い例: • 計算手順 または 1. 計算手順"""
+
+IMAGE_REQUEST_TEXT = """この画像を分析してください。
+
+もし問題（数学、英語、プログラミングなど）であれば:
+1. 問題の内容を確認
+2. 解き方の手順を説明
+3. 回答例を提示
+4. 重要なポイントを指摘
+
+一般的な画像であれば、内容を簡潔に説明してください。"""
+
+IMAGE_SYSTEM_MESSAGE = PrebuiltMessage("system", IMAGE_SYSTEM_PROMPT)
+IMAGE_REQUEST_PART = {"type": "text", "text": IMAGE_REQUEST_TEXT}
+
+
+# ===== 音声の文字起こし =====
+AUDIO_CHUNK_SIZE = 64 * 1024
+transcription_cache = PersistentCache(
+    cache_store,
+    "transcription",
+    TRANSCRIPTION_CACHE_TTL_DAYS * 86400,
+    int(TRANSCRIPTION_CACHE_MAX_MB * 1024 * 1024),
+)
+audio_stats: dict[str, Any] = {"messages": 0, "cache_hits": 0, "bytes": 0, "stage_ms": {}}
+
+
+def record_audio_timings(timings: dict[str, float]) -> None:
+    """音声処理の段階ごとの所要時間を集計してログに残す"""
+    for stage, seconds in timings.items():
+        audio_stats["stage_ms"][stage] = audio_stats["stage_ms"].get(stage, 0.0) + seconds * 1000
+    event_logger.info("音声処理の所要時間: %s", ", ".join(f"{k}={v * 1000:.0f}ms" for k, v in timings.items()))
+
+
+class SpooledUpload:
+    """一時ファイルの内容を head と tail で挟んで送るリクエスト本文
+
+    読み出しは別スレッドで行い、送るたびに先頭から読み直すので再試行でもそのまま使える。
+    """
+
+    def __init__(self, head: bytes, spool: Any, tail: bytes):
+        self._head = head
+        self._spool = spool
+        self._tail = tail
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        yield self._head
+        await asyncio.to_thread(self._spool.seek, 0)
+        while chunk := await asyncio.to_thread(self._spool.read, AUDIO_CHUNK_SIZE):
+            yield chunk
+        yield self._tail
+
+
+async def transcribe_spooled_audio(spool: Any, size: int) -> str | None:
+    """一時ファイルに溜めた音声をWhisper APIへmultipartでストリーミング送信して文字起こしする"""
+    boundary = os.urandom(16).hex()
+    head = (
+        f"--{boundary}\r\n"
+        'Content-Disposition: form-data; name="model"\r\n\r\n'
+        "whisper-1\r\n"
+        f"--{boundary}\r\n"
+        'Content-Disposition: form-data; name="file"; filename="audio.m4a"\r\n'
+        "Content-Type: audio/mp4\r\n\r\n"
+    ).encode()
+    tail = f"\r\n--{boundary}--\r\n".encode()
+
+    headers = {
+        "Authorization": f"Bearer {OPENAI_KEY}",
+        "Content-Type": f"multipart/form-data; boundary={boundary}",
+        # LINEが申告した長さではなく、実際に受け取ったバイト数から計算する
+        "Content-Length": str(len(head) + size + len(tail)),
+    }
+    res = await openai_scheduler.post(
+        "whisper-1", "/v1/audio/transcriptions", headers=headers, content=SpooledUpload(head, spool, tail)
     )
-    rows = cursor.fetchall()
-    conn.close()
+    return json_loads(res.content).get("text")
 
-    # 新しい順に取得したので逆順にして返す
-    history = [{"role": role, "content": content} for role, content in reversed(rows)]
-    return history
 
+async def transcribe_line_audio(message_id: str, timings: dict[str, float]) -> str | None:
+    """LINEの音声を文字起こしする（同じ音声の文字起こしはキャッシュから返す）
 
-async def save_to_history(user_id: str, role: str, content: str) -> None:
-    """会話履歴に追加"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT INTO chat_history (user_id, role, content) VALUES (?, ?, ?)",
-        (user_id, role, content)
+    ダウンロードを一時ファイル（小さければメモリ）に流しながらハッシュを計算し、
+    キャッシュにない音声だけをそこからWhisperへ流す。一時ファイルの読み書きは別スレッドで行う。
+    """
+    audio_stats["messages"] += 1
+    started = time.perf_counter()
+
+    cache_key = None
+    with tempfile.SpooledTemporaryFile(max_size=AUDIO_SPOOL_MEMORY) as spool:
+        digest = hashlib.sha256()
+        size = 0
+        async with open_line_content(message_id) as res:
+            async for chunk in iter_content(res, AUDIO_MAX_BYTES):
+                digest.update(chunk)
+                await asyncio.to_thread(spool.write, chunk)
+                size += len(chunk)
+        audio_stats["bytes"] += size
+        timings["download"] = time.perf_counter() - started
+
+        if transcription_cache.enabled:
+            cache_key = f"whisper-1:{digest.hexdigest()}"
+            cached = await transcription_cache.get(cache_key)
+            if cached is not None:
+                audio_stats["cache_hits"] += 1
+                timings["cache"] = time.perf_counter() - started - timings["download"]
+                return cached.decode()
+
+        transcribe_started = time.perf_counter()
+        text = await transcribe_spooled_audio(spool, size)
+        timings["transcribe"] = time.perf_counter() - transcribe_started
+
+    if text is not None and cache_key is not None:
+        await transcription_cache.set(cache_key, text.encode())
+    return text
+
+
+# ===== ChatGPT API =====
+NO_ANSWER_TEXT = "すみません、応答できませんでした。"
+
+
+async def chat_gpt(
+    messages: list[dict[str, Any]],
+    priority: int = PRIORITY_INTERACTIVE,
+    task: str = "chat",
+    model: str | None = None,
+) -> str:
+    """ChatGPT APIを呼び出し（model を省略したら task から振り分ける）"""
+    model = model or model_router.select(task, messages)
+    # gpt-5系はtemperature=1のみサポート（デフォルト値なので省略）
+    payload = encode_chat_payload(model, messages)
+
+    started = time.perf_counter()
+    res = await openai_scheduler.post(
+        model,
+        "/v1/chat/completions",
+        priority=priority,
+        tokens=estimate_request_tokens(messages),
+        headers=OPENAI_JSON_HEADERS,
+        content=payload,
     )
-    conn.commit()
-    conn.close()
+    model_router.observe(model, time.perf_counter() - started)
+    data = json_loads(res.content)
 
+    if "error" in data:
+        raise HTTPException(
+            status_code=502,
+            detail=data["error"].get("message", "OpenAI API error")
+        )
+
+    return (
+        data.get("choices", [{}])[0]
+        .get("message", {})
+        .get("content", "")
+        .strip()
+        or NO_ANSWER_TEXT
+    )
+
+
+class StreamingUnsupported(HTTPException):
+    """ストリーミングのリクエスト自体が拒否された（400/404。通常の呼び出しなら通る可能性がある）"""
+
+
+async def chat_gpt_stream(messages: list[dict[str, Any]], model: str) -> AsyncIterator[str]:
+    """ChatGPT APIをストリーミングで呼び出し、本文の差分を順に返す"""
+    payload = encode_chat_payload(model, messages, stream=True)
+
+    started = time.perf_counter()
+    async with openai_scheduler.stream(
+        model,
+        "/v1/chat/completions",
+        tokens=estimate_request_tokens(messages),
+        headers=OPENAI_JSON_HEADERS,
+        content=payload,
+    ) as res:
+        if res.status_code != 200:
+            await res.aread()
+            try:
+                message = json_loads(res.content).get("error", {}).get("message", "OpenAI API error")
+            except ValueError:
+                message = f"OpenAI API error: status={res.status_code}"
+            # 429/5xx はスケジューラで再試行済みなので、通常の呼び出しでやり直さずにそのまま失敗させる
+            if res.status_code in (400, 404):
+                raise StreamingUnsupported(status_code=502, detail=message)
+            raise HTTPException(status_code=502, detail=message)
+
+        # Server-Sent Events: "data: {...}" の行が続き、"data: [DONE]" で終わる
+        async for line in res.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            data = line[5:].strip()
+            if data == "[DONE]":
+                break
+            chunk = json_loads(data)
+            if "error" in chunk:
+                raise HTTPException(status_code=502, detail=chunk["error"].get("message", "OpenAI API error"))
+            for choice in chunk.get("choices", []):
+                delta = choice.get("delta", {}).get("content")
+                if delta:
+                    yield delta
+    model_router.observe(model, time.perf_counter() - started)
+
+
+async def _produce_completion(messages: list[dict[str, Any]], parts: list[str], model: str) -> str:
+    """応答を parts に少しずつ溜めながら生成し、全文を返す"""
+    if OPENAI_STREAMING:
+        try:
+            async for delta in chat_gpt_stream(messages, model):
+                parts.append(delta)
+        except StreamingUnsupported as e:
+            # ストリーミングできないモデル・組織の場合は通常の呼び出しに切り替える
+            logger.warning("ストリーミングに失敗したため通常の呼び出しに切り替えます: %s", e.detail)
+            parts.append(await chat_gpt(messages, model=model))
+    else:
+        parts.append(await chat_gpt(messages, model=model))
+    return "".join(parts).strip() or NO_ANSWER_TEXT
+
+
+class PartialReplyError(Exception):
+    """返信期限に途中までを reply で送った後で生成に失敗した（reply token は使用済み）"""
+
+
+async def complete_and_reply(
+    messages: list[dict[str, Any]],
+    reply_token: str,
+    push_to: str | None,
+    deadline: float,
+    model: str,
+) -> str:
+    """応答を model で生成してLINEに送り、全文を返す
+
+    deadline（time.monotonic()基準）までに生成が終われば reply で全文を返す。
+    間に合わなければその時点までの文章を reply で送り、残りは生成完了後に push で送る。
+    """
+    parts: list[str] = []
+    producer = asyncio.create_task(_produce_completion(messages, parts, model))
+    try:
+        done, _ = await asyncio.wait({producer}, timeout=max(0.0, deadline - time.monotonic()))
+    except asyncio.CancelledError:
+        producer.cancel()
+        raise
+
+    if producer in done:
+        text = producer.result()
+        if not await reply_to_line(reply_token, text):
+            await push_to_line(push_to, text)
+        return text
+
+    # 返信期限に間に合わない: 区切りの良いところまでを reply で先に送る
+    # 先頭の空白・改行を除いた位置から区切り、続きも同じ位置から切り出す
+    raw = "".join(parts)
+    start = len(raw) - len(raw.lstrip())
+    partial = raw[start:]
+    cut = natural_cut(partial)
+    logger.info("返信期限に到達: partial_chars=%s, sent_chars=%s", len(partial), cut)
+    if cut:
+        replied = await reply_to_line(reply_token, partial[:cut].rstrip() + "\n（続きを送信します）")
+    else:
+        replied = await reply_to_line(reply_token, "回答を作成中です。少々お待ちください。")
+
+    try:
+        text = await producer
+    except Exception as e:
+        raise PartialReplyError(str(e)) from e
+    # reply 自体が失敗していたら全文を push する
+    await push_to_line(push_to, "".join(parts)[start + cut:].strip() if replied and cut else text)
+    return text
+
+
+# ===== DALL-E 3 画像生成 =====
+async def generate_image_with_dalle(prompt: str, response_format: str = "url") -> str:
+    """DALL-E 3で画像を生成してURLを返す（response_format="b64_json" ならbase64文字列）"""
+    payload = {
+        "model": "dall-e-3",
+        "prompt": prompt,
+        "n": 1,
+        "size": "1024x1024",
+        "quality": "standard",
+        "response_format": response_format,
+    }
+
+    logger.info("DALL-E 3画像生成開始: prompt=%s...", prompt[:100])
+
+    res = await openai_scheduler.post(
+        "dall-e-3",
+        "/v1/images/generations",
+        priority=PRIORITY_IMAGE_GENERATION,
+        headers=OPENAI_JSON_HEADERS,
+        content=json_dumps(payload),
+        timeout=upstream.timeout("openai", DALLE_READ_TIMEOUT),
+    )
+    data = json_loads(res.content)
+
+    if "error" in data:
+        logger.error("DALL-E 3エラー: %s", data["error"])
+        raise HTTPException(
+            status_code=502,
+            detail=data["error"].get("message", "DALL-E 3 API error")
+        )
+
+    if response_format == "b64_json":
+        image_b64 = data.get("data", [{}])[0].get("b64_json", "")
+        logger.info("DALL-E 3画像生成完了: b64_length=%s", len(image_b64))
+        return image_b64
+
+    image_url = data.get("data", [{}])[0].get("url", "")
+    logger.info("DALL-E 3画像生成完了: url=%s", image_url)
+    return image_url
+
+
+# ===== LINE返信 =====
+LINE_TEXT_LIMIT = 4999  # 1メッセージの最大文字数
+LINE_MAX_MESSAGES = 5  # 1回の reply / push で送れるメッセージ数
+# 長文を分割するときの区切り（優先度順）
+SPLIT_BOUNDARIES = ("\n\n", "\n", "。", "！", "？", "!", "?", ". ", "、", " ")
+TRUNCATION_NOTICE = "…（文字数の上限のため以降は省略しました）"
+
+
+def natural_cut(text: str, limit: int | None = None) -> int:
+    """text[:limit] の中で最も区切りの良い位置を返す（後半に区切りが無ければ limit）"""
+    if limit is None or limit >= len(text):
+        limit = len(text)
+        floor = 0
+    else:
+        floor = limit // 2
+    for boundary in SPLIT_BOUNDARIES:
+        index = text.rfind(boundary, floor, limit)
+        if index != -1:
+            return index + len(boundary)
+    return limit if floor else 0
+
+
+def split_message(text: str, limit: int = LINE_TEXT_LIMIT, max_messages: int = LINE_MAX_MESSAGES) -> list[str]:
+    """長文を区切りの良い位置で最大 max_messages 件に分割（収まらない分は省略）"""
+    chunks: list[str] = []
+    rest = text
+    while rest and len(chunks) < max_messages:
+        if len(rest) <= limit:
+            chunks.append(rest)
+            rest = ""
+            break
+        cut = natural_cut(rest, limit)
+        chunks.append(rest[:cut].rstrip())
+        rest = rest[cut:].lstrip()
+    if rest:
+        chunks[-1] = chunks[-1][: limit - len(TRUNCATION_NOTICE)] + TRUNCATION_NOTICE
+    return chunks or [text]
+
+
+def push_target(event: dict[str, Any]) -> str | None:
+    """push で送る宛先（グループ・ルームならそこ、1対1ならユーザー）"""
+    source = event.get("source", {})
+    return source.get("groupId") or source.get("roomId") or source.get("userId")
+
+
+async def post_to_line(path: str, payload: dict[str, Any]) -> httpx.Response:
+    """LINE Messaging API にJSONをPOSTする（所要時間と失敗をメトリクスに記録）"""
+    with stage_timer("line_reply"):
+        res = await upstream.get("line").post(path, headers=LINE_JSON_HEADERS, content=json_dumps(payload))
+    if res.status_code != 200:
+        stage_errors.inc(stage="line_reply", msg_type=current_msg_type.get(), model="")
+    return res
+
+
+async def reply_to_line(reply_token: str, text: str) -> bool:
+    """LINEにテキストメッセージを返信（長文は最大5件に分割）。成功したらTrue"""
+    payload = {
+        "replyToken": reply_token,
+        "messages": [{"type": "text", "text": chunk} for chunk in split_message(text)],
+    }
+
+    res = await post_to_line("/v2/bot/message/reply", payload)
+    if res.status_code != 200:
+        logger.warning("LINE返信エラー: status=%s, body=%s", res.status_code, res.text[:200])
+        return False
+    return True
+
+
+async def push_to_line(to: str | None, text: str) -> bool:
+    """reply token が使えないときに push API でテキストを送信。成功したらTrue"""
+    if not text:
+        return True
+    if not PUSH_FALLBACK or not to:
+        logger.warning("push送信できないため応答を破棄しました: chars=%s", len(text))
+        return False
+    payload = {
+        "to": to,
+        "messages": [{"type": "text", "text": chunk} for chunk in split_message(text)],
+    }
+
+    res = await post_to_line("/v2/bot/message/push", payload)
+    if res.status_code != 200:
+        logger.error("LINE push エラー: status=%s, body=%s", res.status_code, res.text[:200])
+        return False
+    return True
+
+
+async def reply_image_to_line(reply_token: str, image_url: str, preview_url: str = None) -> None:
+    """LINEに画像メッセージを返信"""
+    payload = {
+        "replyToken": reply_token,
+        "messages": [
+            {
+                "type": "image",
+                "originalContentUrl": image_url,
+                "previewImageUrl": preview_url or image_url,
+            }
+        ],
+    }
+
+    logger.info("LINE画像返信: image_url=%s", image_url)
+
+    res = await post_to_line("/v2/bot/message/reply", payload)
+    logger.info("LINE画像返信レスポンス: status=%s", res.status_code)
+    if res.status_code != 200:
+        logger.error("LINE画像返信エラー: %s", res.text)
+
+
+# ===== スタンプ応答キャッシュ =====
+STICKER_ANALYSIS_PROMPT = """あなたはスタンプ画像を分析し、それに応じた画像生成プロンプトを作成する専門家です。
+
+スタンプの感情や雰囲気を読み取り、それに応えるような画像の説明を英語で簡潔に出力してください。
+
+【重要】出力形式:
+- 英語のプロンプトのみ出力（1-2文、最大70単語）
+- 日本語の説明は不要
+- DALL-E 3で生成しやすいシンプルな描写
+- 感情を視覚的に表現
+- **画像内に英語テキストメッセージを含める**: 感情に応じた短い英語メッセージ（2-5単語）を画像に入れる指示を含める
+
+例:
+- 喜び → "A cheerful cartoon character jumping with joy, bright colors, happy atmosphere, with English text 'You did it!' displayed prominently"
+- 悲しみ → "A cute character sitting under rain clouds, soft pastel colors, melancholic mood, with English text 'It's okay' in gentle font"
+- 愛情 → "Two adorable characters hugging with hearts around them, warm pink tones, with English text 'Thank you♡' in decorative style"
+- 応援 → "An energetic character cheering with pom-poms, vibrant colors, motivational scene, with English text 'Go for it!' in bold letters"
+- 感謝 → "Cute character bowing with sparkles, warm orange tones, with English text 'Thanks!' in elegant font"
+- 励まし → "Supportive character with warm smile, gentle colors, with English text 'You got this!' in friendly font"
+"""
+STICKER_ANALYSIS_REQUEST = "このスタンプの感情を読み取り、それに応える画像のプロンプトを英語で作成してください。感情に合った短い英語メッセージ（2-5単語）を画像内に入れる指示も含めてください。"
+STICKER_SYSTEM_MESSAGE = PrebuiltMessage("system", STICKER_ANALYSIS_PROMPT)
+STICKER_REQUEST_PART = {"type": "text", "text": STICKER_ANALYSIS_REQUEST}
 
-async def reset_history(user_id: str) -> None:
-    """会話履歴をリセット"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM chat_history WHERE user_id = ?", (user_id,))
-    conn.commit()
-    conn.close()
 
+def sticker_image_url(sticker_id: str) -> str:
+    """LINEの公式スタンプ画像URL"""
+    return f"https://stickershop.line-scdn.net/stickershop/v1/sticker/{sticker_id}/android/sticker.png"
 
-async def get_history_count(user_id: str) -> int:
-    """会話履歴の件数を取得"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT COUNT(*) FROM chat_history WHERE user_id = ?",
-        (user_id,)
-    )
-    count = cursor.fetchone()[0]
-    conn.close()
-    return count
 
+def sticker_analysis_messages(sticker_url: str) -> list[dict[str, Any]]:
+    """スタンプ画像からDALL-E用プロンプトを作らせるメッセージ"""
+    return [
+        STICKER_SYSTEM_MESSAGE,
+        {
+            "role": "user",
+            "content": [
+                STICKER_REQUEST_PART,
+                {
+                    "type": "image_url",
+                    "image_url": {"url": sticker_url},
+                },
+            ],
+        },
+    ]
 
-# ===== 署名検証 =====
-def verify_signature(body: bytes, signature: str) -> bool:
-    """LINE署名を検証"""
-    if not CHANNEL_SECRET:
-        return True  # シークレット未設定時はスキップ（開発用）
 
-    computed = base64.b64encode(
-        hmac.new(CHANNEL_SECRET.encode(), body, hashlib.sha256).digest()
-    ).decode()
-    return hmac.compare_digest(signature, computed)
+def _encode_sticker_images(png: bytes) -> tuple[bytes, bytes]:
+    """DALL-Eの画像をLINEに送れるJPEG（本体・プレビュー）に変換（別スレッドで実行する）"""
+    with Image.open(io.BytesIO(png)) as img:
+        img = img.convert("RGB")
+        original = io.BytesIO()
+        img.save(original, format="JPEG", quality=90, optimize=True)
+        img.thumbnail((STICKER_PREVIEW_SIZE, STICKER_PREVIEW_SIZE))
+        preview = io.BytesIO()
+        img.save(preview, format="JPEG", quality=80, optimize=True)
+    return original.getvalue(), preview.getvalue()
 
 
-# ===== LINEコンテンツ取得 =====
-async def fetch_line_content(message_id: str, retry_count: int = 3) -> tuple[bytes, str]:
-    """LINE画像/音声コンテンツを取得（リトライ機能付き）"""
-    import asyncio
+class StickerResponseCache:
+    """スタンプ（packageId:stickerId）ごとにDALL-E用プロンプトと生成画像を保存する
 
-    url = f"https://api-data.line.me/v2/bot/message/{message_id}/content"
-    headers = {"Authorization": f"Bearer {ACCESS_TOKEN}"}
+    生成画像は自前の /media/stickers/ から配信する（DALL-EのURLは1時間ほどで失効するため）。
+    1つのスタンプにつき STICKER_CACHE_VARIANTS 枚まで生成し、揃った後は
+    その中からランダムに選んで返す。
+    """
 
-    logger.info(f"LINE content fetch: message_id={message_id}")
-    logger.info(f"URL: {url}")
-    logger.info(f"Token prefix: {ACCESS_TOKEN[:20]}..." if ACCESS_TOKEN else "No token")
+    def __init__(self, entries: PersistentCache, images: PersistentCache, variants: int):
+        self._entries = entries
+        self._images = images
+        self._variants = max(1, variants)
+        self._uses: dict[str, int] = {}
+        self._locks: dict[str, asyncio.Lock] = {}
+        self._hits = 0
+        self._misses = 0
 
-    last_error = None
+    @property
+    def can_rehost(self) -> bool:
+        """生成画像を自前で配信できるか（公開URLとPillowが必要）"""
+        return bool(PUBLIC_BASE_URL) and Image is not None and self._images.enabled
 
-    for attempt in range(retry_count):
-        try:
-            if attempt > 0:
-                wait_time = attempt * 0.5  # 0.5秒, 1秒と待機時間を増やす
-                logger.info(f"Retry {attempt + 1}/{retry_count} after {wait_time}s wait...")
-                await asyncio.sleep(wait_time)
+    def record_use(self, key: str) -> None:
+        """人気順の事前生成に使う利用回数を数える"""
+        self._uses[key] = self._uses.get(key, 0) + 1
 
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                res = await client.get(url, headers=headers)
+    def popular(self, limit: int) -> list[str]:
+        return sorted(self._uses, key=self._uses.__getitem__, reverse=True)[:limit]
 
-                logger.info(f"LINE response (attempt {attempt + 1}): status={res.status_code}, headers={dict(res.headers)}")
+    def _lock(self, key: str) -> asyncio.Lock:
+        """エントリの読み出し〜書き戻しを同じスタンプについて直列にする（生成中は持たない）"""
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        return lock
 
-                if res.status_code == 200:
-                    mime = res.headers.get("content-type", "application/octet-stream")
-                    logger.info(f"Success: size={len(res.content)} bytes, mime={mime}")
-                    return res.content, mime
+    async def entry(self, key: str) -> dict[str, Any]:
+        return await self._entries.get_json(key) or {"prompt": "", "images": []}
 
-                # 404の場合は詳細なエラー情報を記録
-                error_body = res.text[:500] if res.text else "No body"
-                last_error = f"Status {res.status_code}: {error_body}"
-                logger.warning(f"Attempt {attempt + 1} failed: {last_error}")
+    async def needs_variant(self, key: str) -> bool:
+        entry = await self.entry(key)
+        return not entry["prompt"] or (self.can_rehost and len(entry["images"]) < self._variants)
 
-        except Exception as e:
-            last_error = str(e)
-            logger.warning(f"Attempt {attempt + 1} exception: {last_error}")
+    async def pick_image(self, key: str) -> str | None:
+        """バリエーションが揃っていればその中から1枚選んで画像IDを返す"""
+        if not self.can_rehost:
+            return None
+        images = (await self.entry(key))["images"]
+        if len(images) < self._variants:
+            self._misses += 1
+            return None
+        for image_id in random.sample(images, len(images)):
+            if await self._images.get(image_id) is not None:
+                self._hits += 1
+                return image_id
+        # 画像が容量超過で追い出されていたら作り直す
+        async with self._lock(key):
+            await self._entries.set_json(key, {**await self.entry(key), "images": []})
+        self._misses += 1
+        return None
 
-    # すべてのリトライが失敗
-    logger.error(f"All {retry_count} attempts failed. Last error: {last_error}")
-    raise HTTPException(
-        status_code=502,
-        detail=f"LINE content取得に失敗しました（{retry_count}回試行）。\n\n考えられる原因:\n1. アクセストークンの権限不足\n2. メッセージIDが無効\n\n最後のエラー: {last_error}"
-    )
+    async def save_prompt(self, key: str, prompt: str) -> None:
+        async with self._lock(key):
+            entry = await self.entry(key)
+            await self._entries.set_json(key, {**entry, "prompt": prompt})
 
+    async def add_image(self, key: str, png: bytes) -> str:
+        """生成画像を保存してバリエーションに加え、画像IDを返す"""
+        original, preview = await asyncio.to_thread(_encode_sticker_images, png)
+        image_id = hashlib.sha256(original).hexdigest()[:32]
+        await self._images.set(image_id, original)
+        await self._images.set(f"{image_id}_preview", preview)
+        async with self._lock(key):
+            entry = await self.entry(key)
+            images = [*entry["images"], image_id][-self._variants:]
+            await self._entries.set_json(key, {**entry, "images": images})
+        return image_id
 
-# ===== ChatGPT API =====
-async def chat_gpt(messages: list[dict[str, Any]]) -> str:
-    """ChatGPT APIを呼び出し"""
-    url = "https://api.openai.com/v1/chat/completions"
-    headers = {
-        "Authorization": f"Bearer {OPENAI_KEY}",
-        "Content-Type": "application/json",
-    }
-    payload = {
-        "model": "gpt-5",
-        "messages": messages,
-        # gpt-5はtemperature=1のみサポート（デフォルト値）
-        # "temperature": 1,  # デフォルトなので省略
-    }
+    async def image(self, name: str) -> bytes | None:
+        return await self._images.get(name)
 
-    async with httpx.AsyncClient(timeout=60.0) as client:
-        res = await client.post(url, headers=headers, json=payload)
-        data = res.json()
+    def stats(self) -> dict[str, Any]:
+        lookups = self._hits + self._misses
+        return {
+            "rehost": self.can_rehost,
+            "variants": self._variants,
+            "stickers_seen": len(self._uses),
+            "hits": self._hits,
+            "misses": self._misses,
+            "hit_rate": round(self._hits / lookups, 4) if lookups else 0.0,
+            "entries": self._entries.stats(),
+            "images": self._images.stats(),
+        }
 
-        if "error" in data:
-            raise HTTPException(
-                status_code=502,
-                detail=data["error"].get("message", "OpenAI API error")
-            )
 
-        return (
-            data.get("choices", [{}])[0]
-            .get("message", {})
-            .get("content", "")
-            .strip()
-            or "すみません、応答できませんでした。"
-        )
+sticker_cache = StickerResponseCache(
+    PersistentCache(cache_store, "sticker", STICKER_CACHE_TTL_DAYS * 86400, 16 * 1024 * 1024),
+    PersistentCache(
+        cache_store, "sticker_image", STICKER_CACHE_TTL_DAYS * 86400, int(STICKER_CACHE_MAX_MB * 1024 * 1024)
+    ),
+    STICKER_CACHE_VARIANTS,
+)
 
 
-# ===== DALL-E 3 画像生成 =====
-async def generate_image_with_dalle(prompt: str) -> str:
-    """DALL-E 3で画像を生成してURLを返す"""
-    url = "https://api.openai.com/v1/images/generations"
-    headers = {
-        "Authorization": f"Bearer {OPENAI_KEY}",
-        "Content-Type": "application/json",
-    }
-    payload = {
-        "model": "dall-e-3",
-        "prompt": prompt,
-        "n": 1,
-        "size": "1024x1024",
-        "quality": "standard",
-    }
+def sticker_image_urls(image_id: str) -> tuple[str, str]:
+    """自前で配信するスタンプ応答画像のURL（本体・プレビュー）"""
+    base = f"{PUBLIC_BASE_URL}/media/stickers/{image_id}"
+    return f"{base}.jpg", f"{base}_preview.jpg"
 
-    logger.info(f"DALL-E 3画像生成開始: prompt={prompt[:100]}...")
 
-    async with httpx.AsyncClient(timeout=120.0) as client:
-        res = await client.post(url, headers=headers, json=payload)
-        data = res.json()
+async def sticker_dalle_prompt(key: str, sticker_url: str) -> str:
+    """スタンプに応えるDALL-E用プロンプト（キャッシュが無ければスタンプ画像を分析して作る）"""
+    prompt = (await sticker_cache.entry(key))["prompt"]
+    if prompt:
+        return prompt
+    logger.info("OpenAI APIにスタンプ画像を送信して分析中...")
+    prompt = await chat_gpt(sticker_analysis_messages(sticker_url), task="sticker_prompt")
+    await sticker_cache.save_prompt(key, prompt)
+    return prompt
 
-        if "error" in data:
-            logger.error(f"DALL-E 3エラー: {data['error']}")
-            raise HTTPException(
-                status_code=502,
-                detail=data["error"].get("message", "DALL-E 3 API error")
-            )
 
-        image_url = data.get("data", [{}])[0].get("url", "")
-        logger.info(f"DALL-E 3画像生成完了: url={image_url}")
-        return image_url
+async def generate_sticker_variant(key: str, prompt: str) -> tuple[str, str | None]:
+    """DALL-Eで応答画像を1枚生成し、返信に使う (画像URL, プレビューURL) を返す"""
+    if not sticker_cache.can_rehost:
+        # 自前で配信できない場合はDALL-EのURLをそのまま使う（プロンプトのみキャッシュ）
+        return await generate_image_with_dalle(prompt), None
 
+    # 同じスタンプが同時に届いても並行して生成し、それぞれをバリエーションとして加える
+    image_b64 = await generate_image_with_dalle(prompt, response_format="b64_json")
+    image_id = await sticker_cache.add_image(key, base64.b64decode(image_b64))
+    return sticker_image_urls(image_id)
 
-# ===== LINE返信 =====
-async def reply_to_line(reply_token: str, text: str) -> None:
-    """LINEにテキストメッセージを返信"""
-    url = "https://api.line.me/v2/bot/message/reply"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {ACCESS_TOKEN}",
-    }
-    payload = {
-        "replyToken": reply_token,
-        "messages": [{"type": "text", "text": text[:4999]}],
-    }
 
-    async with httpx.AsyncClient(timeout=10.0) as client:
-        await client.post(url, headers=headers, json=payload)
+class StickerPrewarmer:
+    """よく使われるスタンプの応答画像をバックグラウンドで事前に生成しておく"""
 
+    def __init__(self, top: int, interval: float):
+        self._top = top
+        self._interval = interval
+        self._task: asyncio.Task | None = None
+        self._generated = 0
 
-async def reply_image_to_line(reply_token: str, image_url: str, preview_url: str = None) -> None:
-    """LINEに画像メッセージを返信"""
-    url = "https://api.line.me/v2/bot/message/reply"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {ACCESS_TOKEN}",
-    }
-    payload = {
-        "replyToken": reply_token,
-        "messages": [
-            {
-                "type": "image",
-                "originalContentUrl": image_url,
-                "previewImageUrl": preview_url or image_url,
-            }
-        ],
-    }
+    def start(self) -> None:
+        if self._top > 0 and self._interval > 0 and sticker_cache.can_rehost and self._task is None:
+            self._task = asyncio.create_task(self._loop(), name="sticker-prewarm")
 
-    logger.info(f"LINE画像返信: image_url={image_url}")
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
 
-    async with httpx.AsyncClient(timeout=10.0) as client:
-        res = await client.post(url, headers=headers, json=payload)
-        logger.info(f"LINE画像返信レスポンス: status={res.status_code}")
-        if res.status_code != 200:
-            logger.error(f"LINE画像返信エラー: {res.text}")
+    async def _loop(self) -> None:
+        while True:
+            await asyncio.sleep(self._interval)
+            for key in sticker_cache.popular(self._top):
+                try:
+                    if await sticker_cache.needs_variant(key):
+                        sticker_id = key.split(":", 1)[1]
+                        prompt = await sticker_dalle_prompt(key, sticker_image_url(sticker_id))
+                        await generate_sticker_variant(key, prompt)
+                        self._generated += 1
+                        logger.info("スタンプ応答画像を事前生成しました: %s", key)
+                except Exception as e:
+                    logger.warning("スタンプ応答画像の事前生成に失敗しました: %s, error=%s", key, e)
 
+    def stats(self) -> dict[str, Any]:
+        return {"enabled": self._task is not None, "top": self._top, "generated": self._generated}
 
-# ===== Webhookエンドポイント =====
-@app.post("/webhook")
-async def webhook(
-    request: Request,
-    x_line_signature: str = Header(None, alias="x-line-signature"),
-):
-    """LINE Webhook エンドポイント"""
 
-    # Bodyを取得
-    body = await request.body()
+sticker_prewarmer = StickerPrewarmer(STICKER_PREWARM_TOP, STICKER_PREWARM_INTERVAL)
 
-    # テストイベント（events: []）の判定
-    try:
-        body_obj = json.loads(body.decode("utf-8"))
-        is_test = isinstance(body_obj.get("events"), list) and len(body_obj["events"]) == 0
-    except Exception:
-        is_test = False
 
-    # 署名検証
-    if not is_test:
-        if not x_line_signature:
-            raise HTTPException(status_code=401, detail="Missing signature header")
+# ===== イベント処理 =====
+async def handle_event(event: dict[str, Any]) -> dict[str, Any] | None:
+    """1件のWebhookイベントを処理して結果を返す（message以外はNone）"""
+    if event.get("type") != "message":
+        return None
 
-        if not verify_signature(body, x_line_signature):
-            raise HTTPException(status_code=401, detail="Invalid signature")
+    msg_type = event.get("message", {}).get("type")
+    user_id = event.get("source", {}).get("userId", "unknown")
+    reply_token = event.get("replyToken")
+    deadline = event.get("_received_at", time.monotonic()) + REPLY_DEADLINE_SECONDS
+    current_msg_type.set(msg_type or "")
+    started = time.perf_counter()
 
-    # イベント処理
     try:
-        body_obj = json.loads(body.decode("utf-8"))
-    except Exception:
-        raise HTTPException(status_code=400, detail="Invalid JSON")
-
-    events = body_obj.get("events", [])
-    results = []
+        reply_text = ""
 
-    for event in events:
-        if event.get("type") != "message":
-            continue
+        # ===== テキストメッセージ =====
+        if msg_type == "text":
+            user_text = event.get("message", {}).get("text", "")
 
-        msg_type = event.get("message", {}).get("type")
-        user_id = event.get("source", {}).get("userId", "unknown")
-        reply_token = event.get("replyToken")
+            # リセットコマンド
+            if user_text in ["リセット", "/reset"]:
+                await reset_history(user_id)
+                reply_text = "会話履歴をリセットしました！新しい会話を始めましょう。"
 
-        try:
-            reply_text = ""
+            # 履歴確認コマンド
+            elif user_text == "/history":
+                count = await get_history_count(user_id)
+                reply_text = f"現在{count // 2}件の会話履歴があります。\n「リセット」または「/reset」で履歴をクリアできます。"
 
-            # ===== テキストメッセージ =====
-            if msg_type == "text":
-                user_text = event.get("message", {}).get("text", "")
+            # 回答キャッシュの設定コマンド
+            elif user_text in ["/cache on", "/cache off"]:
+                enabled = user_text == "/cache on"
+                await set_answer_cache_setting(user_id, enabled)
+                reply_text = (
+                    "よくある質問への回答キャッシュを有効にしました。"
+                    if enabled
+                    else "回答キャッシュを無効にしました。毎回新しく回答を作成します。"
+                )
 
-                # リセットコマンド
-                if user_text in ["リセット", "/reset"]:
-                    await reset_history(user_id)
-                    reply_text = "会話履歴をリセットしました！新しい会話を始めましょう。"
+            # 通常会話
+            else:
+                # 「/nocache 質問」はその発言だけキャッシュを使わずに回答する（回答はキャッシュを更新する）
+                bypass_cache = user_text.startswith("/nocache ")
+                if bypass_cache:
+                    user_text = user_text[len("/nocache "):].strip()
+                summary, summarized_id = await conversation_summaries.get(user_id)
+                history = await get_history(user_id, after_id=summarized_id)
+                messages = build_context(history, user_text, summary)
+                model = model_router.select("chat", messages)
 
-                # 履歴確認コマンド
-                elif user_text == "/history":
-                    count = await get_history_count(user_id)
-                    reply_text = f"現在{count // 2}件の会話履歴があります。\n「リセット」または「/reset」で履歴をクリアできます。"
+                # 履歴も要約もなければプロンプトは発言だけで決まるので、同じ発言への回答を再利用できる
+                cache_key = None if history or summary else answer_cache.key(user_text, model)
+                if cache_key is not None and not await get_answer_cache_setting(user_id):
+                    answer_cache_lookups.inc(result="opt_out")
+                    cache_key = None
+                if cache_key is not None and bypass_cache:
+                    answer_cache_lookups.inc(result="bypass")
+                    cached = None
+                else:
+                    cached = await answer_cache.get(cache_key) if cache_key is not None else None
 
-                # 通常会話
+                if cached is not None:
+                    event_logger.info("回答キャッシュにヒット: reply_length=%s", len(cached))
+                    answer = cached
+                    if not await reply_to_line(reply_token, answer):
+                        await push_to_line(push_target(event), answer)
                 else:
-                    history = await get_history(user_id)
-                    messages = [
-                        {"role": "system", "content": SYS_PROMPT},
-                        *history,
-                        {"role": "user", "content": user_text},
-                    ]
-                    reply_text = await chat_gpt(messages)
-
-                    # 履歴保存
-                    await save_to_history(user_id, "user", user_text)
-                    await save_to_history(user_id, "assistant", reply_text)
-
-            # ===== 画像メッセージ =====
-            elif msg_type == "image":
-                logger.info(f"画像メッセージを受信: user_id={user_id}")
-                logger.info(f"Event data: {json.dumps(event, ensure_ascii=False)}")
-
-                message_id = event.get("message", {}).get("id")
-                logger.info(f"Message ID: {message_id}")
-
-                if not message_id:
-                    raise ValueError("Message ID not found in event")
-
-                # LINEから画像を取得
-                content, mime = await fetch_line_content(message_id)
-                logger.info(f"画像取得成功: size={len(content)} bytes, mime={mime}")
-
-                # Base64エンコード
-                b64_image = base64.b64encode(content).decode()
-                logger.info(f"Base64エンコード完了: length={len(b64_image)}")
-
-                messages = [
-                    {
-                        "role": "system",
-                        "content": SYS_PROMPT + """
+                    answer = await complete_and_reply(messages, reply_token, push_target(event), deadline, model)
+                    if cache_key is not None and answer != NO_ANSWER_TEXT:
+                        await answer_cache.set(cache_key, answer)
 
-画像が送られたら、以下の形式で対応してください：
+                # 履歴保存（予算に収まらずプロンプトから外れたやり取りは裏で要約に畳み込む）
+                await save_exchange(user_id, user_text, answer)
+                kept = len(messages) - 2  # システムプロンプトと新しい発言を除いた履歴の件数
+                conversation_summaries.schedule(user_id, window=kept + 2)  # 今回の1往復も窓に含める
+                reply_text = None  # 返信済み
 
-1. **問題の画像の場合**（数学、英語、プログラミングなど）:
-   - 問題を理解して、丁寧な解説を提供
-   - 回答例を示す
-   - 解き方の手順を説明
-   - 重要なポイントを指摘
+        # ===== 画像メッセージ =====
+        elif msg_type == "image":
+            event_logger.info("画像メッセージを受信: user_id=%s", user_id)
+            event_logger.debug("Event data: %s", LazyJSON(event))
 
-2. **一般的な画像の場合**:
-   - 画像の内容を簡潔に説明
+            message_id = event.get("message", {}).get("id")
+            event_logger.debug("Message ID: %s", message_id)
 
-判断基準:
-- 文字や数式が多い → 問題の可能性が高い
-- 「問」「解答」「問題」などの文字がある → 問題
-- 教科書やノートの写真 → 問題の可能性あり
+            if not message_id:
+                raise ValueError("Message ID not found in event")
 
-【重要】表記ルール:
+            # LINEから画像を取得（上限付きでストリーミング）
+            content, mime = await fetch_line_content(message_id, max_bytes=IMAGE_MAX_BYTES)
+            event_logger.info("画像取得成功: size=%s bytes, mime=%s", len(content), mime)
 
-▼ 数式の書き方
-• LaTeX形式（\\(, \\), \\[, \\], $など）は絶対に使わない
-• バックスラッシュ（\\）は一切使わない
-• 累乗: x² または x^2
-• 分数: 1/2
-• 根号: √
-• プレーンテキストで読みやすく
+            # Visionモデルが使う解像度まで縮小してから data URL にする
+            content, mime = await prepare_image_for_vision(content, mime)
+            image_data_url = build_data_url(content, mime)
+            image_hash = hashlib.sha256(content).digest()
+            del content
+            event_logger.debug("Base64エンコード完了: length=%s", len(image_data_url))
 
-▼ 箇条書きの書き方
-• ハイフン（-）やアスタリスク（*）は使わない
-• 代わりに「•」（黒丸）または数字を使う
-• 例: • 項目1　• 項目2
+            messages = [
+                IMAGE_SYSTEM_MESSAGE,
+                {
+                    "role": "user",
+                    "content": [
+                        IMAGE_REQUEST_PART,
+                        {
+                            "type": "image_url",
+                            "image_url": {"url": image_data_url},
+                        },
+                    ],
+                },
+            ]
 
-▼ 数式の良い例・悪い例
-❌ 悪い例: \\(x^2 + 2x + 1\\)
-✅ 良い例: x² + 2x + 1 または x^2 + 2x + 1
-❌ 悪い例: - 計算手順（行頭にハイフン）
-✅ 良い例: • 計算手順 または 1. 計算手順""",
-                    },
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": """この画像を分析してください。
+            # 同じ画像・同じプロンプトの解析結果があればOpenAIを呼ばずに返す
+            model = model_router.select("vision", messages)
+            cache_key = image_cache_key(image_hash, messages, model)
+            cached = await image_analysis_cache.get(cache_key)
+            if cached is not None:
+                reply_text = cached.decode()
+                event_logger.info("画像解析キャッシュにヒット: reply_length=%s", len(reply_text))
+            else:
+                event_logger.debug("OpenAI APIに画像を送信中...")
+                answer = await complete_and_reply(messages, reply_token, push_target(event), deadline, model)
+                event_logger.info("画像処理完了: model=%s, reply_length=%s", model, len(answer))
+                if answer and answer != NO_ANSWER_TEXT:
+                    await image_analysis_cache.set(cache_key, answer.encode())
+                reply_text = None  # 返信済み
 
-もし問題（数学、英語、プログラミングなど）であれば:
-1. 問題の内容を確認
-2. 解き方の手順を説明
-3. 回答例を提示
-4. 重要なポイントを指摘
+        # ===== スタンプメッセージ =====
+        elif msg_type == "sticker":
+            event_logger.info("スタンプメッセージを受信: user_id=%s", user_id)
 
-一般的な画像であれば、内容を簡潔に説明してください。""",
-                            },
-                            {
-                                "type": "image_url",
-                                "image_url": {"url": f"data:{mime};base64,{b64_image}"},
-                            },
-                        ],
-                    },
-                ]
-
-                logger.info("OpenAI APIに画像を送信中...")
-                reply_text = await chat_gpt(messages)
-                logger.info(f"画像処理完了: reply_length={len(reply_text)}")
-
-            # ===== スタンプメッセージ =====
-            elif msg_type == "sticker":
-                logger.info(f"スタンプメッセージを受信: user_id={user_id}")
-
-                # スタンプ情報を取得
-                sticker_id = event.get("message", {}).get("stickerId")
-                package_id = event.get("message", {}).get("packageId")
-                sticker_resource_type = event.get("message", {}).get("stickerResourceType", "STATIC")
-
-                logger.info(f"Sticker: packageId={package_id}, stickerId={sticker_id}, type={sticker_resource_type}")
-
-                # スタンプ画像URL（LINEの公式スタンプ画像URL）
-                sticker_url = f"https://stickershop.line-scdn.net/stickershop/v1/sticker/{sticker_id}/android/sticker.png"
-                logger.info(f"Sticker URL: {sticker_url}")
-
-                # ステップ1: スタンプ画像をGPT-4oで分析
-                analysis_messages = [
-                    {
-                        "role": "system",
-                        "content": """あなたはスタンプ画像を分析し、それに応じた画像生成プロンプトを作成する専門家です。
+            # スタンプ情報を取得
+            sticker_id = event.get("message", {}).get("stickerId")
+            package_id = event.get("message", {}).get("packageId")
+            sticker_resource_type = event.get("message", {}).get("stickerResourceType", "STATIC")
 
-スタンプの感情や雰囲気を読み取り、それに応えるような画像の説明を英語で簡潔に出力してください。
+            event_logger.info("Sticker: packageId=%s, stickerId=%s, type=%s", package_id, sticker_id, sticker_resource_type)
 
-【重要】出力形式:
-- 英語のプロンプトのみ出力（1-2文、最大70単語）
-- 日本語の説明は不要
-- DALL-E 3で生成しやすいシンプルな描写
-- 感情を視覚的に表現
-- **画像内に英語テキストメッセージを含める**: 感情に応じた短い英語メッセージ（2-5単語）を画像に入れる指示を含める
+            # スタンプ画像URL（LINEの公式スタンプ画像URL）
+            sticker_url = sticker_image_url(sticker_id)
+            event_logger.debug("Sticker URL: %s", sticker_url)
 
-例:
-- 喜び → "A cheerful cartoon character jumping with joy, bright colors, happy atmosphere, with English text 'You did it!' displayed prominently"
-- 悲しみ → "A cute character sitting under rain clouds, soft pastel colors, melancholic mood, with English text 'It's okay' in gentle font"
-- 愛情 → "Two adorable characters hugging with hearts around them, warm pink tones, with English text 'Thank you♡' in decorative style"
-- 応援 → "An energetic character cheering with pom-poms, vibrant colors, motivational scene, with English text 'Go for it!' in bold letters"
-- 感謝 → "Cute character bowing with sparkles, warm orange tones, with English text 'Thanks!' in elegant font"
-- 励まし → "Supportive character with warm smile, gentle colors, with English text 'You got this!' in friendly font"
-""",
-                    },
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": "このスタンプの感情を読み取り、それに応える画像のプロンプトを英語で作成してください。感情に合った短い英語メッセージ（2-5単語）を画像内に入れる指示も含めてください。"},
-                            {
-                                "type": "image_url",
-                                "image_url": {"url": sticker_url},
-                            },
-                        ],
-                    },
-                ]
-
-                logger.info("OpenAI APIにスタンプ画像を送信して分析中...")
-                dalle_prompt = await chat_gpt(analysis_messages)
-                logger.info(f"画像生成プロンプト: {dalle_prompt}")
+            # キャッシュ済みの応答画像があれば OpenAI を呼ばずにすぐ返す
+            sticker_key = f"{package_id}:{sticker_id}"
+            sticker_cache.record_use(sticker_key)
+            cached_image = await sticker_cache.pick_image(sticker_key)
+            if cached_image is not None:
+                await reply_image_to_line(reply_token, *sticker_image_urls(cached_image))
+                event_logger.info("スタンプ応答キャッシュにヒット: %s", sticker_key)
+                reply_text = None
+
+            else:
+                # ステップ1: スタンプ画像を分析してプロンプトを作成（キャッシュ済みなら再利用）
+                dalle_prompt = await sticker_dalle_prompt(sticker_key, sticker_url)
+                event_logger.debug("画像生成プロンプト: %s", dalle_prompt)
 
                 # ステップ2: DALL-E 3で画像を生成
                 try:
-                    generated_image_url = await generate_image_with_dalle(dalle_prompt)
-                    logger.info(f"スタンプ応答画像生成完了: {generated_image_url}")
+                    image_url, preview_url = await generate_sticker_variant(sticker_key, dalle_prompt)
+                    event_logger.info("スタンプ応答画像生成完了: %s", image_url)
 
                     # 画像で返信
-                    await reply_image_to_line(reply_token, generated_image_url)
-                    logger.info("スタンプに対して画像で返信しました")
+                    await reply_image_to_line(reply_token, image_url, preview_url)
+                    event_logger.debug("スタンプに対して画像で返信しました")
 
                     # 返信済みなのでreply_textは空にしてスキップ
                     reply_text = None
 
                 except Exception as dalle_error:
-                    logger.error(f"DALL-E 3画像生成エラー: {dalle_error}")
+                    logger.error("DALL-E 3画像生成エラー: %s", dalle_error)
                     # DALL-E失敗時はテキストで返信
                     reply_text = f"スタンプありがとう！（画像生成中にエラーが発生しました: {str(dalle_error)[:100]}）"
 
-            # ===== 音声メッセージ =====
-            elif msg_type == "audio":
-                message_id = event.get("message", {}).get("id")
-                content, _ = await fetch_line_content(message_id)
+        # ===== 音声メッセージ =====
+        elif msg_type == "audio":
+            message_id = event.get("message", {}).get("id")
 
-                # Whisper APIで文字起こし
-                url = "https://api.openai.com/v1/audio/transcriptions"
-                headers = {"Authorization": f"Bearer {OPENAI_KEY}"}
-                files = {"file": ("audio.m4a", content, "audio/mp4")}
-                data = {"model": "whisper-1"}
+            # Whisper APIで文字起こし（ダウンロードをそのまま送信し、同じ音声はキャッシュから）
+            timings: dict[str, float] = {}
+            text = await transcribe_line_audio(message_id, timings)
+            if text is None:
+                text = "(音声の文字起こしに失敗しました)"
 
-                async with httpx.AsyncClient(timeout=60.0) as client:
-                    res = await client.post(url, headers=headers, files=files, data=data)
-                    transcription = res.json()
+            messages = [
+                SYSTEM_MESSAGE,
+                {"role": "user", "content": f"次の文字起こしを要約してください：\n{text}"},
+            ]
+            summarize_started = time.perf_counter()
+            model = model_router.select("transcript_summary", messages)
+            await complete_and_reply(messages, reply_token, push_target(event), deadline, model)
+            timings["summarize"] = time.perf_counter() - summarize_started
+            record_audio_timings(timings)
+            reply_text = None  # 返信済み
 
-                text = transcription.get("text", "(音声の文字起こしに失敗しました)")
+        # ===== その他 =====
+        else:
+            reply_text = "現在はテキスト・画像・音声・スタンプに対応しています。"
 
-                messages = [
-                    {"role": "system", "content": SYS_PROMPT},
-                    {"role": "user", "content": f"次の文字起こしを要約してください：\n{text}"},
-                ]
-                reply_text = await chat_gpt(messages)
+        # 返信（reply_textがNoneでない場合のみ）
+        if reply_text is not None:
+            await reply_to_line(reply_token, reply_text)
+        return {"ok": True, "type": msg_type, "userId": user_id}
 
-            # ===== その他 =====
+    except Exception as e:
+        logger.error("エラー発生: type=%s, user=%s, error=%s", msg_type, user_id, e, exc_info=True)
+
+        # エラーをユーザーに通知
+        error_msg = f"申し訳ございません。処理中にエラーが発生しました。\n\nエラー詳細: {str(e)[:200]}"
+        try:
+            if isinstance(e, PartialReplyError):
+                # reply token は途中までの回答で使用済みなので push で知らせる
+                await push_to_line(push_target(event), error_msg)
             else:
-                reply_text = "現在はテキスト・画像・音声・スタンプに対応しています。"
+                await reply_to_line(reply_token, error_msg)
+        except Exception as reply_error:
+            logger.error("エラー返信も失敗: %s", reply_error)
+
+        stage_errors.inc(stage="event", msg_type=msg_type or "", model="")
+        return {"ok": False, "type": msg_type, "error": str(e), "userId": user_id}
+
+    finally:
+        stage_seconds.observe(time.perf_counter() - started, stage="event", msg_type=msg_type or "", model="")
+
+
+# ===== 連続したテキストのまとめ =====
+def is_command(text: str) -> bool:
+    """リセット・/history・/cache などのコマンド（まとめずにそのまま処理する）"""
+    return text == "リセット" or text.startswith("/")
+
+
+@dataclass
+class _TextBatch:
+    events: list[dict[str, Any]]
+    future: asyncio.Future
+    started: float
+    timer: asyncio.TimerHandle | None = None
+
+
+class MessageCoalescer:
+    """同じユーザーから続けて届いたテキストを1つの発言にまとめ、1回の応答で返す
+
+    テキストが届くたびに window 秒待ち、その間に次のテキストが来なければ（最初のテキストから
+    max_wait 秒経つか max_messages 件たまったらその時点で）改行でつないで handler に渡す。
+    返信には最後のイベントの reply token を使い、履歴にも1回のやり取りとして保存される。
+    同じユーザーのまとめは1つずつ順番に処理する。
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[dict[str, Any]], Awaitable[Any]],
+        window: float,
+        max_wait: float,
+        max_messages: int,
+    ):
+        self._handler = handler
+        self._window = window
+        self._max_wait = max(window, max_wait)
+        self._max_messages = max(1, max_messages)
+        self._pending: dict[str, _TextBatch] = {}
+        self._running: dict[str, asyncio.Task] = {}
+        self._batches = 0
+        self._messages = 0
+        self._largest = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._window > 0
+
+    def eligible(self, event: dict[str, Any]) -> bool:
+        """まとめの対象（コマンド以外のテキストメッセージ）か"""
+        if not self.enabled or event.get("type") != "message":
+            return False
+        message = event.get("message", {})
+        return message.get("type") == "text" and not is_command(message.get("text", ""))
+
+    async def submit(self, event: dict[str, Any], accepted: asyncio.Event | None = None) -> Any:
+        """テキストをまとめ待ちに加え（加えたら accepted をセット）、まとめた応答の結果を返す"""
+        key = event_source_key(event)
+        loop = asyncio.get_running_loop()
+        batch = self._pending.get(key)
+        if batch is None:
+            batch = self._pending[key] = _TextBatch([], loop.create_future(), loop.time())
+        batch.events.append(event)
+        if accepted is not None:
+            accepted.set()
 
-            # 返信（reply_textがNoneでない場合のみ）
-            if reply_text is not None:
-                await reply_to_line(reply_token, reply_text)
-            results.append({"ok": True, "type": msg_type, "userId": user_id})
+        if batch.timer is not None:
+            batch.timer.cancel()
+        remaining = batch.started + self._max_wait - loop.time()
+        if len(batch.events) >= self._max_messages or remaining <= 0:
+            self._fire(key)
+        else:
+            batch.timer = loop.call_later(min(self._window, remaining), self._fire, key)
+        return await asyncio.shield(batch.future)
 
+    def _fire(self, key: str) -> None:
+        batch = self._pending.pop(key, None)
+        if batch is None:
+            return
+        if batch.timer is not None:
+            batch.timer.cancel()
+        previous = self._running.get(key)
+        task = self._running[key] = asyncio.create_task(self._run(key, batch, previous))
+        task.add_done_callback(lambda done: self._running.pop(key, None) if self._running.get(key) is done else None)
+
+    async def _run(self, key: str, batch: _TextBatch, previous: asyncio.Task | None) -> None:
+        """前のまとめが終わるのを待ってから、まとめた発言を1件のイベントとして処理する"""
+        if previous is not None:
+            await asyncio.wait([previous])
+        events = sorted(batch.events, key=lambda e: e.get("timestamp", 0))
+        count = len(events)
+        self._batches += 1
+        self._messages += count
+        self._largest = max(self._largest, count)
+        if count > 1:
+            coalesced_messages.inc(count - 1)
+            event_logger.info("連続したテキストをまとめて処理します: user_id=%s, messages=%s", key, count)
+
+        latest = events[-1]
+        combined = {
+            **latest,
+            "message": {**latest["message"], "text": "\n".join(e["message"].get("text", "") for e in events)},
+        }
+        try:
+            result = await self._handler(combined)
+        except asyncio.CancelledError:
+            batch.future.cancel()
+            raise
+        except Exception as e:
+            batch.future.set_exception(e)
+            batch.future.exception()  # 待っている呼び出し元がいなくても未回収の警告を出さない
+            return
+        if isinstance(result, dict) and count > 1:
+            result = {**result, "coalesced": count}
+        batch.future.set_result(result)
+
+    async def flush(self, key: str) -> None:
+        """このユーザーのまとめ待ちのテキストをすぐに処理し、処理中のものと合わせて終わるまで待つ"""
+        self._fire(key)
+        task = self._running.get(key)
+        if task is not None:
+            await asyncio.wait([task])
+
+    async def flush_all(self) -> None:
+        for key in list(self._pending):
+            self._fire(key)
+        if self._running:
+            await asyncio.wait(list(self._running.values()))
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "window_ms": round(self._window * 1000),
+            "batches": self._batches,
+            "messages": self._messages,
+            "largest_batch": self._largest,
+            "waiting_users": len(self._pending),
+        }
+
+
+message_coalescer = MessageCoalescer(
+    handle_event,
+    MESSAGE_COALESCE_WINDOW_MS / 1000,
+    MESSAGE_COALESCE_MAX_WAIT_MS / 1000,
+    MESSAGE_COALESCE_MAX_MESSAGES,
+)
+
+
+async def dispatch_event(event: dict[str, Any], accepted: asyncio.Event | None = None) -> Any:
+    """テキストはまとめ待ちに入れ、それ以外はそのユーザーのまとめ待ちを先に処理してから処理する"""
+    if message_coalescer.eligible(event):
+        return await message_coalescer.submit(event, accepted)
+    if message_coalescer.enabled:
+        await message_coalescer.flush(event_source_key(event))
+    return await handle_event(event)
+
+
+async def start_in_order(
+    handler: Callable[[dict[str, Any], asyncio.Event], Awaitable[Any]], event: dict[str, Any]
+) -> asyncio.Task:
+    """handler(event, accepted) をタスクで始め、まとめ待ちに入るか処理が終わるまで待ってタスクを返す
+
+    同じユーザーのイベントを到着順に渡しつつ、まとめ待ちのテキストの応答は待たずに次のイベントへ進める。
+    """
+    accepted = asyncio.Event()
+    task = asyncio.create_task(handler(event, accepted))
+    waiter = asyncio.create_task(accepted.wait())
+    try:
+        await asyncio.wait([task, waiter], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        waiter.cancel()
+    return task
+
+
+# ===== イベントの重複排除 =====
+class EventDeduplicator:
+    """webhookEventId で処理済み・処理中のイベントを判定し、同じイベントを二重に処理しない
+
+    処理済みの結果はメモリ（LRU）とSQLite（再起動後の再送用）にTTL付きで保持する。
+    SQLiteへの記録は応答を待たせないよう裏で行う（プロセス内の重複はメモリ側で判定できる）。
+    処理中のイベントが再送されたら、新たに処理せず実行中の結果を待って同じ結果を返す。
+    処理に失敗したイベント（ok=False）は記録しないので、LINEの再送で処理し直す。
+    """
+
+    def __init__(self, store: PersistentCache, ttl: float, max_entries: int):
+        self._store = store
+        self._ttl = ttl
+        self._max_entries = max(1, max_entries)
+        self._done: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self._in_flight: dict[str, asyncio.Future] = {}
+        self._writes: set[asyncio.Task] = set()
+        self._processed = 0
+        self._failures = 0
+        self._duplicates = 0
+        self._coalesced = 0
+        self._redeliveries = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._ttl > 0
+
+    def _remember(self, event_id: str, result: Any) -> None:
+        self._done[event_id] = (time.monotonic() + self._ttl, result)
+        self._done.move_to_end(event_id)
+        while len(self._done) > self._max_entries:
+            self._done.popitem(last=False)
+
+    def _recall(self, event_id: str) -> tuple[bool, Any]:
+        entry = self._done.get(event_id)
+        if entry is None:
+            return False, None
+        if entry[0] < time.monotonic():
+            del self._done[event_id]
+            return False, None
+        self._done.move_to_end(event_id)
+        return True, entry[1]
+
+    def _duplicate(self, result: Any) -> Any:
+        self._duplicates += 1
+        return {**result, "duplicate": True} if isinstance(result, dict) else result
+
+    async def run(
+        self, event: dict[str, Any], handler: Callable[[dict[str, Any]], Awaitable[Any]]
+    ) -> Any:
+        """イベントを1回だけ処理し、重複した呼び出しには同じ結果を返す"""
+        event_id = event.get("webhookEventId")
+        if not self.enabled or not event_id:
+            return await handler(event)
+        if event.get("deliveryContext", {}).get("isRedelivery"):
+            self._redeliveries += 1
+
+        found, result = self._recall(event_id)
+        if found:
+            return self._duplicate(result)
+        future = self._in_flight.get(event_id)
+        if future is not None:
+            self._coalesced += 1
+            logger.info("処理中のイベントが再送されたため結果を待ちます: event_id=%s", event_id)
+            return self._duplicate(await asyncio.shield(future))
+
+        # 最初のawaitより前に登録して、同時に届いた再送を確実に合流させる
+        future = self._in_flight[event_id] = asyncio.get_running_loop().create_future()
+        try:
+            stored = await self._store.get_json(event_id)
+            if stored is not None:
+                self._remember(event_id, stored)
+                future.set_result(stored)
+                return self._duplicate(stored)
+
+            result = await handler(event)
+            self._processed += 1
+            future.set_result(result)
+            # 失敗した（handle_event が {"ok": False} を返した）イベントは記録せず、次の再送で処理し直す
+            if isinstance(result, dict) and result.get("ok") is False:
+                self._failures += 1
+                return result
+            self._remember(event_id, result)
+            task = asyncio.create_task(self._persist(event_id, result))
+            self._writes.add(task)
+            task.add_done_callback(self._writes.discard)
+            return result
+        except BaseException as e:
+            # 例外で終わったイベントも記録せず、次の再送で処理し直す
+            if future.done():
+                pass
+            elif isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                future.exception()  # 待っている再送がなくても未回収の警告を出さない
+            raise
+        finally:
+            del self._in_flight[event_id]
+
+    async def _persist(self, event_id: str, result: Any) -> None:
+        try:
+            await self._store.set_json(event_id, result)
         except Exception as e:
-            logger.error(f"エラー発生: type={msg_type}, user={user_id}, error={str(e)}", exc_info=True)
+            logger.warning("処理済みイベントの記録に失敗しました: event_id=%s, error=%s", event_id, e)
+
+    async def flush(self) -> None:
+        """裏で行っている記録の書き込みを待つ（シャットダウン時）"""
+        if self._writes:
+            await asyncio.wait(list(self._writes))
 
-            # エラーをユーザーに通知
-            error_msg = f"申し訳ございません。処理中にエラーが発生しました。\n\nエラー詳細: {str(e)[:200]}"
+    async def handle(self, event: dict[str, Any], accepted: asyncio.Event | None = None) -> Any:
+        return await self.run(event, functools.partial(dispatch_event, accepted=accepted))
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "processed": self._processed,
+            "failed": self._failures,
+            "duplicates": self._duplicates,
+            "coalesced": self._coalesced,
+            "redeliveries": self._redeliveries,
+            "in_flight": len(self._in_flight),
+            "pending_writes": len(self._writes),
+            "remembered": len(self._done),
+            "store": self._store.stats(),
+        }
+
+
+event_deduplicator = EventDeduplicator(
+    PersistentCache(
+        cache_store, "webhook_events", EVENT_DEDUP_TTL, int(EVENT_DEDUP_MAX_MB * 1024 * 1024), evict_lru=False
+    ),
+    EVENT_DEDUP_TTL,
+    EVENT_DEDUP_MEMORY,
+)
+
+
+# ===== イベントキュー =====
+def event_source_key(event: dict[str, Any]) -> str:
+    """イベントの順序を保証する単位（userId、無ければグループ/ルームID）"""
+    source = event.get("source", {})
+    return source.get("userId") or source.get("groupId") or source.get("roomId") or "unknown"
+
+
+class EventDispatcher:
+    """イベントを有界キューに積み、ワーカーで処理する
+
+    同じユーザーのイベントは到着順に1件ずつ、異なるユーザーのイベントは並列に処理する。
+    まとめ待ちに入ったテキストは応答を待たずに次のイベントへ進み、枠は応答が終わった時点で解放する。
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[dict[str, Any], asyncio.Event], Awaitable[Any]],
+        workers: int,
+        max_pending: int,
+    ):
+        self._handler = handler
+        self._worker_count = max(1, workers)
+        self._max_pending = max(1, max_pending)
+        self._user_queues: dict[str, deque[dict[str, Any]]] = {}
+        self._ready: asyncio.Queue[str] | None = None
+        self._space: asyncio.Condition | None = None
+        self._idle: asyncio.Event | None = None
+        self._workers: list[asyncio.Task] = []
+        self._completions: set[asyncio.Task] = set()
+        self._pending = 0
+        self._accepting = False
+        self._processed = 0
+        self._failed = 0
+        self._rejected = 0
+
+    def start(self) -> None:
+        """ワーカーを起動（asyncioのプリミティブは実行中のループ上で生成する）"""
+        self._ready = asyncio.Queue()
+        self._space = asyncio.Condition()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._accepting = True
+        self._workers = [
+            asyncio.create_task(self._worker(i), name=f"event-worker-{i}")
+            for i in range(self._worker_count)
+        ]
+        logger.info("イベントワーカー起動: workers=%s, queue_size=%s", self._worker_count, self._max_pending)
+
+    async def submit(self, events: list[dict[str, Any]], timeout: float = EVENT_ENQUEUE_TIMEOUT) -> None:
+        """イベントをキューに積む（満杯なら空きを待ち、待ちきれなければ503）"""
+        if not events:
+            return
+        if not self._accepting:
+            raise HTTPException(status_code=503, detail="Event queue is not accepting events")
+
+        def has_space() -> bool:
+            return self._pending == 0 or self._pending + len(events) <= self._max_pending
+
+        async with self._space:
             try:
-                await reply_to_line(reply_token, error_msg)
-            except Exception as reply_error:
-                logger.error(f"エラー返信も失敗: {str(reply_error)}")
+                await asyncio.wait_for(self._space.wait_for(has_space), timeout)
+            except asyncio.TimeoutError:
+                self._rejected += len(events)
+                logger.warning("イベントキューが満杯です: pending=%s, rejected=%s", self._pending, len(events))
+                # 503を返すとLINEが再送してくれる
+                raise HTTPException(status_code=503, detail="Event queue is full")
 
-            results.append(
-                {"ok": False, "type": msg_type, "error": str(e), "userId": user_id}
-            )
+            for event in events:
+                key = event_source_key(event)
+                user_queue = self._user_queues.get(key)
+                if user_queue is None:
+                    user_queue = self._user_queues[key] = deque()
+                    self._ready.put_nowait(key)
+                user_queue.append(event)
+                self._pending += 1
+            self._idle.clear()
+
+    async def _worker(self, index: int) -> None:
+        """ユーザー単位でイベントを取り出して処理し続ける"""
+        while True:
+            key = await self._ready.get()
+            user_queue = self._user_queues[key]
+            # このユーザーのキューが空になるまで同じワーカーが順番に処理する
+            while user_queue:
+                event = user_queue.popleft()
+                task = await start_in_order(self._handler, event)
+                if task.done():
+                    await self._complete(index, task)
+                else:
+                    completion = asyncio.create_task(self._complete(index, task))
+                    self._completions.add(completion)
+                    completion.add_done_callback(self._completions.discard)
+            del self._user_queues[key]
+
+    async def _complete(self, index: int, task: asyncio.Task) -> None:
+        """1件の処理の終了を待って結果を数え、枠を解放する"""
+        try:
+            result = await task
+            if result is not None and not result.get("ok", True):
+                self._failed += 1
+        except Exception as e:
+            self._failed += 1
+            logger.error("イベント処理で未捕捉の例外: worker=%s, error=%s", index, e, exc_info=True)
+        finally:
+            self._processed += 1
+            await self._release()
+
+    async def _release(self) -> None:
+        """処理済み1件分の枠を解放して待機中の投入者を起こす"""
+        self._pending -= 1
+        if self._pending == 0:
+            self._idle.set()
+        async with self._space:
+            self._space.notify_all()
+
+    async def drain(self, timeout: float) -> None:
+        """新規受付を止め、キュー内のイベントを処理し終えてからワーカーを止める"""
+        if not self._workers:
+            return
+        self._accepting = False
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+            logger.info("イベントキューを処理し終えました")
+        except asyncio.TimeoutError:
+            logger.error("シャットダウン時に未処理のイベントが残りました: pending=%s", self._pending)
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def stats(self) -> dict[str, Any]:
+        """キューの統計"""
+        return {
+            "mode": WEBHOOK_MODE,
+            "workers": len(self._workers),
+            "pending": self._pending,
+            "max_pending": self._max_pending,
+            "active_users": len(self._user_queues),
+            "processed": self._processed,
+            "failed": self._failed,
+            "rejected": self._rejected,
+        }
+
+
+dispatcher = EventDispatcher(event_deduplicator.handle, EVENT_WORKERS, EVENT_QUEUE_SIZE)
+event_queue_depth.set_function(lambda: {(): dispatcher.stats()["pending"]})
+
+
+# ===== Webhookエンドポイント =====
+@app.post("/webhook")
+async def webhook(
+    request: Request,
+    x_line_signature: str = Header(None, alias="x-line-signature"),
+):
+    """LINE Webhook エンドポイント"""
+
+    # Bodyを取得
+    body = await request.body()
+
+    with stage_timer("webhook"):
+        return await process_webhook(body, x_line_signature)
+
+
+async def process_webhook(body: bytes, x_line_signature: str | None) -> dict[str, Any]:
+    """署名検証・パースを行い、イベントを処理またはキューに積む"""
+    # JSONは1回だけパースして、テスト判定・イベント処理の両方で使う
+    try:
+        body_obj = json_loads(body)
+    except ValueError:
+        body_obj = None
+
+    # テストイベント（events: []）の判定
+    is_test = isinstance(body_obj, dict) and body_obj.get("events") == []
+
+    # 署名検証
+    if not is_test:
+        if not x_line_signature:
+            raise HTTPException(status_code=401, detail="Missing signature header")
+
+        with stage_timer("signature"):
+            valid = verify_signature(body, x_line_signature)
+        if not valid:
+            stage_errors.inc(stage="signature", msg_type="", model="")
+            raise HTTPException(status_code=401, detail="Invalid signature")
+
+    if not isinstance(body_obj, dict):
+        raise HTTPException(status_code=400, detail="Invalid JSON")
+
+    events = body_obj.get("events", [])
+
+    # 返信期限の起点（キューで待たされた時間も期限に含める）
+    received_at = time.monotonic()
+    for event in events:
+        event["_received_at"] = received_at
+
+    if WEBHOOK_MODE == "queue":
+        # 署名検証済みのイベントをキューに積んで即座に200を返す
+        message_events = [event for event in events if event.get("type") == "message"]
+        await dispatcher.submit(message_events)
+        return {"status": 200, "queued": len(message_events)}
+
+    # まとめ待ちに入ったテキストは応答を待たずに次のイベントへ進み、最後にまとめて結果を待つ
+    tasks = [await start_in_order(event_deduplicator.handle, event) for event in events]
+    results = [result for result in await asyncio.gather(*tasks) if result is not None]
 
     return {"status": 200, "results": results}
 
 
+# ===== メトリクス =====
+@app.get("/metrics")
+async def metrics():
+    """Prometheus形式のメトリクス"""
+    return Response(content=render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+# ===== メディア配信 =====
+@app.get("/media/stickers/{name}")
+async def sticker_media(name: str):
+    """キャッシュしたスタンプ応答画像を配信（LINEが画像メッセージの取得に使う）"""
+    stem, _, ext = name.rpartition(".")
+    if ext != "jpg" or not stem.replace("_preview", "").isalnum():
+        raise HTTPException(status_code=404, detail="Not found")
+    content = await sticker_cache.image(stem)
+    if content is None:
+        raise HTTPException(status_code=404, detail="Not found")
+    return Response(content, media_type="image/jpeg", headers={"Cache-Control": "public, max-age=86400"})
+
+
 # ===== ヘルスチェック =====
 @app.get("/")
 async def root():
@@ -591,5 +4404,26 @@ async def health():
         "has_openai_key": bool(OPENAI_KEY),
         "has_channel_secret": bool(CHANNEL_SECRET),
         "db_path": str(DB_PATH),
-        "db_exists": DB_PATH.exists(),
+        "db_shards": [str(path) for path in history_shards.paths],
+        "db_exists": all(path.exists() for path in history_shards.paths),
+        "startup": {
+            "phases_ms": {phase: round(seconds * 1000, 1) for phase, seconds in startup_phases.items()},
+            **startup_report,
+        },
+        "upstream": upstream.stats(),
+        "openai": openai_scheduler.stats(),
+        "model_routing": model_router.stats(),
+        "event_queue": dispatcher.stats(),
+        "event_dedup": event_deduplicator.stats(),
+        "message_coalescing": message_coalescer.stats(),
+        "history_cache": history_cache.stats(),
+        "history_writer": history_shards.stats(),
+        "history_retention": history_retention.stats(),
+        "context": {**context_stats.stats(), "summaries": conversation_summaries.stats()},
+        "images": {**image_stats, "decode": image_decode_budget.stats()},
+        "image_analysis_cache": image_analysis_cache.stats(),
+        "answer_cache": answer_cache.stats(),
+        "sticker_cache": {**sticker_cache.stats(), "prewarm": sticker_prewarmer.stats()},
+        "audio": {**audio_stats, "transcription_cache": transcription_cache.stats()},
+        "logging": {**log_sampler.stats(), "queued": log_queue.qsize()},
     }
@@ -0,0 +1,190 @@
+"""
+会話履歴DBの分割数（HISTORY_SHARDS）を変更する移行ツール
+
+    python tools/reshard_history.py --from-shards 1 --to-shards 4 [--db line_chat_history.db]
+
+アプリを止めた状態で実行する。移行元のデータは変更・削除せず（スキーマだけは現在の
+バージョンにそろえる）、移行先のファイル（main.shard_paths() と同じ名前）を新しく作って
+user_id のハッシュで振り分ける。
+移行後に HISTORY_SHARDS を変更してアプリを起動し、問題がなければ移行元を削除する。
+
+id は移行先のshardごとに振り直す（ユーザー内の順序は保つ）。アーカイブを先に移し、本体の id は
+アーカイブの最大 id より後から振るので、今後の保持期間の整理でアーカイブの id と衝突しない。
+要約の last_id も振り直した id に合わせる。コミット前に行数と id の範囲を確かめ、合わなければ取り消す。
+"""
+
+import argparse
+import sqlite3
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import main  # noqa: E402
+
+DEFAULT_DB = main.DB_PATH
+
+
+def _users(conn: sqlite3.Connection) -> list[str]:
+    return [
+        row[0]
+        for row in conn.execute(
+            "SELECT user_id FROM chat_history UNION SELECT user_id FROM chat_summary "
+            "UNION SELECT user_id FROM chat_history_archive UNION SELECT user_id FROM user_settings"
+        )
+    ]
+
+
+def _row_count(path: Path) -> int:
+    if not path.exists():
+        return 0
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("SELECT COUNT(*) FROM chat_history").fetchone()[0]
+    except sqlite3.OperationalError:
+        return 0
+    finally:
+        conn.close()
+
+
+def _copy_archive(source: sqlite3.Connection, target: sqlite3.Connection, user_id: str) -> int:
+    """1ユーザー分のアーカイブを移して行数を返す（id は移行先で振り直す）"""
+    archived = source.execute(
+        "SELECT role, content, timestamp, archived_at FROM chat_history_archive WHERE user_id = ? ORDER BY id",
+        (user_id,),
+    ).fetchall()
+    target.executemany(
+        "INSERT INTO chat_history_archive (user_id, role, content, timestamp, archived_at) VALUES (?, ?, ?, ?, ?)",
+        ((user_id, *row) for row in archived),
+    )
+    return len(archived)
+
+
+def _reserve_archive_ids(conn: sqlite3.Connection) -> None:
+    """本体の AUTOINCREMENT をアーカイブの最大 id より先に進める
+
+    保持期間の整理は本体の id のままアーカイブへ移す（INSERT OR IGNORE）ので、本体の行を
+    入れる前に進めておかないと、id が重なった行はアーカイブされずに削除されてしまう。
+    """
+    max_archive = conn.execute("SELECT COALESCE(MAX(id), 0) FROM chat_history_archive").fetchone()[0]
+    updated = conn.execute(
+        "UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'chat_history'", (max_archive,)
+    ).rowcount
+    if not updated and max_archive:
+        conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('chat_history', ?)", (max_archive,))
+
+
+def _copy_user(source: sqlite3.Connection, target: sqlite3.Connection, user_id: str) -> int:
+    """1ユーザー分の履歴・要約・設定を移して履歴の行数を返す"""
+    id_map: list[tuple[int, int]] = []
+    rows = source.execute(
+        "SELECT id, role, content, timestamp FROM chat_history WHERE user_id = ? ORDER BY id", (user_id,)
+    ).fetchall()
+    for old_id, role, content, timestamp in rows:
+        cursor = target.execute(
+            "INSERT INTO chat_history (user_id, role, content, timestamp) VALUES (?, ?, ?, ?)",
+            (user_id, role, content, timestamp),
+        )
+        id_map.append((old_id, cursor.lastrowid))
+
+    summary = source.execute(
+        "SELECT summary, last_id, updated_at FROM chat_summary WHERE user_id = ?", (user_id,)
+    ).fetchone()
+    if summary is not None:
+        text, last_id, updated_at = summary
+        # 要約済みだった行のうち最後のものの新しい id
+        new_last_id = max((new for old, new in id_map if old <= last_id), default=0)
+        target.execute(
+            "INSERT INTO chat_summary (user_id, summary, last_id, updated_at) VALUES (?, ?, ?, ?)",
+            (user_id, text, new_last_id, updated_at),
+        )
+
+    settings = source.execute("SELECT answer_cache FROM user_settings WHERE user_id = ?", (user_id,)).fetchone()
+    if settings is not None:
+        target.execute("INSERT INTO user_settings (user_id, answer_cache) VALUES (?, ?)", (user_id, *settings))
+    return len(rows)
+
+
+def _counts(conn: sqlite3.Connection) -> tuple[int, int]:
+    return (
+        conn.execute("SELECT COUNT(*) FROM chat_history").fetchone()[0],
+        conn.execute("SELECT COUNT(*) FROM chat_history_archive").fetchone()[0],
+    )
+
+
+def _verify(source_counts: tuple[int, int], target_conns: list[sqlite3.Connection]) -> None:
+    """移行先の行数が移行元と一致し、本体の id がすべてアーカイブの id より大きいことを確かめる"""
+    target_counts = tuple(map(sum, zip(*(_counts(conn) for conn in target_conns))))
+    if target_counts != source_counts:
+        raise SystemExit(f"行数が一致しません: 移行元(本体, アーカイブ)={source_counts}, 移行先={target_counts}")
+    for conn in target_conns:
+        min_live, max_archive = conn.execute(
+            "SELECT (SELECT MIN(id) FROM chat_history), (SELECT MAX(id) FROM chat_history_archive)"
+        ).fetchone()
+        if min_live is not None and max_archive is not None and min_live <= max_archive:
+            raise SystemExit(f"本体の id がアーカイブの id と重なっています: min_live={min_live}, max_archive={max_archive}")
+
+
+def reshard(db: Path, from_shards: int, to_shards: int) -> None:
+    sources = main.shard_paths(db, from_shards)
+    targets = main.shard_paths(db, to_shards)
+    missing = [path for path in sources if not path.exists()]
+    if missing:
+        raise SystemExit(f"移行元が見つかりません: {', '.join(map(str, missing))}")
+    if set(sources) & set(targets):
+        raise SystemExit("移行元と移行先が同じファイルです（分割数を変えてください）")
+    occupied = [path for path in targets if _row_count(path)]
+    if occupied:
+        raise SystemExit(f"移行先に既にデータがあります: {', '.join(map(str, occupied))}")
+
+    for path in targets:
+        main.init_db(path)
+    for path in sources:
+        main.init_db(path)  # 古いスキーマのままなら新しいテーブルを足しておく
+    source_conns = [main.connect_db(path) for path in sources]
+    target_conns = [main.connect_db(path) for path in targets]
+    started = time.perf_counter()
+    totals = [[0, 0, 0] for _ in targets]  # users, rows, archived
+    try:
+        source_counts = tuple(map(sum, zip(*(_counts(conn) for conn in source_conns))))
+        for conn in target_conns:
+            conn.execute("BEGIN IMMEDIATE")
+        users = [(source, user_id) for source in source_conns for user_id in _users(source)]
+        # アーカイブを先に移し、本体の id をその先から振る
+        for source, user_id in users:
+            index = main.shard_index(user_id, to_shards)
+            totals[index][2] += _copy_archive(source, target_conns[index], user_id)
+        for conn in target_conns:
+            _reserve_archive_ids(conn)
+        for source, user_id in users:
+            index = main.shard_index(user_id, to_shards)
+            totals[index][0] += 1
+            totals[index][1] += _copy_user(source, target_conns[index], user_id)
+        _verify(source_counts, target_conns)
+        for conn in target_conns:
+            conn.commit()
+    except BaseException:
+        for conn in target_conns:
+            conn.rollback()
+        raise
+    finally:
+        for conn in [*source_conns, *target_conns]:
+            conn.close()
+
+    elapsed = time.perf_counter() - started
+    for path, (users, rows, archived) in zip(targets, totals):
+        print(f"{path}: users={users} rows={rows} archived={archived}")
+    print(f"完了: {elapsed:.1f}s。HISTORY_SHARDS={to_shards} で起動し、確認後に移行元を削除してください:")
+    for path in sources:
+        print(f"  {path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--db", type=Path, default=DEFAULT_DB, help="履歴DBのパス（既定は HISTORY_DB_PATH）")
+    parser.add_argument("--from-shards", type=int, required=True)
+    parser.add_argument("--to-shards", type=int, required=True)
+    args = parser.parse_args()
+    reshard(args.db, max(1, args.from_shards), max(1, args.to_shards))